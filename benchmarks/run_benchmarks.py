@@ -0,0 +1,175 @@
+# Per-stage benchmarks of the pipeline
+#
+# For every requested scale, generates the synthetic league (see
+# synthetic_league.py), creates the raw and cleaned tables on a throwaway
+# database and runs process_data_task against it a few times, with a config
+# pointing at the generated files. The database is
+# a SQLite file in a temporary directory unless --database-url names a
+# scratch database (e.g. an empty PostgreSQL one), whose tables are dropped
+# first. Every run appends the stage metrics of the instrumentation, the
+# commit and the settings to RESULTS_FILE, and its stages are compared with
+# the last stored run of the same scale, mode, database and run number, so
+# the regressions between versions show. RESULTS_FILE is not committed:
+# timings only compare on one machine, so the first run there is its baseline.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+from sqlalchemy import create_engine, inspect, text
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import league_pipeline
+from pipeline_config import load_config
+from synthetic_league import generate_league
+
+
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.jsonl")
+
+# A stage this much slower than in the stored run is reported as a regression
+REGRESSION_RATIO = 1.2
+# Stages faster than this are not compared, their times are mostly noise
+MIN_COMPARED_SECONDS = 0.25
+
+# Raw tables of the pipeline, parents first; the cleaned tables have the same columns
+SCHEMA = {
+    "teams": """
+        team_id INTEGER PRIMARY KEY, team_name TEXT, founded_year INTEGER, home_city TEXT, manager_name TEXT,
+        stadium_name TEXT, stadium_capacity INTEGER, country TEXT""",
+    "players": """
+        player_id INTEGER PRIMARY KEY, team_id INTEGER, player_name TEXT, position TEXT, birthdate DATE,
+        nationality TEXT, contract_until DATE, market_value BIGINT""",
+    "matches": """
+        match_id INTEGER PRIMARY KEY, match_date DATE, home_team_id INTEGER, away_team_id INTEGER,
+        home_team_score INTEGER, away_team_score INTEGER, stadium TEXT, referee TEXT""",
+    "player_stats": """
+        stat_id INTEGER PRIMARY KEY, player_id INTEGER, match_id INTEGER, goals INTEGER, assists DOUBLE PRECISION,
+        yellow_cards INTEGER, red_cards INTEGER, mins_played INTEGER""",
+    "transfer_history": """
+        trans_id INTEGER PRIMARY KEY, player_id INTEGER, from_team_id INTEGER, to_team_id INTEGER, trans_date DATE,
+        trans_fee BIGINT, contract_duration INTEGER""",
+}
+
+
+def create_schema(engine):
+    # Drops every table of the database, then creates the raw and cleaned tables
+    with engine.begin() as connection:
+        for table_name in reversed(inspect(connection).get_table_names()):
+            connection.execute(text(f"DROP TABLE {table_name} CASCADE" if engine.dialect.name == "postgresql"
+                                    else f"DROP TABLE {table_name}"))
+        for table_name, columns in SCHEMA.items():
+            connection.execute(text(f"CREATE TABLE {table_name} ({columns})"))
+            connection.execute(text(f"CREATE TABLE cleaned_{table_name} ({columns})"))
+
+
+def benchmark_config(csv_files, work_dir, database_url, mode, workers):
+    # The files of the pipeline in work_dir, whatever the environment says
+    return load_config(
+        environ={},
+        database_url=database_url,
+        data_dir=work_dir,
+        csv_files=csv_files,
+        final_view_csv="final_view.csv",
+        log_records_file="",
+        metrics_report="",
+        sync_mode=mode,
+        workers=workers,
+    )
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+def same_benchmark(result, other):
+    return all(result[field] == other[field] for field in ("scale", "mode", "database", "run"))
+
+
+def compare(result, previous):
+    # [stage, previous seconds, seconds, change, flag] of the stages both runs have
+    previous_seconds = {stage["stage"]: stage["wall_seconds"] for stage in previous["stages"]}
+    rows = []
+    for stage in result["stages"] + [{"stage": "(run)", "wall_seconds": result["wall_seconds"]}]:
+        name, seconds = stage["stage"], stage["wall_seconds"]
+        before = previous_seconds.get(name, previous["wall_seconds"] if name == "(run)" else None)
+        if before is None or max(before, seconds) < MIN_COMPARED_SECONDS:
+            continue
+        ratio = seconds / before if before else float("inf")
+        rows.append([name, before, seconds, f"{ratio - 1:+.0%}", "REGRESSION" if ratio > REGRESSION_RATIO else ""])
+    return rows
+
+
+def run_benchmark(scale, mode, runs, database_url, workers, seed, results_path):
+    from tabulate import tabulate
+
+    with tempfile.TemporaryDirectory(prefix=f"league_benchmark_{scale}x_") as work_dir:
+        csv_files = generate_league(os.path.join(work_dir, "CSVs"), scale, seed)
+        database_url = database_url or f"sqlite:///{os.path.join(work_dir, 'league.sqlite')}"
+        engine = create_engine(database_url)
+        create_schema(engine)
+        engine.dispose()
+        config = benchmark_config(csv_files, work_dir, database_url, mode, workers)
+
+        stored = read_results(results_path)
+        for run_number in range(1, runs + 1):
+            instrumentation = league_pipeline.process_data_task(config)
+            result = {
+                "benchmark_started": datetime.now().isoformat(timespec="seconds"),
+                "commit": current_commit(),
+                "scale": scale,
+                "mode": mode,
+                "database": create_engine(database_url).dialect.name,
+                "workers": league_pipeline.pipeline_workers(config),
+                "seed": seed,
+                # 1 loads an empty database, 2 the stats and transfers 1 rejected (their
+                # players were not stored yet), the later runs sync unchanged CSVs
+                "run": run_number,
+                **instrumentation.report(),
+            }
+            with open(results_path, "a") as results_file:
+                results_file.write(json.dumps(result, default=str) + "\n")
+
+            print(f"\n{scale}x {mode} on {result['database']}, run {run_number}: {result['wall_seconds']} s")
+            previous = next((other for other in reversed(stored) if same_benchmark(result, other)), None)
+            if previous is None:
+                print(tabulate([[stage["stage"], stage["wall_seconds"], stage["cpu_seconds"], stage["peak_rss_mb"]]
+                                for stage in result["stages"]],
+                               headers=["Stage", "Seconds", "CPU seconds", "Peak RSS MB"], tablefmt="grid"))
+            else:
+                print(f"against {previous['commit']} of {previous['benchmark_started']}")
+                print(tabulate(compare(result, previous),
+                               headers=["Stage", "Before", "Seconds", "Change", ""], tablefmt="grid"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on a synthetic league")
+    parser.add_argument("--scale", type=int, nargs="+", default=[1, 100],
+                        help="multiples of FootballDummyData.xlsx, e.g. 1 100 10000")
+    parser.add_argument("--mode", choices=sorted(league_pipeline.PIPELINE_TASKS), default="incremental")
+    parser.add_argument("--runs", type=int, default=2, help="runs per scale, the first one on an empty database")
+    parser.add_argument("--database-url", help="scratch database, its tables are dropped (default: temporary SQLite)")
+    parser.add_argument("--workers", type=int, help="stage threads (default: see league_pipeline.pipeline_workers)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--results", default=RESULTS_FILE)
+    args = parser.parse_args()
+
+    for scale in args.scale:
+        run_benchmark(scale, args.mode, args.runs, args.database_url, args.workers, args.seed, args.results)
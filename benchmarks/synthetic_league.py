@@ -0,0 +1,130 @@
+# Synthetic football league for the benchmarks
+#
+# Writes the five source CSVs of the pipeline with the schema of
+# FootballDummyData.xlsx at a multiple of its size: scale 1 has its 20 teams,
+# 400 players, 210 matches, 1000 stats and 80 transfers, scale 100 a hundred
+# times as many of each. Rows are drawn from the rows of the workbook (so
+# names, cities, scores, minutes and card pairs keep their frequencies and
+# their combinations), then given new ids and foreign keys over the scaled
+# tables, so every team keeps about 20 players. The anomalies the pipeline
+# cleans are kept: the card pairs include the invalid ones at the workbook
+# rate, FK_VIOLATION_RATE of the stats and transfers reference unknown
+# players, and the tables the workbook lists twice are written twice. Every
+# table is generated and written CHUNK_ROWS rows at a time, from a seed per
+# chunk, so the output only depends on the seed and 10000x fits in memory.
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from league_schema import SHEETS
+from pipeline_config import CSV_NAMES
+
+
+WORKBOOK = os.path.join(REPO_DIR, "FootballDummyData.xlsx")
+
+# The standard scales: the workbook, a large league and a stress test
+SCALES = (1, 100, 10_000)
+
+# Share of the stats and transfers whose player does not exist
+FK_VIOLATION_RATE = 0.01
+
+CHUNK_ROWS = 1_000_000
+
+
+def read_workbook(path=WORKBOOK):
+    # The distinct rows of every sheet, dates as ISO strings like the CSVs,
+    # and whether the sheet lists its rows twice
+    sheets = pd.read_excel(path, sheet_name=list(SHEETS.values()))
+    rows = {}
+    duplicated = {}
+    for table_name, sheet in SHEETS.items():
+        df = sheets[sheet]
+        for column in df.columns:
+            if pd.api.types.is_datetime64_any_dtype(df[column]):
+                df[column] = df[column].dt.strftime("%Y-%m-%d")
+        duplicated[table_name] = bool(df.duplicated().any())
+        rows[table_name] = df.drop_duplicates().reset_index(drop=True)
+    return rows, duplicated
+
+
+def ids_of(rng, count, size):
+    return rng.integers(1, count + 1, size=size)
+
+
+def player_ids(rng, counts, size):
+    # FK_VIOLATION_RATE of them past the last player
+    ids = ids_of(rng, counts["players"], size)
+    unknown = rng.random(size) < FK_VIOLATION_RATE
+    ids[unknown] += counts["players"]
+    return ids
+
+
+def other_team_ids(rng, counts, team_ids):
+    # a random team that is not team_ids (when there is one)
+    if counts["teams"] == 1:
+        return team_ids
+    return (team_ids - 1 + ids_of(rng, counts["teams"] - 1, len(team_ids))) % counts["teams"] + 1
+
+
+def generate_keys(table_name, df, rng, counts):
+    # New foreign keys of the sampled rows, in place
+    size = len(df)
+    if table_name == "players":
+        df["TeamID"] = ids_of(rng, counts["teams"], size)
+    elif table_name == "matches":
+        df["HomeTeamID"] = ids_of(rng, counts["teams"], size)
+        df["AwayTeamID"] = other_team_ids(rng, counts, df["HomeTeamID"].to_numpy())
+    elif table_name == "player_stats":
+        df["PlayerID"] = player_ids(rng, counts, size)
+        df["MatchID"] = ids_of(rng, counts["matches"], size)
+    elif table_name == "transfer_history":
+        df["PlayerID"] = player_ids(rng, counts, size)
+        df["FromTeamID"] = ids_of(rng, counts["teams"], size)
+        df["ToTeamID"] = other_team_ids(rng, counts, df["FromTeamID"].to_numpy())
+
+
+def generate_chunk(table_name, sample, counts, seed, chunk_number, start, stop):
+    # Rows start + 1 .. stop of a table, the same for the same seed
+    rng = np.random.default_rng([seed, list(SHEETS).index(table_name), chunk_number])
+    df = sample.iloc[rng.integers(0, len(sample), size=stop - start)].reset_index(drop=True)
+    df[sample.columns[0]] = np.arange(start + 1, stop + 1)
+    generate_keys(table_name, df, rng, counts)
+    return df
+
+
+def generate_league(output_dir, scale=1, seed=0, workbook=WORKBOOK, chunk_rows=CHUNK_ROWS):
+    # Writes the CSVs into output_dir, returns {table: CSV path}
+    os.makedirs(output_dir, exist_ok=True)
+    rows, duplicated = read_workbook(workbook)
+    counts = {table_name: len(sample) * scale for table_name, sample in rows.items()}
+
+    paths = {}
+    for table_name, sample in rows.items():
+        paths[table_name] = os.path.join(output_dir, CSV_NAMES[table_name])
+        header = True
+        for _ in range(2 if duplicated[table_name] else 1):
+            for chunk_number, start in enumerate(range(0, counts[table_name], chunk_rows)):
+                stop = min(start + chunk_rows, counts[table_name])
+                df = generate_chunk(table_name, sample, counts, seed, chunk_number, start, stop)
+                df.to_csv(paths[table_name], mode="w" if header else "a", header=header, index=False)
+                header = False
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic football league as the pipeline source CSVs")
+    parser.add_argument("output_dir")
+    parser.add_argument("--scale", type=int, default=1, help=f"multiple of the workbook size, e.g. {SCALES}")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workbook", default=WORKBOOK)
+    args = parser.parse_args()
+
+    for table_name, path in generate_league(args.output_dir, args.scale, args.seed, args.workbook).items():
+        print(f"{table_name}: {path}")
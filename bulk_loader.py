@@ -0,0 +1,204 @@
+# Bulk writers for the pipeline tables
+#
+# TableWriter loads frames with batched INSERTs and works with any SQLAlchemy
+# engine (e.g. SQLite). CopyWriter streams them through
+# PostgreSQL's COPY FROM STDIN instead. Both keep the rows/sec of every write,
+# store the datetime64 dates of the frames as ISO dates and the floats
+# holding only whole numbers as integers (see writable). Upserts use INSERT
+# ... ON CONFLICT where the dialect has it (PostgreSQL, SQLite); on the other
+# dialects the rows of the keys are deleted and inserted again, in the
+# caller's transaction.
+
+import io
+import time
+from collections import namedtuple
+
+from sqlalchemy import Column, Date, Float, MetaData, Table, bindparam, text
+
+from league_schema import database_values, date_columns
+
+
+LoadStats = namedtuple("LoadStats", ["table_name", "rows", "seconds"])
+
+
+def integral_float_columns(df):
+    # Float columns holding only whole numbers, like the integer columns
+    # with NULLs that pandas reads as float64
+    columns = []
+    for column in df.columns:
+        values = df[column]
+        if values.dtype.kind == "f" and values.notna().any() and (values.dropna() % 1 == 0).all():
+            columns.append(column)
+    return columns
+
+
+def writable(df):
+    # (values, date columns, integral float columns) of df as the writers
+    # send it: the dates as ISO text and the integral floats as integers,
+    # since COPY rejects "1.0" for an INTEGER column and a float column
+    # takes 1 as well
+    dates, integral = date_columns(df), integral_float_columns(df)
+    values = database_values(df, dates)
+    if integral:
+        values = values.astype(dict.fromkeys(integral, "Int64"))
+    return values, dates, integral
+
+
+def on_conflict_insert(dialect):
+    # The insert() of the dialect that has on_conflict_do_update, None if it has none
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    return None
+
+
+class TableWriter:
+
+    # rows per executemany() batch
+    batch_rows = 10_000
+
+    # pandas to_sql method. The default executemany() is batched into
+    # multi-row VALUES by SQLAlchemy where the driver supports it, and is far
+    # faster than pandas' "multi" method, which compiles one huge statement
+    # per chunk.
+    insert_method = None
+
+    # SQL type of the date columns of the tables to_sql creates; None keeps
+    # the text type pandas infers for the ISO dates, which is what SQLite has
+    date_type = None
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.stats = []
+
+    def write(self, df, table_name, if_exists="append", connection=None):
+        start = time.perf_counter()
+        values, dates, integral = writable(df)
+        # the tables to_sql creates keep a float column for the integral floats
+        dtype = {column: Float(precision=53) for column in integral}
+        if self.date_type is not None:
+            dtype.update({column: self.date_type for column in dates})
+        values.to_sql(
+            table_name,
+            connection if connection is not None else self.engine,
+            if_exists=if_exists,
+            index=False,
+            method=self.insert_method,
+            chunksize=self.batch_rows,
+            dtype=dtype or None,
+        )
+        self.record(table_name, len(df), start)
+
+    def upsert(self, connection, df, table_name, key):
+        # INSERT ... ON CONFLICT (key) DO UPDATE, inside the caller's transaction
+        if df.empty:
+            return
+        start = time.perf_counter()
+        values, _, _ = writable(df)
+        records = values.astype(object).where(values.notna(), None).to_dict("records")
+
+        # Untyped columns, so values are passed to the driver as they are
+        table = Table(table_name, MetaData(), *[Column(column) for column in df.columns])
+        insert = on_conflict_insert(connection.dialect.name)
+        if insert is None:
+            self.delete_keys(connection, table_name, key, list(dict.fromkeys(record[key] for record in records)))
+            statement = table.insert()
+        else:
+            statement = insert(table)
+            statement = statement.on_conflict_do_update(
+                index_elements=[key],
+                set_={column: statement.excluded[column] for column in df.columns if column != key},
+            )
+        for offset in range(0, len(records), self.batch_rows):
+            connection.execute(statement, records[offset:offset + self.batch_rows])
+        self.record(table_name, len(df), start)
+
+    def delete_keys(self, connection, table_name, key, keys):
+        statement = text(f"DELETE FROM {table_name} WHERE {key} IN :keys").bindparams(
+            bindparam("keys", expanding=True))
+        for offset in range(0, len(keys), self.batch_rows):
+            connection.execute(statement, {"keys": keys[offset:offset + self.batch_rows]})
+
+    def record(self, table_name, rows, start):
+        self.stats.append(LoadStats(table_name, rows, time.perf_counter() - start))
+
+    def report(self):
+        # [table, rows, seconds, rows/sec] for every write, in order
+        return [
+            [entry.table_name, entry.rows, round(entry.seconds, 3),
+             round(entry.rows / entry.seconds) if entry.seconds else 0]
+            for entry in self.stats
+        ]
+
+
+# Backslash escapes of the COPY text format
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def copy_value(value):
+    # None is NULL (\N), so an empty string stays an empty string
+    if value is None:
+        return "\\N"
+    return str(value).translate(COPY_ESCAPES)
+
+
+def copy_buffer(conn, name, columns, rows):
+    # Stream rows through an in-memory buffer in the COPY text format with
+    # COPY FROM STDIN
+    buffer = io.StringIO()
+    buffer.writelines("\t".join(map(copy_value, row)) + "\n" for row in rows)
+    buffer.seek(0)
+
+    columns = ", ".join(f'"{column}"' for column in columns)
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {name} ({columns}) FROM STDIN", buffer)
+
+
+def copy_rows(table, conn, keys, data_iter):
+    # pandas to_sql method
+    name = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+    copy_buffer(conn, name, keys, data_iter)
+
+
+class CopyWriter(TableWriter):
+
+    # rows per COPY buffer
+    batch_rows = 100_000
+
+    insert_method = staticmethod(copy_rows)
+
+    # COPY parses the ISO text, so new tables get real DATE columns
+    date_type = Date()
+
+    def upsert(self, connection, df, table_name, key):
+        # COPY into a temporary staging table, then upsert it with one statement
+        if df.empty:
+            return
+        start = time.perf_counter()
+        staging = f"{table_name}_staging"
+        connection.execute(text(f"DROP TABLE IF EXISTS {staging}"))
+        connection.execute(text(
+            f"CREATE TEMPORARY TABLE {staging} (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP"
+        ))
+        values, _, _ = writable(df)
+        values = values.astype(object).where(values.notna(), None)
+        for offset in range(0, len(values), self.batch_rows):
+            chunk = values.iloc[offset:offset + self.batch_rows]
+            copy_buffer(connection, staging, df.columns, chunk.itertuples(index=False))
+
+        columns = ", ".join(df.columns)
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in df.columns if column != key)
+        connection.execute(text(
+            f"INSERT INTO {table_name} ({columns}) SELECT {columns} FROM {staging} "
+            f"ON CONFLICT ({key}) DO UPDATE SET {updates}"
+        ))
+        self.record(table_name, len(df), start)
+
+
+def make_writer(engine):
+    if engine.dialect.name == "postgresql":
+        return CopyWriter(engine)
+    return TableWriter(engine)
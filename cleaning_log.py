@@ -0,0 +1,188 @@
+# Cleaning log: every rejected row of a run, collected in bulk
+#
+# Rejected rows are added as whole DataFrames and the log is rendered once
+# per run: a grid table for people (data_cleaning.log), an optional
+# JSONL/Parquet file for tools and an optional rotating JSONL history that
+# keeps the rejections of previous runs.
+
+import logging
+import math
+import os
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+import numpy as np
+import pandas as pd
+
+
+COLUMNS = ["Table ID", "Table Name", "Cleaning Reason"]
+
+# Column names of the machine-readable records
+RECORD_COLUMNS = {
+    "Table ID": "table_id",
+    "Table Name": "table_name",
+    "Cleaning Reason": "reason",
+}
+
+
+def cell_type(value):
+    # Type tabulate deduces for a cell: None for a blank one (None or empty
+    # text), otherwise bool, int, float or str, text that reads as a number
+    # counting as a number
+    if value is None or (isinstance(value, str) and not value):
+        return None
+    if hasattr(value, "isoformat"):
+        return str
+    if isinstance(value, bool):
+        return bool
+    if isinstance(value, (int, np.integer)):
+        return int
+    if isinstance(value, (float, np.floating)):
+        return float
+    for number_type in (int, float):
+        try:
+            number = number_type(value)
+        except (TypeError, ValueError):
+            continue
+        # text overflowing to infinity stays text
+        if number_type is float and isinstance(value, str) and math.isinf(number) and "inf" not in value.lower():
+            return str
+        return number_type
+    return str
+
+
+# cell types from the least to the most generic, as tabulate ranks them
+CELL_TYPES = [bool, int, float, str]
+
+
+def grid_cells(values):
+    # (cells, numeric) of a column as tabulate formats it: the most generic
+    # type of its cells decides; ints are printed as they are, floats with
+    # format "g" (2.0 as "2", NaN as "nan"), anything else as text
+    if isinstance(values.dtype, np.dtype) and values.dtype.kind in "iu":
+        return values.astype(str), True
+    if isinstance(values.dtype, np.dtype) and values.dtype.kind == "f":
+        return values.map(lambda value: format(value, "g")), True
+
+    values = values.astype(object)
+    types = values.map(cell_type)
+    present = [cell_type for cell_type in CELL_TYPES if (types == cell_type).any()]
+    column_type = present[-1] if present else None
+    blank = types.isna()
+    if column_type is float:
+        cells = values.map(lambda value: value if value is None or value == "" else format(float(value), "g"))
+    else:
+        cells = values.map(str)
+    cells = cells.where(~blank, "")
+    if column_type in (int, float):
+        return cells, True
+    return cells.str.strip(), False
+
+
+def decimals(cells):
+    # Digits after the decimal point (or the exponent) of every number, -1 without one
+    point = cells.str.rfind(".")
+    point = point.where(point >= 0, cells.str.lower().str.rfind("e"))
+    return (cells.str.len() - point - 1).where(point >= 0, -1)
+
+
+def render_grid(df):
+    # Same text as tabulate(df, headers="keys", tablefmt="grid",
+    # showindex=False) for single-line cells (but frames of bool columns
+    # only, which tabulate prints as 1 and 0), built column by column with
+    # vectorized string operations so large logs render in one pass
+    columns = []
+    for name in df.columns:
+        values, numeric = grid_cells(df[name])
+        if numeric and len(values):
+            # like tabulate, numbers are right-aligned on their decimal point
+            places = decimals(values)
+            values = values + places.rsub(places.max()).map(lambda spaces: " " * spaces)
+        width = max(len(name) + 2, int(values.str.len().max()) if len(values) else 0)
+        if numeric and len(values):
+            columns.append((width, name.rjust(width), values.str.rjust(width)))
+        else:
+            columns.append((width, name.ljust(width), values.str.ljust(width)))
+
+    border = "+" + "+".join("-" * (width + 2) for width, _, _ in columns) + "+"
+    lines = [
+        border,
+        "| " + " | ".join(header for _, header, _ in columns) + " |",
+        border.replace("-", "="),
+    ]
+    if len(df):
+        rows = columns[0][2]
+        for _, _, cells in columns[1:]:
+            rows = rows + " | " + cells
+        rows = "| " + rows + " |"
+        lines.append(("\n" + border + "\n").join(rows))
+    lines.append(border)
+    return "\n".join(lines)
+
+
+def history_logger(path, max_bytes, backups):
+    # One rotating handler per history file, shared by every run of the process
+    logger = logging.getLogger("cleaning_log.history")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    path = os.path.abspath(path)
+    if not any(getattr(handler, "baseFilename", None) == path for handler in logger.handlers):
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+    return logger
+
+
+class CleaningLog:
+
+    def __init__(self, file_path, records_path=None, history_path=None,
+                 history_max_bytes=10 * 1024 * 1024, history_backups=5):
+        self.file_path = file_path
+        self.records_path = records_path
+        self.history_path = history_path
+        self.history_max_bytes = history_max_bytes
+        self.history_backups = history_backups
+        self.entries = []
+
+    def add(self, rows, id_column, table_name, reason=None, reason_column="reason"):
+        # Log every row of a rejected frame, with a fixed reason or the
+        # reason stored in one of its columns
+        if rows.empty:
+            return
+        self.entries.append(pd.DataFrame({
+            "Table ID": rows[id_column].to_numpy(),
+            "Table Name": table_name,
+            "Cleaning Reason": reason if reason is not None else rows[reason_column].to_numpy(),
+        }))
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.entries)
+
+    def frame(self):
+        if not self.entries:
+            return pd.DataFrame(columns=COLUMNS)
+        return pd.concat(self.entries, ignore_index=True)
+
+    def records(self):
+        records = self.frame().rename(columns=RECORD_COLUMNS)
+        records["logged_at"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        return records
+
+    def write(self):
+        with open(self.file_path, 'w') as log_file:
+            log_file.write("Data Cleaning Log\n")
+            log_file.write(render_grid(self.frame()))
+
+        if self.records_path is None and self.history_path is None:
+            return
+        records = self.records()
+
+        if self.records_path is not None:
+            if self.records_path.endswith(".parquet"):
+                records.to_parquet(self.records_path, index=False)
+            else:
+                records.to_json(self.records_path, orient="records", lines=True)
+
+        if self.history_path is not None and len(records):
+            logger = history_logger(self.history_path, self.history_max_bytes, self.history_backups)
+            logger.info(records.to_json(orient="records", lines=True).rstrip("\n"))
@@ -0,0 +1,12 @@
+# Checksums of the source files, by the scheduler (did a CSV change since
+# the last run) and the Parquet staging layer (since its last conversion)
+
+import hashlib
+
+
+def file_checksum(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
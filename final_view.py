@@ -0,0 +1,342 @@
+# final_view builder
+#
+# The view is built in vectorized stages: per-player aggregates with
+# built-in groupby reductions (persisted in final_view_aggregates), date
+# arithmetic for the ages, and isin lookups for the France/Italy columns.
+# The frames come in the compact dtypes of league_schema.py, so the lookups
+# and merges run on int32 keys and category countries, and the dates are
+# already datetime64. In incremental mode only the players touched by the
+# synced changes are refreshed in both tables: their stored stat aggregates
+# are folded with the changed stats, so the stats table is not read again.
+# The whole view is rebuilt on the first run of the day, which is recorded
+# in the database with the aggregates.
+
+from datetime import date, datetime
+
+import pandas as pd
+from sqlalchemy import Column, Date, MetaData, Table, bindparam, delete, inspect, insert, select, text
+
+from incremental_sync import delete_keys, fetch_rows, key_batches
+from league_schema import apply_schema
+
+
+FINAL_VIEW_COLUMNS = [
+    'player_id', 'player_name', 'team_name', 'TotalGoals', 'TotalAssists',
+    'AverageMinutesPlayed', 'PlayedOver300Min', 'AgeBetween25And30', 'Scored3PlusGoalsInMatch',
+    'EstimatedMatchesPlayed',
+    'PlayedInFrance', 'DateJoinedFrenchTeam', 'PlayedInItaly', 'DateJoinedItalianTeam',
+]
+
+# (country, played flag column, earliest join date column,
+#  transfer count aggregate, earliest join date aggregate)
+COUNTRY_COLUMNS = [
+    ("France", 'PlayedInFrance', 'DateJoinedFrenchTeam', 'french_transfers', 'first_french_join'),
+    ("Italy", 'PlayedInItaly', 'DateJoinedItalianTeam', 'italian_transfers', 'first_italian_join'),
+]
+
+AGGREGATES_TABLE = "final_view_aggregates"
+
+# Day of the last full rebuild; the age flags only change from one day to the next
+REBUILD_TABLE = "final_view_rebuild"
+
+rebuild_metadata = MetaData()
+final_view_rebuild = Table(
+    REBUILD_TABLE,
+    rebuild_metadata,
+    Column("rebuilt_on", Date, nullable=False),
+)
+
+
+# Aggregates
+
+# How every stat aggregate combines across chunks of stats
+STAT_AGGREGATES = {
+    'goals': 'sum',
+    'assists': 'sum',
+    'minutes': 'sum',
+    'minutes_count': 'sum',
+    'stat_rows': 'sum',
+    'max_goals': 'max',
+}
+
+
+def stat_aggregates(stats):
+    # Per-player stat totals, count and max goals per match, indexed by player_id
+    return stats.groupby('player_id').agg(
+        goals=('goals', 'sum'),
+        assists=('assists', 'sum'),
+        minutes=('mins_played', 'sum'),
+        minutes_count=('mins_played', 'count'),
+        stat_rows=('goals', 'size'),
+        max_goals=('goals', 'max'),
+    )
+
+
+def combine_stat_aggregates(parts):
+    # Stat aggregates of the union of the stats the parts were computed from
+    return pd.concat(parts).groupby(level='player_id').agg(STAT_AGGREGATES)
+
+
+def player_aggregates(stats, teams, transfers):
+    # Running per-player aggregates: stat totals, count and max goals per
+    # match, and the transfers to French/Italian teams
+    return add_transfer_aggregates(stat_aggregates(stats), teams, transfers)
+
+
+def add_transfer_aggregates(aggregates, teams, transfers):
+    stat_dtypes = aggregates.dtypes
+
+    for country, _, _, count_column, join_column in COUNTRY_COLUMNS:
+        country_team_ids = teams.loc[teams['country'] == country, 'team_id']
+        country_transfers = transfers[transfers['to_team_id'].isin(country_team_ids)].groupby('player_id')
+        aggregates = aggregates.join(
+            pd.DataFrame({
+                count_column: country_transfers.size(),
+                join_column: country_transfers['trans_date'].min(),
+            }),
+            how='outer',
+        )
+
+    # players with transfers but no stats
+    for column, dtype in stat_dtypes.items():
+        aggregates[column] = aggregates[column].fillna(0).astype(dtype)
+    for _, _, _, count_column, join_column in COUNTRY_COLUMNS:
+        aggregates[count_column] = aggregates[count_column].fillna(0).astype(int)
+        # keeps a date column type even when no player has such a transfer
+        aggregates[join_column] = aggregates[join_column].astype(transfers['trans_date'].dtype)
+
+    return aggregates.rename_axis('player_id').reset_index()
+
+
+# View stages
+
+def stat_totals(aggregates):
+    # One row per player with stats
+    with_stats = aggregates[aggregates['stat_rows'] > 0]
+    minutes = with_stats['minutes']
+    totals = pd.DataFrame({
+        'player_id': with_stats['player_id'],
+        'TotalGoals': with_stats['goals'],
+        'TotalAssists': with_stats['assists'],
+        'TotalMinutesPlayed': minutes,
+        'AverageMinutesPlayed': minutes / with_stats['minutes_count'],
+        'PlayedOver300Min': (minutes > 300).astype(int),
+        'Scored3PlusGoalsInMatch': (with_stats['max_goals'] >= 3).astype(int),
+        'EstimatedMatchesPlayed': (minutes // 90).astype(str) + ' match ' + (minutes % 90).astype(str) + ' mins',
+    })
+    return totals.reset_index(drop=True)
+
+
+def players_without_stats(players, totals):
+    no_stats_view = pd.DataFrame({'player_id': players.loc[~players['player_id'].isin(totals['player_id']), 'player_id']})
+    no_stats_view['TotalGoals'] = 0
+    no_stats_view['TotalAssists'] = 0
+    no_stats_view['TotalMinutesPlayed'] = 0
+    no_stats_view['AverageMinutesPlayed'] = 0
+    no_stats_view['PlayedOver300Min'] = 0
+    no_stats_view['Scored3PlusGoalsInMatch'] = 0
+    no_stats_view['EstimatedMatchesPlayed'] = 0
+    return no_stats_view
+
+
+def age_flags(players, now=None):
+    # 1 for players aged 25 to 30, indexed by player_id
+    now = now or datetime.now()
+    age_in_years = (now - players['birthdate']).dt.days / 365
+    flags = ((age_in_years >= 25) & (age_in_years <= 30)).astype(int)
+    return pd.Series(flags.to_numpy(), index=players['player_id'].to_numpy())
+
+
+def country_flags(view, aggregates, players, teams):
+    # PlayedIn<Country>: transferred to a team of that country or playing for one now
+    # DateJoined<Country>Team: earliest transfer to a team of that country
+    for country, played_column, joined_column, count_column, join_column in COUNTRY_COLUMNS:
+        country_team_ids = teams.loc[teams['country'] == country, 'team_id']
+        transferred = aggregates.loc[aggregates[count_column] > 0]
+        current_players = players.loc[players['team_id'].isin(country_team_ids), 'player_id']
+
+        view[played_column] = (
+            view['player_id'].isin(transferred['player_id']) | view['player_id'].isin(current_players)
+        ).astype(int)
+        # one aggregate row per player; map() cannot take an empty date mapper
+        view[joined_column] = transferred.set_index('player_id')[join_column].reindex(view['player_id']).to_numpy()
+    return view
+
+
+def attach_names(view, players, teams):
+    view = view.merge(players[['player_id', 'player_name', 'team_id']], on='player_id', how='left')
+    return view.merge(teams[['team_id', 'team_name']], on='team_id', how='left')
+
+
+def view_from_aggregates(aggregates, players, teams, now=None):
+    totals = stat_totals(aggregates)
+    view = pd.concat([totals, players_without_stats(players, totals)], ignore_index=True)
+    # text also when no player has stats, so the table created from it takes the refreshed rows
+    view['EstimatedMatchesPlayed'] = view['EstimatedMatchesPlayed'].astype(str)
+    view['AgeBetween25And30'] = view['player_id'].map(age_flags(players, now)).fillna(0).astype(int)
+    view = country_flags(view, aggregates, players, teams)
+    return attach_names(view, players, teams)[FINAL_VIEW_COLUMNS]
+
+
+def build_final_view(stats, players, teams, transfers, now=None):
+    return view_from_aggregates(player_aggregates(stats, teams, transfers), players, teams, now)
+
+
+# Materialization
+
+def last_rebuild(engine):
+    # Day of the last full rebuild, None before the first one
+    if not inspect(engine).has_table(REBUILD_TABLE):
+        return None
+    with engine.connect() as connection:
+        return connection.execute(select(final_view_rebuild.c.rebuilt_on)).scalar()
+
+
+def needs_rebuild(engine):
+    # Full rebuild on the first run of the day, or when the aggregates are missing
+    return last_rebuild(engine) != date.today() or not inspect(engine).has_table(AGGREGATES_TABLE)
+
+
+def record_rebuild(connection, day):
+    final_view_rebuild.create(connection, checkfirst=True)
+    connection.execute(delete(final_view_rebuild))
+    connection.execute(insert(final_view_rebuild).values(rebuilt_on=day))
+
+
+def rebuild_final_view(writer, stats, players, teams, transfers, now=None):
+    return materialize_final_view(writer, player_aggregates(stats, teams, transfers), players, teams, now)
+
+
+def materialize_final_view(writer, aggregates, players, teams, now=None):
+    # Replace both tables with the view of the given player aggregates, and
+    # record the rebuild, in one transaction
+    final_view = view_from_aggregates(aggregates, players, teams, now)
+    with writer.engine.begin() as connection:
+        writer.write(aggregates, AGGREGATES_TABLE, if_exists='replace', connection=connection)
+        writer.write(final_view, 'final_view', if_exists='replace', connection=connection)
+        record_rebuild(connection, date.today())
+    return final_view
+
+
+def select_player_ids(engine, table_name, column, values):
+    return fetch_rows(engine, table_name, values, column=column, columns="player_id")['player_id']
+
+
+def old_rows(engine, changes):
+    # Stored version of the updated and deleted players, matches, stats and
+    # transfers, by table. Must be read before the changes are applied.
+    rows = {}
+    for table_name in ("players", "matches", "player_stats", "transfer_history"):
+        table_changes = changes[table_name]
+        old_keys = table_changes.updates[table_changes.key].tolist() + list(table_changes.deletes)
+        rows[table_name] = apply_schema(fetch_rows(engine, table_name, old_keys), table_name)
+    return rows
+
+
+def stat_changes(changes, old_stats, apply_deletes):
+    # (removed, added) stats of a player_stats change set: the old version
+    # of the updated stats (and of the deleted ones, if the deletes are
+    # applied) and the upserted stats, with integer columns where they hold
+    # no missing values (the CSV frame may not have them)
+    removed = old_stats
+    if not apply_deletes:
+        removed = old_stats[old_stats[changes.key].isin(changes.updates[changes.key])]
+    return removed, apply_schema(changes.upserts, "player_stats")
+
+
+def touched_players(engine, changes, old):
+    # Players whose final_view row can change with the given change sets,
+    # given the old rows of the stats and transfers (see old_rows)
+    player_changes = changes["players"]
+    touched = [
+        player_changes.upserts['player_id'],
+        pd.Series(player_changes.deletes, dtype='int64'),
+    ]
+
+    # new and old owner of every changed stat and transfer
+    for table_name in ("player_stats", "transfer_history"):
+        table_changes = changes[table_name]
+        touched.append(table_changes.upserts['player_id'])
+        touched.append(old[table_name]['player_id'])
+
+    # players and transfers of teams whose name or country may have changed
+    team_changes = changes["teams"]
+    team_ids = team_changes.upserts['team_id'].tolist() + list(team_changes.deletes)
+    if team_ids:
+        touched.append(select_player_ids(engine, "players", "team_id", team_ids))
+        touched.append(select_player_ids(engine, "transfer_history", "to_team_id", team_ids))
+        touched.append(player_changes.upserts.loc[player_changes.upserts['team_id'].isin(team_ids), 'player_id'])
+
+    return pd.Index(pd.concat(touched, ignore_index=True).dropna().astype('int64').unique())
+
+
+def stored_stat_aggregates(engine, player_ids):
+    # Stat aggregates of final_view_aggregates for the given players with stats
+    query = text(
+        f"SELECT player_id, {', '.join(STAT_AGGREGATES)} FROM {AGGREGATES_TABLE} "
+        "WHERE stat_rows > 0 AND player_id IN :player_ids"
+    ).bindparams(bindparam("player_ids", expanding=True))
+    stored = pd.concat(
+        [pd.read_sql(query, engine, params={"player_ids": batch}) for batch in key_batches(player_ids)]
+        or [pd.DataFrame(columns=['player_id', *STAT_AGGREGATES])],
+        ignore_index=True,
+    )
+    return stored.set_index('player_id')
+
+
+def stored_stats(engine, player_ids):
+    stats = fetch_rows(engine, "player_stats", player_ids, column="player_id",
+                       columns="player_id, goals, assists, mins_played")
+    return apply_schema(stats, "player_stats")
+
+
+def folded_stat_aggregates(engine, touched, removed, added):
+    # Stat aggregates of the touched players after the changes: the stored
+    # aggregates, less the removed stats, plus the added ones. The players
+    # who lost the stat of their max goals are aggregated again from the
+    # stored stats.
+    stored = stored_stat_aggregates(engine, touched)
+    removed = stat_aggregates(removed)
+    added = stat_aggregates(added)
+    parts = [part for part in (stored, removed, added) if len(part)]
+    if not parts:
+        return stat_aggregates(added)
+
+    sums = [column for column, how in STAT_AGGREGATES.items() if how == 'sum']
+    aggregates = stored[sums].sub(removed[sums], fill_value=0).add(added[sums], fill_value=0)
+    aggregates['max_goals'] = pd.concat([stored['max_goals'], added['max_goals']]).groupby(level=0).max()
+    lost_max = removed.index[removed['max_goals'].to_numpy() >= stored['max_goals'].reindex(removed.index).to_numpy()]
+    if len(lost_max):
+        aggregates = pd.concat([aggregates.drop(index=lost_max, errors='ignore'),
+                                stat_aggregates(stored_stats(engine, lost_max))])
+    aggregates = aggregates[aggregates['stat_rows'] > 0]
+
+    # integer totals stay integers, as they are when aggregated in one go
+    # (the minutes feed EstimatedMatchesPlayed as text)
+    for column in STAT_AGGREGATES:
+        integers = all(part[column].dtype.kind in "iu" for part in parts)
+        aggregates[column] = aggregates[column].astype('int64' if integers else 'float64')
+    return aggregates.rename_axis('player_id')
+
+
+def refresh_final_view(writer, touched, stat_changes, players, teams, transfers, now=None):
+    # Fold the (removed, added) stats of stat_changes into the aggregates of
+    # the touched players, recompute their view rows and replace both by key
+    # in one transaction
+    if len(touched) == 0:
+        return None
+
+    removed, added = stat_changes
+    aggregates = add_transfer_aggregates(
+        folded_stat_aggregates(writer.engine, touched, removed, added),
+        teams,
+        transfers[transfers['player_id'].isin(touched)],
+    )
+    final_view = view_from_aggregates(aggregates, players[players['player_id'].isin(touched)], teams, now)
+
+    with writer.engine.begin() as connection:
+        for table_name in (AGGREGATES_TABLE, 'final_view'):
+            delete_keys(connection, table_name, touched, 'player_id')
+        writer.write(aggregates, AGGREGATES_TABLE, connection=connection)
+        writer.write(final_view, 'final_view', connection=connection)
+    return final_view
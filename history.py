@@ -0,0 +1,160 @@
+# Type-2 history of the raw league tables
+#
+# Every raw table has a <table>_versions table with each version of its rows
+# and the period it was current: valid_from, and valid_to (NULL for the
+# current version). After every sync the raw rows are hashed and
+# hash-joined with the hashes of the current versions, so only the rows
+# that really changed are written: a new version for inserted and updated
+# rows, a closed period for updated and deleted ones. The hashes are taken
+# over normalized values (numbers as float64, everything else as text), so
+# the same row read with other dtypes (CSV against database, one chunk
+# against another) hashes the same. A table can be given in chunks, each
+# applied in its own transaction; the current versions are read back from
+# the versions table, so an interrupted run is completed by the next one.
+
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_datetime64_any_dtype, is_numeric_dtype, is_string_dtype
+from sqlalchemy import bindparam, inspect, text
+
+from incremental_sync import TABLE_KEYS, key_batches
+
+
+HASH_COLUMN = "row_hash"
+VALID_FROM = "valid_from"
+VALID_TO = "valid_to"
+
+# keys per UPDATE closing the current versions
+CLOSE_BATCH_ROWS = 10_000
+
+
+def history_table(table_name):
+    # not <table>_history: players_history is the log of player_history_from_*
+    return f"{table_name}_versions"
+
+
+# Hashes
+
+def normalized(values):
+    if is_bool_dtype(values) or is_numeric_dtype(values):
+        return values.astype("float64")
+    if isinstance(values.dtype, pd.CategoricalDtype) and is_string_dtype(values.dtype.categories):
+        # text categories hash like their text
+        return values
+    if is_datetime64_any_dtype(values):
+        present = values.dropna()
+        # dates read as timestamps hash like ISO date strings
+        date_only = (present == present.dt.normalize()).all()
+        return values.dt.strftime("%Y-%m-%d" if date_only else "%Y-%m-%d %H:%M:%S")
+    return values.astype(str).where(values.notna(), None)
+
+
+def content_hashes(df, key):
+    # 64-bit hash of the normalized content of every row, indexed by the row key
+    columns = sorted(df.columns)
+    hashes = pd.util.hash_pandas_object(
+        pd.DataFrame({column: normalized(df[column]) for column in columns}, index=df.index),
+        index=False,
+    )
+    return pd.Series(hashes.to_numpy().view("int64"), index=df[key].to_numpy())
+
+
+def changed_rows(hashes, current):
+    # (new, changed) boolean masks of the rows of hashes against the current
+    # hashes, both indexed by key
+    known = hashes.index.isin(current.index)
+    changed = known.copy()
+    changed[known] = current.reindex(hashes.index[known]).to_numpy() != hashes.to_numpy()[known]
+    return ~known, changed
+
+
+# History tables
+
+def ensure_history_table(connection, table_name):
+    # Same columns and types as the raw table, plus the hash and the period
+    name = history_table(table_name)
+    if inspect(connection).has_table(name):
+        return
+    connection.execute(text(f"CREATE TABLE {name} AS SELECT * FROM {table_name} WHERE 1 = 0"))
+    for column, column_type in ((HASH_COLUMN, "BIGINT"), (VALID_FROM, "TIMESTAMP"), (VALID_TO, "TIMESTAMP")):
+        connection.execute(text(f"ALTER TABLE {name} ADD COLUMN {column} {column_type}"))
+    connection.execute(text(f"CREATE INDEX ix_{name}_{TABLE_KEYS[table_name]} ON {name} ({TABLE_KEYS[table_name]})"))
+
+
+def current_hashes(connection, table_name, keys=None):
+    # Hashes of the current versions, of the given keys only if keys is not None
+    key = TABLE_KEYS[table_name]
+    query = f"SELECT {key}, {HASH_COLUMN} FROM {history_table(table_name)} WHERE {VALID_TO} IS NULL"
+    if keys is None:
+        current = pd.read_sql(text(query), connection)
+    else:
+        statement = text(f"{query} AND {key} IN :keys").bindparams(bindparam("keys", expanding=True))
+        parts = [pd.read_sql(statement, connection, params={"keys": batch}) for batch in key_batches(keys)]
+        current = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame({key: [], HASH_COLUMN: []})
+    return pd.Series(current[HASH_COLUMN].to_numpy(dtype="int64"), index=current[key].to_numpy())
+
+
+class TableHistory:
+    # Brings the history of one raw table up to date with its content at
+    # now, given whole or in chunks: observe() every chunk, then finish().
+    # Given keys, only the history of those keys is brought up to date: the
+    # other rows are known not to have changed, and finish() only closes the
+    # keys no chunk held among them.
+
+    def __init__(self, engine, writer, table_name, now, keys=None):
+        self.engine = engine
+        self.writer = writer
+        self.table_name = table_name
+        self.key = TABLE_KEYS[table_name]
+        self.now = now
+        with engine.begin() as connection:
+            ensure_history_table(connection, table_name)
+            self.current = current_hashes(connection, table_name, keys)
+        self.seen = []
+        self.inserted = 0
+        self.updated = 0
+        self.deleted = 0
+
+    def observe(self, df):
+        # Writes the new versions of the rows of df and closes the versions they replace
+        df = df.drop_duplicates(subset=self.key, keep="last")
+        hashes = content_hashes(df, self.key)
+        self.seen.append(hashes.index)
+        new, changed = changed_rows(hashes, self.current)
+
+        versions = df[new | changed].copy()
+        versions[HASH_COLUMN] = hashes.to_numpy()[new | changed]
+        versions[VALID_FROM] = pd.Timestamp(self.now)
+        versions[VALID_TO] = pd.Series(pd.NaT, index=versions.index, dtype="datetime64[us]")
+
+        with self.engine.begin() as connection:
+            self.close(connection, hashes.index[changed])
+            self.writer.write(versions, history_table(self.table_name), connection=connection)
+        self.inserted += int(new.sum())
+        self.updated += int(changed.sum())
+        return versions
+
+    def finish(self):
+        # Closes the current versions of the rows no chunk held
+        seen = self.seen[0].append(self.seen[1:]) if self.seen else pd.Index([])
+        deleted = self.current.index.difference(seen)
+        with self.engine.begin() as connection:
+            self.close(connection, deleted)
+        self.deleted = len(deleted)
+        return {"inserted": self.inserted, "updated": self.updated, "deleted": self.deleted}
+
+    def close(self, connection, keys):
+        statement = text(
+            f"UPDATE {history_table(self.table_name)} SET {VALID_TO} = :now "
+            f"WHERE {self.key} IN :keys AND {VALID_TO} IS NULL"
+        ).bindparams(bindparam("keys", expanding=True))
+        for offset in range(0, len(keys), CLOSE_BATCH_ROWS):
+            batch = [int(key) for key in keys[offset:offset + CLOSE_BATCH_ROWS]]
+            connection.execute(statement, {"now": self.now, "keys": batch})
+
+
+def track_history(engine, writer, table_name, df, now, keys=None):
+    # History of a table held whole, or of the given keys held by df
+    history = TableHistory(engine, writer, table_name, now, keys)
+    versions = history.observe(df)
+    history.finish()
+    return versions
@@ -0,0 +1,198 @@
+# Incremental change-data-capture sync for the raw league tables
+#
+# Every CSV row is hashed by its key and compared with the hashes persisted
+# for that table at the last sync, so each cycle only touches the rows that
+# were inserted, updated or deleted since then.
+
+import threading
+from dataclasses import dataclass, field
+
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_datetime64_any_dtype, is_numeric_dtype
+from sqlalchemy import BigInteger, Column, MetaData, String, Table, bindparam, text
+
+
+# Key column of every raw table
+TABLE_KEYS = {
+    "teams": "team_id",
+    "players": "player_id",
+    "matches": "match_id",
+    "player_stats": "stat_id",
+    "transfer_history": "trans_id",
+}
+
+# Parents before children, so upserts never break the FK constraints.
+# Deletes are applied in the reverse order.
+SYNC_ORDER = ["teams", "players", "matches", "player_stats", "transfer_history"]
+
+# Tables every table references
+TABLE_PARENTS = {
+    "teams": [],
+    "players": ["teams"],
+    "matches": ["teams"],
+    "player_stats": ["players", "matches"],
+    "transfer_history": ["players", "teams"],
+}
+
+STATE_TABLE = "sync_state"
+
+# keys per statement of the IN lists below
+KEY_BATCH_ROWS = 10_000
+
+state_metadata = MetaData()
+sync_state = Table(
+    STATE_TABLE,
+    state_metadata,
+    Column("table_name", String(64), primary_key=True),
+    Column("row_key", BigInteger, primary_key=True),
+    Column("row_hash", BigInteger, nullable=False),
+)
+
+
+@dataclass
+class ChangeSet:
+    table_name: str
+    key: str
+    inserts: pd.DataFrame
+    updates: pd.DataFrame
+    deletes: pd.Index
+    # hash of every row that is upserted, indexed by key
+    hashes: pd.Series = field(repr=False)
+
+    @property
+    def upserts(self):
+        return pd.concat([self.inserts, self.updates], ignore_index=True)
+
+    def __len__(self):
+        return len(self.inserts) + len(self.updates) + len(self.deletes)
+
+    def drop_keys(self, keys):
+        # Remove rows (e.g. FK violations) so they are neither applied nor
+        # recorded in the state, and get checked again next cycle
+        self.inserts = self.inserts[~self.inserts[self.key].isin(keys)]
+        self.updates = self.updates[~self.updates[self.key].isin(keys)]
+        self.hashes = self.hashes[~self.hashes.index.isin(keys)]
+
+
+def hashed_values(values):
+    # One dtype per kind of column, so a row hashes the same whatever dtype
+    # its column was read with: an integer column turns float as soon as one
+    # value is missing, and dates may come at any resolution. Text and text
+    # categories already hash alike. Cheaper than history.normalized, which
+    # has to match the text the database returns.
+    if is_bool_dtype(values) or is_numeric_dtype(values):
+        return values.astype("float64")
+    if is_datetime64_any_dtype(values):
+        return values.astype("datetime64[s]")
+    return values
+
+
+def row_hashes(df, key):
+    # 64-bit content hash of every row, indexed by the row key
+    columns = sorted(df.columns)
+    hashes = pd.util.hash_pandas_object(
+        pd.DataFrame({column: hashed_values(df[column]) for column in columns}, index=df.index),
+        index=False,
+    )
+    # stored in a signed BIGINT column
+    return pd.Series(hashes.to_numpy().view("int64"), index=df[key].to_numpy())
+
+
+# the state table is created on first use, by one stage thread at a time
+state_table_lock = threading.Lock()
+
+
+def load_state(engine, table_name):
+    with state_table_lock:
+        state_metadata.create_all(engine, checkfirst=True)
+    query = text(f"SELECT row_key, row_hash FROM {STATE_TABLE} WHERE table_name = :table_name")
+    with engine.connect() as connection:
+        state = pd.read_sql(query, connection, params={"table_name": table_name})
+    return pd.Series(state["row_hash"].to_numpy(dtype="int64"), index=state["row_key"].to_numpy())
+
+
+def diff_table(table_name, df, state):
+    key = TABLE_KEYS[table_name]
+
+    # Same rule as the full sync: the last occurrence of a key wins
+    df = df.drop_duplicates(subset=key, keep="last")
+    hashes = row_hashes(df, key)
+
+    known = hashes.index.isin(state.index)
+    changed = known.copy()
+    changed[known] = state.reindex(hashes.index[known]).to_numpy() != hashes.to_numpy()[known]
+
+    inserts = df[~known]
+    updates = df[changed]
+    deletes = state.index.difference(hashes.index)
+
+    return ChangeSet(
+        table_name=table_name,
+        key=key,
+        inserts=inserts,
+        updates=updates,
+        deletes=deletes,
+        hashes=hashes[~known | changed],
+    )
+
+
+def key_batches(keys):
+    # The keys as ints, in lists of at most KEY_BATCH_ROWS
+    keys = [int(k) for k in keys]
+    for offset in range(0, len(keys), KEY_BATCH_ROWS):
+        yield keys[offset:offset + KEY_BATCH_ROWS]
+
+
+def fetch_rows(engine, table_name, keys, column=None, columns="*"):
+    # Read only the rows whose column (the key of the table by default) is
+    # in keys, e.g. the old version of updated rows
+    column = column or TABLE_KEYS[table_name]
+    query = text(f"SELECT {columns} FROM {table_name} WHERE {column} IN :keys").bindparams(
+        bindparam("keys", expanding=True)
+    )
+    parts = [pd.read_sql(query, engine, params={"keys": batch}) for batch in key_batches(keys)]
+    if not parts:
+        return pd.read_sql(text(f"SELECT {columns} FROM {table_name} WHERE 1 = 0"), engine)
+    return pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+
+
+def delete_keys(connection, table_name, keys, key=None):
+    # key defaults to the key of the raw table
+    key = key or TABLE_KEYS[table_name]
+    statement = text(f"DELETE FROM {table_name} WHERE {key} IN :keys").bindparams(
+        bindparam("keys", expanding=True)
+    )
+    for batch in key_batches(keys):
+        connection.execute(statement, {"keys": batch})
+
+
+def save_state(writer, connection, changes):
+    statement = text(
+        f"DELETE FROM {STATE_TABLE} WHERE table_name = :table_name AND row_key IN :keys"
+    ).bindparams(bindparam("keys", expanding=True))
+    for batch in key_batches(changes.hashes.index.union(changes.deletes)):
+        connection.execute(statement, {"table_name": changes.table_name, "keys": batch})
+    if len(changes.hashes):
+        state = pd.DataFrame({
+            "table_name": changes.table_name,
+            "row_key": changes.hashes.index,
+            "row_hash": changes.hashes.to_numpy(),
+        })
+        writer.write(state, STATE_TABLE, connection=connection)
+
+
+def apply_changes(writer, changes, apply_deletes=False):
+    # Apply all change sets and their new state in a single transaction.
+    # Rows removed from the CSVs are only dropped from the state (they are
+    # still reported, e.g. in players_history) unless apply_deletes is set,
+    # which matches the full sync where old rows are kept in the raw tables.
+    with writer.engine.begin() as connection:
+        if apply_deletes:
+            for table_name in reversed(SYNC_ORDER):
+                if table_name in changes:
+                    delete_keys(connection, table_name, changes[table_name].deletes)
+        for table_name in SYNC_ORDER:
+            if table_name in changes:
+                table_changes = changes[table_name]
+                writer.upsert(connection, table_changes.upserts, table_name, table_changes.key)
+                save_state(writer, connection, table_changes)
@@ -0,0 +1,187 @@
+# Per-stage instrumentation of the pipeline
+#
+# Every stage of a run records its wall time, CPU time (of the thread that
+# ran it, stages may run concurrently), the peak RSS of the process, the
+# memory of the DataFrames it produced and its rows in and out. A whole
+# run can also be profiled with cProfile or pyinstrument. The metrics of a
+# run are written to a JSON report and appended to the
+# pipeline_stage_metrics table.
+
+import cProfile
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime
+
+import pandas as pd
+
+try:
+    import resource
+    # only needed without resource, and slow to import
+    psutil = None
+except ImportError:  # Windows
+    resource = None
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+
+
+METRICS_TABLE = "pipeline_stage_metrics"
+
+PROFILERS = ("cprofile", "pyinstrument")
+
+
+@dataclass
+class StageMetrics:
+    stage: str
+    wall_seconds: float
+    cpu_seconds: float
+    # high-water mark of the process after the stage, and how much the stage raised it
+    peak_rss_mb: float
+    rss_growth_mb: float
+    # memory of the DataFrames produced by the stage
+    frame_memory_mb: float
+    rows_in: int
+    rows_out: int
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process, None when it cannot be measured
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / (1024 * 1024), 1)
+    return None
+
+
+def frame_rows(frames):
+    return sum(len(df) for df in frames)
+
+
+def frame_memory_mb(frames, deep=True):
+    return round(sum(int(df.memory_usage(index=True, deep=deep).sum()) for df in frames) / (1024 * 1024), 3)
+
+
+class Instrumentation:
+
+    def __init__(self, profiler=None, profile_dir=None, deep_memory=True):
+        if profiler is not None and profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler {profiler!r}, expected one of {PROFILERS}")
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+        # deep memory counts the strings of object columns, at the cost of a pass over them
+        self.deep_memory = deep_memory
+        self.started_at = datetime.now()
+        self.metrics = []
+        # row counts of the tables produced by the run
+        self.rows = {}
+        self.profile_path = None
+        # perf_counter() at the start of the first stage and the end of the last one
+        self.first_start = None
+        self.last_end = None
+
+    @property
+    def wall_seconds(self):
+        # elapsed time of the stages, shorter than their sum when they overlapped
+        if self.first_start is None:
+            return 0.0
+        return round(self.last_end - self.first_start, 3)
+
+    @property
+    def stages(self):
+        # {"stage name": wall seconds}
+        return {metrics.stage: metrics.wall_seconds for metrics in self.metrics}
+
+    def run_stage(self, name, stage, *args):
+        # Runs stage(*args), which returns (input frames, output frames)
+        peak_before = peak_rss_mb()
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+
+        inputs, outputs = stage(*args)
+
+        cpu_seconds = time.thread_time() - cpu_start
+        wall_end = time.perf_counter()
+        wall_seconds = wall_end - wall_start
+        peak_after = peak_rss_mb()
+        if self.first_start is None or wall_start < self.first_start:
+            self.first_start = wall_start
+        if self.last_end is None or wall_end > self.last_end:
+            self.last_end = wall_end
+
+        inputs, outputs = list(inputs), list(outputs)
+        self.metrics.append(StageMetrics(
+            stage=name,
+            wall_seconds=round(wall_seconds, 3),
+            cpu_seconds=round(cpu_seconds, 3),
+            peak_rss_mb=peak_after,
+            rss_growth_mb=round(peak_after - peak_before, 1) if peak_after is not None else None,
+            frame_memory_mb=frame_memory_mb(outputs, self.deep_memory),
+            rows_in=frame_rows(inputs),
+            rows_out=frame_rows(outputs),
+        ))
+
+    @contextmanager
+    def profiling(self):
+        # Profiles the enclosed block when a profiler is configured, and dumps
+        # the profile to <profile_dir>/run_<timestamp>.prof (or .html)
+        if self.profiler is None:
+            yield
+            return
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        stem = os.path.join(self.profile_dir, f"run_{self.started_at:%Y%m%d_%H%M%S}")
+
+        if self.profiler == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                self.profile_path = stem + ".prof"
+                profile.dump_stats(self.profile_path)
+        else:
+            from pyinstrument import Profiler
+
+            profile = Profiler()
+            profile.start()
+            try:
+                yield
+            finally:
+                profile.stop()
+                self.profile_path = stem + ".html"
+                with open(self.profile_path, "w") as profile_file:
+                    profile_file.write(profile.output_html())
+
+    # Output
+
+    def frame(self):
+        metrics = pd.DataFrame([asdict(metrics) for metrics in self.metrics], columns=list(StageMetrics.__annotations__))
+        metrics.insert(0, "run_started", self.started_at)
+        return metrics
+
+    def report(self):
+        return {
+            "run_started": self.started_at.isoformat(timespec="seconds"),
+            "wall_seconds": self.wall_seconds,
+            "cpu_seconds": round(sum(metrics.cpu_seconds for metrics in self.metrics), 3),
+            "peak_rss_mb": peak_rss_mb(),
+            "profile": self.profile_path,
+            "rows": self.rows,
+            "stages": [asdict(metrics) for metrics in self.metrics],
+        }
+
+    def write_report(self, path):
+        with open(path, "w") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+    def write_table(self, writer):
+        writer.write(self.frame(), METRICS_TABLE, if_exists="append")
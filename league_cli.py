@@ -0,0 +1,85 @@
+# Command line of the cleaning pipeline
+#
+#   python league_cli.py run      one run now (status 1 when it failed or was skipped)
+#   python league_cli.py serve    runs on a schedule, whenever the CSVs changed
+#
+# Settings come from --config, the LEAGUE_* environment variables and the
+# options below, in increasing priority (see pipeline_config.py). Only the
+# standard library is imported until the arguments are parsed; the backend
+# (pandas, or Spark with --backend spark) is then imported once, and its
+# engine, connection pool and Spark session are reused by every run of the
+# process. Both commands go through the scheduler, so a run is recorded in
+# pipeline_runs and never overlaps a run of another host. The startup time,
+# from the start of the command until the backend is ready, is printed.
+
+import argparse
+import sys
+import time
+
+from pipeline_config import load_config, shared_engine
+
+
+STARTED = time.perf_counter()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Clean the football league data")
+    parser.add_argument("command", choices=["run", "serve"], help="run once, or serve on a schedule")
+    parser.add_argument("--config", help="JSON settings file (default: $LEAGUE_CONFIG)")
+    parser.add_argument("--backend", "--engine", dest="backend", choices=["pandas", "spark"],
+                        help="run the stages in pandas or in Spark (local[*] mode)")
+    parser.add_argument("--sync-mode", choices=["incremental", "full", "streaming"])
+    parser.add_argument("--database-url")
+    parser.add_argument("--data-dir", help="directory of the CSVs, logs and staging files")
+    parser.add_argument("--interval", type=int, dest="interval_seconds", help="seconds between the checks of serve")
+    return parser
+
+
+def load_backend(config):
+    # process_data_task of the configured backend; pyspark is only needed,
+    # and imported, by the Spark backend
+    if config.backend == "spark":
+        from spark_backend import process_data_task
+    else:
+        from league_pipeline import process_data_task
+    return process_data_task
+
+
+def pipeline_scheduler(config):
+    # Scheduler running the configured backend on the shared engine
+    from scheduler import PipelineScheduler
+
+    process_data_task = load_backend(config)
+    return PipelineScheduler(
+        lambda: process_data_task(config),
+        shared_engine(config.database_url),
+        config.csv_paths().values(),
+        interval_seconds=config.interval_seconds,
+    )
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    config = load_config(
+        args.config,
+        backend=args.backend,
+        sync_mode=args.sync_mode,
+        database_url=args.database_url,
+        data_dir=args.data_dir,
+        interval_seconds=args.interval_seconds,
+    )
+
+    scheduler = pipeline_scheduler(config)
+    print(f"Started the {config.backend} backend in {time.perf_counter() - STARTED:.2f} s")
+
+    if args.command == "serve":
+        # Run every interval, but only when the CSVs changed, never two runs
+        # at once (also across hosts) and with a backoff after failures
+        scheduler.serve()
+    outcome = scheduler.run_once(force=True)
+    print(f"Run {outcome}")
+    return 0 if outcome == "success" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,843 @@
+# Football league cleaning pipeline
+#
+# process_data_task runs the named stages below as a dependency graph (see
+# stage_graph.py): the stages of independent tables run concurrently, each
+# under the instrumentation (wall/CPU time, memory, rows in and out). The
+# stages share one PipelineRun and return the frames they consumed and
+# produced. Per-table stages are named "<stage>:<table>". The incremental
+# mode runs two graphs, the sync and then the cleaning of the rows it
+# changed, so a sync that changed nothing ends the run. Paths, database and
+# options come from a PipelineConfig (see pipeline_config.py).
+
+# imports
+import numpy as np
+import pandas as pd
+from sqlalchemy import inspect, text
+from datetime import datetime
+import logging
+import os
+
+from bulk_loader import make_writer
+from cleaning_log import CleaningLog
+from final_view import (
+    AGGREGATES_TABLE, add_transfer_aggregates, materialize_final_view, needs_rebuild, old_rows, rebuild_final_view,
+    refresh_final_view, stat_changes, touched_players,
+)
+from history import TableHistory, content_hashes, track_history
+from incremental_sync import (
+    SYNC_ORDER, TABLE_KEYS, TABLE_PARENTS, apply_changes, delete_keys, diff_table, fetch_rows, load_state,
+)
+from instrumentation import Instrumentation
+from league_reports import bump_run_generation
+from league_schema import COLUMN_NAMES, apply_schema
+from parquet_staging import read_staged, read_typed_csv, stage_csvs, staging_available
+from pipeline_config import load_config, shared_engine
+from quality_rules import apply_fixes, check
+from stage_graph import Task, run_graph, table_tasks
+from stats_stream import StatsStream
+from summary_tables import (
+    player_summary, player_totals, player_totals_of_aggregates, refresh_summary_rows, refresh_summary_tables,
+    summary_tables_current, team_results, team_summary,
+)
+
+
+# Threads running the stages of a run (and pooled connections) when the
+# config sets none: up to one per table, but no more than the cores, as the
+# stages also need CPU for pandas and the driver. 1 runs them one after
+# another, which profiling needs.
+def pipeline_workers(config):
+    if config.profiler:
+        # the profilers only see the calling thread
+        return 1
+    return config.workers or min(len(SYNC_ORDER), os.cpu_count() or 1)
+
+
+class PipelineRun:
+    # State shared by the stages of one run
+
+    def __init__(self, engine, writer, cleaning_log, config):
+        self.engine = engine
+        self.writer = writer
+        self.cleaning_log = cleaning_log
+        # a pipeline_config.PipelineConfig
+        self.config = config
+        # valid_from and valid_to of the history versions this run writes
+        self.started_at = datetime.now()
+        # tables held in memory, and the streamed player_stats in streaming mode
+        self.tables = list(SYNC_ORDER)
+        self.stats_stream = None
+        # typed and renamed sources by table, and the ones converted by this run
+        self.csv = {}
+        self.staged = {}
+        # incremental mode: ChangeSet by table, the players whose final_view
+        # rows change and the (removed, added) stats
+        self.changes = {}
+        self.changed_players = None
+        self.stat_changes = None
+        # incremental mode: keys of the raw rows read back after the sync and
+        # of the rows it deleted, by table, and the teams whose match results
+        # change; unchanged once nothing changed since the last sync
+        self.scope = {}
+        self.removed = {}
+        self.result_teams = None
+        self.unchanged = False
+        # full mode: raw tables before the sync, and their synced content
+        self.existing = {}
+        self.synced = {}
+        # raw tables after the sync (only the rows of the scope in
+        # incremental mode), cleaned in place, and their row counts
+        self.raw = {}
+        self.raw_rows = {}
+        self.final_view = None
+
+
+# Stages
+
+def use_staging(config):
+    # Staging is disabled by an empty staging_dir, or without pyarrow
+    return config.path("staging_dir") is not None and staging_available()
+
+
+def stage_sources(run):
+    # Convert the changed CSVs into the Parquet staging layer, the streamed
+    # player_stats chunk by chunk
+    if use_staging(run.config):
+        csv_paths = run.config.csv_paths()
+        streamed = [] if run.stats_stream is None else ["player_stats"]
+        csv_files = {table_name: csv_paths[table_name] for table_name in run.tables + streamed}
+        run.staged = stage_csvs(csv_files, COLUMN_NAMES, run.config.path("staging_dir"),
+                                streamed=streamed, chunk_rows=run.config.stats_chunk_rows)
+    return [], run.staged.values()
+
+
+def read_source(run, table_name):
+    # Every column: the sources are diffed, merged and compared as whole rows
+    if table_name in run.staged:
+        run.csv[table_name] = run.staged[table_name]
+    elif use_staging(run.config):
+        run.csv[table_name] = read_staged(run.config.path("staging_dir"), table_name)
+    else:
+        run.csv[table_name] = read_typed_csv(
+            run.config.csv_paths()[table_name], table_name, COLUMN_NAMES[table_name])
+    return [], [run.csv[table_name]]
+
+
+def diff_source(run, table_name):
+    # Diff the CSV against the state persisted at the last sync
+    df = run.csv[table_name]
+    run.changes[table_name] = diff_table(table_name, df, load_state(run.engine, table_name))
+    return [df], [run.changes[table_name].upserts]
+
+
+def record_player_history(run, deleted_players, updated_players):
+    # Store the old version of the deleted and updated players in the history table
+    history_players = pd.concat([deleted_players, updated_players], ignore_index=True)
+
+    # Add a column to mark whether the operation is 'Deleted' or 'Updated'
+    history_players['operation'] = np.where(
+        history_players['player_id'].isin(deleted_players['player_id']), 'Deleted', 'Updated')
+
+    # Add a timestamp for when the operation was logged
+    history_players['Time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    run.writer.write(history_players, "players_history", if_exists="append")
+    return history_players
+
+
+def changed_players(old_players, new_players):
+    # Ids of the players in both frames whose content differs. The content
+    # hashes ignore the dtype differences between the CSV and the database,
+    # and the last row of a duplicated player is the one the sync keeps.
+    old_hashes = content_hashes(old_players, 'player_id')
+    new_hashes = content_hashes(new_players.drop_duplicates(subset='player_id', keep='last'), 'player_id')
+    common_indices = old_hashes.index.intersection(new_hashes.index)
+    return common_indices[old_hashes[common_indices].to_numpy() != new_hashes[common_indices].to_numpy()]
+
+
+def player_history_from_changes(run):
+    # Fetch the old version of the deleted and updated players only
+    player_changes = run.changes["players"]
+    # in the dtypes of the full mode, also when nothing is fetched (an empty
+    # frame reads as text, and the first write creates players_history)
+    deleted_players = apply_schema(fetch_rows(run.engine, "players", player_changes.deletes), "players")
+    updated_players = apply_schema(fetch_rows(run.engine, "players", player_changes.updates['player_id']), "players")
+    # the sync state hashes depend on the dtypes of the CSV frames, so a
+    # player is only recorded when its stored content really changed
+    updated_players = updated_players[
+        updated_players['player_id'].isin(changed_players(updated_players, player_changes.updates))]
+    history_players = record_player_history(run, deleted_players, updated_players)
+    return [player_changes.updates], [history_players]
+
+
+def id_index(columns):
+    # Distinct ids of the given columns
+    return pd.Index(pd.concat(columns, ignore_index=True).dropna().astype('int64').unique())
+
+
+def check_foreign_keys_of_changes(run):
+    transfer_changes = run.changes["transfer_history"]
+    stats_changes = run.changes["player_stats"]
+    inputs = [transfer_changes.upserts, stats_changes.upserts]
+
+    # Same reference as the full sync: the players stored before the sync,
+    # less the ones it deletes. Only the referenced players are read.
+    referenced = id_index([transfer_changes.upserts['player_id'], stats_changes.upserts['player_id']])
+    valid_player_ids = pd.Index(fetch_rows(run.engine, "players", referenced, columns="player_id")['player_id'])
+    if run.config.sync_apply_deletes:
+        valid_player_ids = valid_player_ids.difference(run.changes["players"].deletes)
+
+    rule_context = {'valid_player_ids': valid_player_ids}
+
+    # Invalid rows are dropped from the change set, so they are not
+    # recorded in the sync state and get checked again next cycle.
+    # player_stats_errors keeps the card errors of the stats that did not
+    # change (see validate_changes), so the stats are only logged.
+    invalid_rows, _ = check("sync", "transfer_history", transfer_changes.upserts, rule_context)
+    run.writer.write(invalid_rows, 'transfer_history_errors', if_exists='replace')
+    run.cleaning_log.add(invalid_rows, 'trans_id', "Player Transfers")
+    transfer_changes.drop_keys(invalid_rows['trans_id'])
+
+    invalid_player, _ = check("sync", "player_stats", stats_changes.upserts, rule_context)
+    run.cleaning_log.add(invalid_player, 'stat_id', "Player Stats")
+    stats_changes.drop_keys(invalid_player['stat_id'])
+
+    return inputs, [transfer_changes.upserts, stats_changes.upserts]
+
+
+def find_changed_players(run):
+    # Players whose final_view rows must be refreshed, and the stats to fold
+    # into their aggregates, seen before the changes are applied
+    old = old_rows(run.engine, run.changes)
+    run.changed_players = touched_players(run.engine, run.changes, old)
+    run.stat_changes = stat_changes(run.changes["player_stats"], old["player_stats"], run.config.sync_apply_deletes)
+    scope_changes(run, old)
+    return [], [pd.DataFrame({'player_id': run.changed_players}), *run.stat_changes]
+
+
+def scope_changes(run, old):
+    # The raw rows the rest of the run reads back: the upserted rows, and
+    # every team that gained or lost a player (the team size rule counts its
+    # players). The deleted rows are dropped from the cleaned, error and
+    # history tables if the deletes are applied. The teams whose results
+    # change are the changed teams and the old and new sides of the changed
+    # matches.
+    for table_name, changes in run.changes.items():
+        run.scope[table_name] = id_index([changes.upserts[changes.key]])
+        run.removed[table_name] = changes.deletes if run.config.sync_apply_deletes else changes.deletes[:0]
+
+    players = [run.changes["players"].upserts, old["players"]]
+    run.scope["teams"] = run.scope["teams"].union(id_index([df['team_id'] for df in players]))
+
+    matches = [run.changes["matches"].upserts, old["matches"]]
+    run.result_teams = id_index([
+        run.changes["teams"].upserts['team_id'], pd.Series(run.removed["teams"], dtype='int64'),
+        *[df[column] for df in matches for column in ('home_team_id', 'away_team_id')],
+    ])
+
+
+def apply_synced_changes(run):
+    # Upsert the changed rows and the new sync state in one transaction
+    apply_changes(run.writer, run.changes, apply_deletes=run.config.sync_apply_deletes)
+    upserts = [changes.upserts for changes in run.changes.values()]
+    return upserts, upserts
+
+
+def read_existing(run, table_name):
+    # Fetch existing data from the database
+    run.existing[table_name] = apply_schema(pd.read_sql_table(table_name, con=run.engine), table_name)
+    return [], [run.existing[table_name]]
+
+
+def player_history_from_tables(run):
+    existing_players = run.existing["players"]
+    players_df = run.csv["players"]
+
+    # Identify rows that were deleted
+    deleted_players = existing_players.loc[~existing_players['player_id'].isin(players_df['player_id'])]
+
+    # Identify rows that were updated
+    updated_players = existing_players[existing_players['player_id'].isin(changed_players(existing_players, players_df))]
+
+    history_players = record_player_history(run, deleted_players, updated_players)
+    return [run.existing["players"], run.csv["players"]], [history_players]
+
+
+def merge_synced(run, table_name):
+    # If there is an updated row, the updated one is inserted instead of old
+    # If there is a new row, it will be inserted
+    synced = pd.concat(
+        [run.existing[table_name], run.csv[table_name]]
+    ).drop_duplicates(subset=TABLE_KEYS[table_name], keep="last")
+    # categories of different values concatenate to plain text
+    run.synced[table_name] = apply_schema(synced, table_name)
+    return [run.existing[table_name], run.csv[table_name]], [run.synced[table_name]]
+
+
+def check_foreign_keys_of_transfers(run):
+    # get player ids that exist in table players
+    rule_context = {'valid_player_ids': run.existing["players"]['player_id']}
+    inputs = [run.synced["transfer_history"]]
+
+    # Insert Invalid Rows into Error Table and log file, and remove them
+    # from the synced DataFrame
+    invalid_rows, run.synced["transfer_history"] = check(
+        "sync", "transfer_history", run.synced["transfer_history"], rule_context)
+    run.writer.write(invalid_rows, 'transfer_history_errors', if_exists='replace')
+    run.cleaning_log.add(invalid_rows, 'trans_id', "Player Transfers")
+    return inputs, [run.synced["transfer_history"]]
+
+
+def check_foreign_keys_of_tables(run):
+    # get player ids that exist in table players
+    rule_context = {'valid_player_ids': run.existing["players"]['player_id']}
+    # rule_context['valid_match_ids'] = run.existing["matches"]['match_id']
+    inputs = [run.synced["transfer_history"], run.synced["player_stats"]]
+
+    check_foreign_keys_of_transfers(run)
+
+    invalid_player, run.synced["player_stats"] = check(
+        "sync", "player_stats", run.synced["player_stats"], rule_context)
+    run.writer.write(invalid_player, 'player_stats_errors', if_exists='replace')
+    run.cleaning_log.add(invalid_player, 'stat_id', "Player Stats")
+
+    return inputs, [run.synced["transfer_history"], run.synced["player_stats"]]
+
+
+def clear_raw_tables(run):
+    # First delete data from the tables, children first
+    with run.engine.connect() as connection:
+        with connection.begin():
+            for table_name in reversed(SYNC_ORDER):
+                connection.execute(text(f"DELETE FROM {table_name}"))
+    return [], []
+
+
+def reload_raw_table(run, table_name):
+    # Add the data to the database, after the tables it references
+    run.writer.write(run.synced[table_name], table_name, if_exists="append")
+    return [run.synced[table_name]], [run.synced[table_name]]
+
+
+def read_raw_table(run, table_name):
+    # creating dataframes from database to clean
+    run.raw[table_name] = apply_schema(pd.read_sql(f"SELECT * FROM {table_name}", run.engine), table_name)
+    run.raw_rows[table_name] = len(run.raw[table_name])
+    return [], [run.raw[table_name]]
+
+
+def read_raw_changes(run, table_name):
+    # Incremental mode: read back the raw rows of the scope only
+    run.raw[table_name] = apply_schema(fetch_rows(run.engine, table_name, run.scope[table_name]), table_name)
+    return [], [run.raw[table_name]]
+
+
+def count_raw_rows(run):
+    # Incremental mode: row count of every raw table, for the record
+    # comparison and the cleaned tables
+    with run.engine.connect() as connection:
+        for table_name in run.tables:
+            run.raw_rows[table_name] = connection.execute(text(f"SELECT COUNT(*) FROM {table_name}")).scalar()
+    return [], []
+
+
+def track_table_history(run, table_name):
+    # Version the raw rows that changed since the last run, before the
+    # fixes. In incremental mode only the rows of the scope and the deleted
+    # ones can have changed.
+    keys = None
+    if run.config.sync_mode == "incremental":
+        keys = run.scope[table_name].union(run.removed[table_name])
+    versions = track_history(run.engine, run.writer, table_name, run.raw[table_name], run.started_at, keys)
+    return [run.raw[table_name]], [versions]
+
+
+def validate_teams(run):
+    teams_df_new = run.raw["teams"]
+
+    # Teams have more than 11 players, add to error table
+    teams_errors, _ = check("clean", "teams", teams_df_new, {'players': run.raw["players"]})
+
+    # Insert Invalid Rows into Error Table and log file
+    run.writer.write(teams_errors, 'teams_errors', if_exists='replace')
+    run.cleaning_log.add(teams_errors, 'team_id', "Teams")
+    return [teams_df_new], [teams_errors]
+
+
+def validate(run):
+    stats_df_new = run.raw["player_stats"]
+    (teams_df_new,), (teams_errors,) = validate_teams(run)
+
+    # STATS TABLE CLEANING
+
+    # card rules: red cards greater than 1, yellow cards greater than 2 and
+    # two yellow cards without a red card, one error row per stat
+    stats_invalid, _ = check("clean", "player_stats", stats_df_new)
+
+    # Insert Invalid Rows into Error Table and log file
+    run.writer.write(stats_invalid, 'player_stats_errors', if_exists='replace')
+    run.cleaning_log.add(stats_invalid, 'stat_id', "Player Stats")
+
+    # fix errors in dataframe
+    apply_fixes("clean", "player_stats", stats_df_new)
+
+    return [teams_df_new, stats_df_new], [teams_errors, stats_invalid]
+
+
+def replace_error_rows(run, table_name, errors, key, keys):
+    # Replace the error rows of the given keys, in one transaction
+    with run.engine.begin() as connection:
+        if inspect(connection).has_table(table_name):
+            delete_keys(connection, table_name, keys, key)
+        run.writer.write(errors, table_name, if_exists='append', connection=connection)
+
+
+def validate_changes(run):
+    # Incremental mode: the rules only run over the rows of the scope, the
+    # teams against all their players, and replace the error rows of the
+    # scope and of the deleted rows. The error rows of the other rows still
+    # hold.
+    teams_df_new = run.raw["teams"]
+    team_players = apply_schema(
+        fetch_rows(run.engine, "players", teams_df_new['team_id'], column='team_id'), "players")
+    teams_errors, _ = check("clean", "teams", teams_df_new, {'players': team_players})
+    replace_error_rows(run, 'teams_errors', teams_errors, 'team_id', run.scope["teams"].union(run.removed["teams"]))
+    run.cleaning_log.add(teams_errors, 'team_id', "Teams")
+
+    stats_df_new = run.raw["player_stats"]
+    stats_invalid, _ = check("clean", "player_stats", stats_df_new)
+    replace_error_rows(run, 'player_stats_errors', stats_invalid, 'stat_id',
+                       run.scope["player_stats"].union(run.removed["player_stats"]))
+    run.cleaning_log.add(stats_invalid, 'stat_id', "Player Stats")
+
+    apply_fixes("clean", "player_stats", stats_df_new)
+
+    return [teams_df_new, team_players, stats_df_new], [teams_errors, stats_invalid]
+
+
+# (name in the log, table) of the record comparison, in log order
+RECORD_COMPARISON = [
+    ("Player Transfers", "transfer_history"),
+    ("Matches", "matches"),
+    ("Teams", "teams"),
+    ("Player Stats", "player_stats"),
+    ("Players", "players"),
+]
+
+
+def write_record_comparison(log_file, old_counts, new_counts):
+    from tabulate import tabulate
+
+    # include each table count before and after cleaning in the log file
+    log_table_string = tabulate(
+        [[name, old_counts[table_name], new_counts[table_name]] for name, table_name in RECORD_COMPARISON],
+        headers=["Table Name", "Old Count", "New Count"],
+        tablefmt="grid"
+    )
+    with open(log_file, "a") as log:
+        log.write("\nRecord Comparison\n")
+        log.write(log_table_string)
+        log.write("\n")
+
+
+def write_cleaning_log(run):
+    # Render the cleaning log once, with every rejected row of this run
+    run.cleaning_log.write()
+
+    old_counts = {table_name: len(df) for table_name, df in run.csv.items()}
+    new_counts = dict(run.raw_rows)
+    if run.stats_stream is not None:
+        old_counts["player_stats"] = run.stats_stream.csv_rows
+        new_counts["player_stats"] = run.stats_stream.cleaned_rows
+    write_record_comparison(run.config.path("log_file"), old_counts, new_counts)
+    return [], []
+
+
+def clear_cleaned_tables(run):
+    # First delete data from the tables
+    with run.engine.connect() as connection:
+        with connection.begin():
+            for table_name in reversed(SYNC_ORDER):
+                connection.execute(text(f"DELETE FROM cleaned_{table_name}"))
+    return [], []
+
+
+def load_cleaned_table(run, table_name):
+    # Write clean data to sql database
+    run.writer.write(run.raw[table_name], f"cleaned_{table_name}", if_exists='append')
+    return [run.raw[table_name]], [run.raw[table_name]]
+
+
+def load_cleaned_changes(run, table_name):
+    # Incremental mode: replace the rows of the scope (fixed by validate) in
+    # the cleaned table and drop the deleted ones. The fixes only touch the
+    # row they fix, so the other cleaned rows are still the fixed raw rows.
+    # The table is reloaded whole from the raw table when it does not hold
+    # the rows the raw table held before the sync (a table emptied or
+    # changed by hand).
+    rows = run.raw[table_name]
+    changes = run.changes[table_name]
+    cleaned_table = f"cleaned_{table_name}"
+    removed = run.removed[table_name]
+
+    with run.engine.begin() as connection:
+        cleaned_rows = connection.execute(text(f"SELECT COUNT(*) FROM {cleaned_table}")).scalar()
+        if cleaned_rows == run.raw_rows[table_name] - len(changes.inserts) + len(removed):
+            delete_keys(connection, cleaned_table, run.scope[table_name].union(removed), changes.key)
+        else:
+            connection.execute(text(f"DELETE FROM {cleaned_table}"))
+            rows = apply_schema(pd.read_sql(text(f"SELECT * FROM {table_name}"), connection), table_name)
+            apply_fixes("clean", table_name, rows)
+        run.writer.write(rows, cleaned_table, if_exists='append', connection=connection)
+    return [run.raw[table_name]], [rows]
+
+
+def read_whole_table(run, table_name):
+    # The raw table as read by the full mode; run.raw only holds the scope
+    # in incremental mode
+    if run.config.sync_mode != "incremental":
+        return run.raw[table_name]
+    return apply_schema(pd.read_sql(f"SELECT * FROM {table_name}", run.engine), table_name)
+
+
+def read_touched_rows(run, player_ids):
+    # The players, their transfers and the teams of both, the view rows of
+    # the players need
+    players = apply_schema(fetch_rows(run.engine, "players", player_ids), "players")
+    transfers = apply_schema(
+        fetch_rows(run.engine, "transfer_history", player_ids, column='player_id'), "transfer_history")
+    team_ids = id_index([players['team_id'], transfers['to_team_id']])
+    return players, apply_schema(fetch_rows(run.engine, "teams", team_ids), "teams"), transfers
+
+
+def build_final_view(run):
+    # Rebuild the whole view in full sync mode and on the first run of the
+    # day (the age flags depend on the date), otherwise only replace the
+    # rows of the players touched by the synced changes
+    if run.config.sync_mode == "incremental" and not needs_rebuild(run.engine):
+        tables = read_touched_rows(run, run.changed_players)
+        view_inputs = [*run.stat_changes, *tables]
+        final_view = refresh_final_view(run.writer, run.changed_players, run.stat_changes, *tables)
+        outputs = [final_view] if final_view is not None else []
+        if final_view is not None:
+            final_view = pd.read_sql("SELECT * FROM final_view", run.engine)
+    else:
+        view_inputs = [read_whole_table(run, table_name)
+                       for table_name in ("player_stats", "players", "teams", "transfer_history")]
+        final_view = rebuild_final_view(run.writer, *view_inputs)
+        outputs = [final_view]
+
+    if final_view is not None:
+        final_view.to_csv(run.config.path("final_view_csv"), index=False, header=True)
+
+    run.final_view = final_view
+    return view_inputs, outputs
+
+
+def build_summaries(run):
+    # Per-player and per-team totals served to the reports (league_reports.py)
+    raw = run.raw
+    players = player_summary(player_totals(raw["player_stats"]), raw["players"], raw["teams"])
+    teams = team_summary(team_results(raw["matches"]), raw["teams"])
+    refresh_summary_tables(run.writer, players, teams)
+    return [raw["player_stats"], raw["matches"]], [players, teams]
+
+
+def refresh_summaries(run):
+    # Incremental mode: recompute the summary rows of the touched players,
+    # from their aggregates in final_view_aggregates (refreshed by then),
+    # and of the teams whose results changed, from their matches. Built
+    # whole while the summary tables do not exist yet, or have an older layout.
+    if not summary_tables_current(run.engine):
+        tables = {table_name: read_whole_table(run, table_name)
+                  for table_name in ("player_stats", "players", "teams", "matches")}
+        players = player_summary(player_totals(tables["player_stats"]), tables["players"], tables["teams"])
+        teams = team_summary(team_results(tables["matches"]), tables["teams"])
+        refresh_summary_tables(run.writer, players, teams)
+        return list(tables.values()), [players, teams]
+
+    player_ids = run.changed_players
+    aggregates = fetch_rows(run.engine, AGGREGATES_TABLE, player_ids, column='player_id',
+                            columns="player_id, goals, assists, minutes, stat_rows")
+    players, teams, _ = read_touched_rows(run, player_ids)
+    players = player_summary(player_totals_of_aggregates(aggregates.set_index('player_id')), players, teams)
+
+    team_ids = run.result_teams
+    matches = pd.concat([fetch_rows(run.engine, "matches", team_ids, column=column)
+                         for column in ('home_team_id', 'away_team_id')], ignore_index=True)
+    matches = apply_schema(matches.drop_duplicates(subset='match_id'), "matches")
+    results = team_results(matches)
+    teams = team_summary(results[results['team_id'].isin(team_ids)],
+                         apply_schema(fetch_rows(run.engine, "teams", team_ids), "teams"))
+
+    refresh_summary_rows(run.writer, players, player_ids, teams, team_ids)
+    return [aggregates, matches], [players, teams]
+
+
+# Streamed player_stats (streaming mode)
+
+def sync_streamed_stats(run):
+    # Stream the raw and staged (or CSV) stats through the player foreign key check
+    valid_player_ids = pd.Index(run.existing["players"]['player_id'])
+    if use_staging(run.config):
+        stats_errors = run.stats_stream.sync_staged(run.config.path("staging_dir"), valid_player_ids)
+    else:
+        stats_errors = run.stats_stream.sync_csv(
+            run.config.csv_paths()["player_stats"], COLUMN_NAMES["player_stats"], valid_player_ids)
+    run.writer.write(stats_errors, 'player_stats_errors', if_exists='replace')
+    run.cleaning_log.add(stats_errors, 'stat_id', "Player Stats")
+    return [], [stats_errors]
+
+
+def load_streamed_stats(run):
+    run.stats_stream.load_raw()
+    return [], []
+
+
+def clean_streamed_stats(run):
+    # Card rules and fixes, chunk by chunk, into cleaned_player_stats, and
+    # the history of the raw chunks
+    history = None
+    if run.config.track_history:
+        history = TableHistory(run.engine, run.writer, "player_stats", run.started_at)
+    stats_invalid = run.stats_stream.clean(history)
+    run.writer.write(stats_invalid, 'player_stats_errors', if_exists='replace')
+    run.cleaning_log.add(stats_invalid, 'stat_id', "Player Stats")
+    return [], [stats_invalid]
+
+
+def build_streamed_final_view(run):
+    # Full rebuild from the aggregates folded while the stats were cleaned
+    raw = run.raw
+    aggregates = add_transfer_aggregates(run.stats_stream.aggregates, raw["teams"], raw["transfer_history"])
+    run.final_view = materialize_final_view(run.writer, aggregates, raw["players"], raw["teams"])
+    run.final_view.to_csv(run.config.path("final_view_csv"), index=False, header=True)
+    return [aggregates], [run.final_view]
+
+
+def build_streamed_summaries(run):
+    raw = run.raw
+    totals = player_totals_of_aggregates(run.stats_stream.aggregates)
+    players = player_summary(totals, raw["players"], raw["teams"])
+    teams = team_summary(team_results(raw["matches"]), raw["teams"])
+    refresh_summary_tables(run.writer, players, teams)
+    return [totals, raw["matches"]], [players, teams]
+
+
+# Stage graphs
+
+def after(stage_name, table_names):
+    return [f"{stage_name}:{table_name}" for table_name in table_names]
+
+
+def parents_loaded(stage_name, table_name, tables):
+    # the loads of the tables table_name references, so the FKs hold at every insert
+    return after(stage_name, [parent for parent in TABLE_PARENTS[table_name] if parent in tables])
+
+
+def cleaning_tasks(run, validate_stage, views_need, load_cleaned_stage=None):
+    # Rules and cleaned tables, shared by every mode. Returns the tasks and
+    # what the cleaning log and final_view need: every raw table read and
+    # cleaned, plus views_need. The cleaned tables are emptied and reloaded,
+    # unless load_cleaned_stage updates them in place.
+    tables = run.tables
+    validated = [table_name for table_name in ("teams", "players", "player_stats") if table_name in tables]
+    tracked = tables if run.config.track_history else []
+    cleaned = after("read_raw", tables) + ["validate"]
+    tasks = [
+        *table_tasks("history", track_table_history, tracked, lambda table_name: [f"read_raw:{table_name}"]),
+        # the fixes change the raw stats in place, so after their history
+        Task("validate", validate_stage, needs=tuple(
+            after("read_raw", validated) + after("history", set(tracked) & {"player_stats"}))),
+    ]
+    if load_cleaned_stage is None:
+        tasks += [
+            Task("clear_cleaned", clear_cleaned_tables, needs=tuple(cleaned)),
+            *table_tasks("load_cleaned", load_cleaned_table, tables, lambda table_name: [
+                "clear_cleaned", *parents_loaded("load_cleaned", table_name, tables)]),
+        ]
+    else:
+        tasks += table_tasks("load_cleaned", load_cleaned_stage, tables, lambda table_name: [
+            *cleaned, *parents_loaded("load_cleaned", table_name, tables)])
+    return tasks, tuple(cleaned + views_need)
+
+
+def incremental_sync_tasks(run):
+    # Diff the CSVs against the sync state and apply the changes
+    tables = run.tables
+    return [
+        Task("stage_sources", stage_sources),
+        *table_tasks("read_sources", read_source, tables, lambda table_name: ["stage_sources"]),
+        *table_tasks("diff_sources", diff_source, tables, lambda table_name: [f"read_sources:{table_name}"]),
+        Task("player_history", player_history_from_changes, needs=("diff_sources:players",)),
+        Task("foreign_keys", check_foreign_keys_of_changes, needs=tuple(after("diff_sources", tables))),
+        Task("changed_players", find_changed_players, needs=("foreign_keys",)),
+        # one transaction, parents first
+        Task("load_raw", apply_synced_changes, needs=("player_history", "changed_players")),
+    ]
+
+
+def incremental_cleaning_tasks(run):
+    # Everything after the sync only reads and rewrites the rows of the
+    # scope (see scope_changes), and nothing at all once no row changed
+    # since the last sync: then only the rows rejected again are logged,
+    # and final_view is rebuilt on the first run of the day.
+    tables = run.tables
+    if not any(len(changes) for changes in run.changes.values()) and not needs_rebuild(run.engine):
+        run.unchanged = True
+        if len(run.cleaning_log) == 0:
+            return []
+        return [Task("count_raw", count_raw_rows), Task("cleaning_log", write_cleaning_log, needs=("count_raw",))]
+
+    rules, views_need = cleaning_tasks(run, validate_changes, [], load_cleaned_changes)
+    return [
+        Task("count_raw", count_raw_rows),
+        *table_tasks("read_raw", read_raw_changes, tables, lambda table_name: ["count_raw"]),
+        *rules,
+        Task("cleaning_log", write_cleaning_log, needs=views_need),
+        Task("final_view", build_final_view, needs=views_need),
+        # from the refreshed final_view_aggregates; the indexes cover the cleaned tables too
+        Task("summaries", refresh_summaries, needs=views_need + tuple(after("load_cleaned", tables) + ["final_view"])),
+    ]
+
+
+def full_tasks(run):
+    tables = run.tables
+    rules, views_need = cleaning_tasks(run, validate, [])
+    return [
+        Task("stage_sources", stage_sources),
+        *table_tasks("read_sources", read_source, tables, lambda table_name: ["stage_sources"]),
+        *table_tasks("read_existing", read_existing, tables),
+        Task("player_history", player_history_from_tables, needs=("read_sources:players", "read_existing:players")),
+        *table_tasks("merge_synced", merge_synced, tables, lambda table_name: [
+            f"read_sources:{table_name}", f"read_existing:{table_name}"]),
+        Task("foreign_keys", check_foreign_keys_of_tables, needs=tuple(
+            after("merge_synced", ["transfer_history", "player_stats"]) + ["read_existing:players"])),
+        Task("clear_raw", clear_raw_tables, needs=tuple(after("read_existing", tables) + ["player_history", "foreign_keys"])),
+        *table_tasks("load_raw", reload_raw_table, tables, lambda table_name: [
+            "clear_raw", f"merge_synced:{table_name}", *parents_loaded("load_raw", table_name, tables)]),
+        *table_tasks("read_raw", read_raw_table, tables, lambda table_name: [f"load_raw:{table_name}"]),
+        *rules,
+        Task("cleaning_log", write_cleaning_log, needs=views_need),
+        Task("final_view", build_final_view, needs=views_need),
+        # its indexes cover the cleaned tables too
+        Task("summaries", build_summaries, needs=views_need + tuple(after("load_cleaned", tables))),
+    ]
+
+
+def streaming_tasks(run):
+    # full_tasks, with player_stats streamed by single tasks instead of held in run.tables
+    tables = run.tables
+    stats_parents = TABLE_PARENTS["player_stats"]
+    rules, views_need = cleaning_tasks(run, validate_teams, ["clean_stats"])
+    return [
+        Task("stage_sources", stage_sources),
+        *table_tasks("read_sources", read_source, tables, lambda table_name: ["stage_sources"]),
+        *table_tasks("read_existing", read_existing, tables),
+        Task("player_history", player_history_from_tables, needs=("read_sources:players", "read_existing:players")),
+        *table_tasks("merge_synced", merge_synced, tables, lambda table_name: [
+            f"read_sources:{table_name}", f"read_existing:{table_name}"]),
+        Task("foreign_keys", check_foreign_keys_of_transfers, needs=(
+            "merge_synced:transfer_history", "read_existing:players")),
+        # reads the raw stats, so before they are cleared; logs after the transfers
+        Task("sync_stats", sync_streamed_stats, needs=("foreign_keys",)),
+        Task("clear_raw", clear_raw_tables, needs=tuple(
+            after("read_existing", tables) + ["player_history", "foreign_keys", "sync_stats"])),
+        *table_tasks("load_raw", reload_raw_table, tables, lambda table_name: [
+            "clear_raw", f"merge_synced:{table_name}", *parents_loaded("load_raw", table_name, tables)]),
+        Task("load_raw_stats", load_streamed_stats, needs=tuple(["clear_raw"] + after("load_raw", stats_parents))),
+        *table_tasks("read_raw", read_raw_table, tables, lambda table_name: [f"load_raw:{table_name}"]),
+        *rules,
+        # logs after the teams
+        Task("clean_stats", clean_streamed_stats, needs=tuple(
+            ["load_raw_stats", "validate", "clear_cleaned"] + after("load_cleaned", stats_parents))),
+        Task("cleaning_log", write_cleaning_log, needs=views_need),
+        Task("final_view", build_streamed_final_view, needs=views_need),
+        Task("summaries", build_streamed_summaries, needs=views_need + tuple(after("load_cleaned", tables))),
+    ]
+
+
+# Stage graphs of every sync mode, run one after the other: a graph may
+# depend on what the graphs before it found
+PIPELINE_TASKS = {
+    "incremental": [incremental_sync_tasks, incremental_cleaning_tasks],
+    "full": [full_tasks],
+    "streaming": [streaming_tasks],
+}
+
+
+def write_load_report(run):
+    from tabulate import tabulate
+
+    # include the load throughput of every table write in the log file
+    load_table_string = tabulate(
+        run.writer.report(),
+        headers=["Table Name", "Rows", "Seconds", "Rows/sec"],
+        tablefmt="grid"
+    )
+    with open(run.config.path("log_file"), "a") as log_file:
+        log_file.write("\nLoad Performance\n")
+        log_file.write(load_table_string)
+        log_file.write("\n")
+
+
+def open_cleaning_log(config):
+    # Configure the logger
+    logging.basicConfig(
+        filename=config.path("log_file"),
+        filemode='w',
+        level=logging.INFO,
+        format='%(message)s',
+    )
+
+    # Rejected rows are collected in bulk and the log is rendered once per run
+    return CleaningLog(
+        config.path("log_file"),
+        records_path=config.path("log_records_file"),
+        history_path=config.path("log_history_file"),
+    )
+
+
+# Define the task to be scheduled
+def process_data_task(config=None):
+    # One run with config (load_config() by default), on the engine shared
+    # by the runs of this process
+    config = config or load_config()
+    workers = pipeline_workers(config)
+
+    # Connection to PostgreSQL, one pooled connection per stage thread
+    engine = shared_engine(config.database_url, pool_size=workers)
+
+    # COPY-based writer on PostgreSQL, batched INSERTs on other engines
+    writer = make_writer(engine)
+
+    run = PipelineRun(engine, writer, open_cleaning_log(config), config)
+    if config.sync_mode == "streaming":
+        run.tables.remove("player_stats")
+        run.stats_stream = StatsStream(engine, writer, config.stats_chunk_rows)
+    instrumentation = Instrumentation(profiler=config.profiler or None, profile_dir=config.path("profile_dir"))
+
+    with instrumentation.profiling():
+        for tasks in PIPELINE_TASKS[config.sync_mode]:
+            run_graph(
+                tasks(run),
+                lambda task: instrumentation.run_stage(task.name, task.stage, run, *task.args),
+                workers,
+            )
+
+    write_load_report(run)
+
+    # Row counts and stage metrics of this run, also recorded in pipeline_runs
+    instrumentation.rows = dict(run.raw_rows)
+    if run.stats_stream is not None:
+        instrumentation.rows["player_stats"] = run.stats_stream.cleaned_rows
+    instrumentation.rows["rejected"] = len(run.cleaning_log)
+    if config.path("metrics_report") is not None:
+        instrumentation.write_report(config.path("metrics_report"))
+    instrumentation.write_table(writer)
+
+    # the reports cached before this load are stale now
+    if not run.unchanged:
+        bump_run_generation(run.engine)
+
+    print("Task executed successfully!")
+    return instrumentation
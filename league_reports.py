@@ -0,0 +1,415 @@
+# League reports served from the summary tables
+#
+# The reports of "football league analysis.sql", read from player_summary
+# and team_summary (see summary_tables.py) instead of rejoining the cleaned
+# tables. Every report takes the same parameters:
+#
+#     team    only the players (or transfers) of that team, by team name
+#     season  (start, end) window of match (transfer) dates, end excluded,
+#             e.g. season_window(2023); aggregated from the cleaned tables
+#     top_n   the n best rows instead of every row tied for the best
+#
+# report() serves them through an in-process LRU cache, keyed by the run
+# generation that process_data_task bumps in the database after every
+# successful load, whichever process loaded the data. The generation itself
+# is read at most every GENERATION_POLL_SECONDS, so repeated dashboard
+# refreshes make no query at all in between. The TTL bounds how stale a
+# report can get when the tables are changed outside the pipeline.
+# Print all of them, or the ones named:
+#
+#     python league_reports.py
+#     python league_reports.py highest_scorer clean_sheets --team "Paris Kings" --season 2023 --top 5
+
+import argparse
+import inspect
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+import pandas as pd
+from sqlalchemy import BigInteger, Column, MetaData, Table, exc, func, insert, select, text, update
+
+from summary_tables import PLAYER_SUMMARY_TABLE, TEAM_SUMMARY_TABLE
+
+
+REPORT_CACHE_SIZE = 256
+REPORT_CACHE_TTL_SECONDS = 15 * 60
+
+# How late a load by another process can be seen (one by this process is
+# seen at once)
+GENERATION_POLL_SECONDS = 2
+
+# Seasons run from July to June
+SEASON_START_MONTH = 7
+
+
+def read(engine, query, params=None):
+    return pd.read_sql(text(query), engine, params=params)
+
+
+def season_window(year):
+    # (start, end) of the season starting in year, e.g. 2023 for 2023/24
+    return date(year, SEASON_START_MONTH, 1), date(year + 1, SEASON_START_MONTH, 1)
+
+
+# Sources
+
+def window_params(season):
+    if season is None:
+        return {}
+    start, end = season
+    # dates are compared as ISO strings, like they are stored
+    return {"season_start": str(start), "season_end": str(end)}
+
+
+def player_source(season):
+    # Per-player totals of the whole history, or of the matches in the season window
+    if season is None:
+        return PLAYER_SUMMARY_TABLE
+    return """(
+        SELECT P.player_id, P.player_name, P.team_id, T.team_name, P.birthdate,
+               COALESCE(S.total_goals, 0) AS total_goals,
+               COALESCE(S.total_assists, 0) AS total_assists,
+               COALESCE(S.total_minutes, 0) AS total_minutes,
+               COALESCE(S.total_goals, 0) + COALESCE(S.total_assists, 0) AS total_contributions,
+               COALESCE(S.stat_rows, 0) AS stat_rows
+        FROM cleaned_players P
+        LEFT JOIN cleaned_teams T ON P.team_id = T.team_id
+        LEFT JOIN (
+            SELECT S.player_id,
+                   SUM(S.goals) AS total_goals,
+                   SUM(S.assists) AS total_assists,
+                   SUM(S.mins_played) AS total_minutes,
+                   COUNT(*) AS stat_rows
+            FROM cleaned_player_stats S
+            JOIN cleaned_matches M ON S.match_id = M.match_id
+            WHERE M.match_date >= :season_start AND M.match_date < :season_end
+            GROUP BY S.player_id
+        ) S ON P.player_id = S.player_id
+    ) windowed"""
+
+
+def team_source(season):
+    # Per-team results of the whole history, or of the matches in the season window
+    if season is None:
+        return TEAM_SUMMARY_TABLE
+    return """(
+        SELECT T.team_id, T.team_name, T.country,
+               COUNT(R.team_id) AS matches_played,
+               COALESCE(SUM(R.home_win), 0) AS home_wins,
+               COALESCE(SUM(R.away_win), 0) AS away_wins,
+               COALESCE(SUM(R.clean_sheet), 0) AS clean_sheets
+        FROM cleaned_teams T
+        LEFT JOIN (
+            SELECT home_team_id AS team_id,
+                   CASE WHEN home_team_score > away_team_score THEN 1 ELSE 0 END AS home_win,
+                   0 AS away_win,
+                   CASE WHEN away_team_score = 0 THEN 1 ELSE 0 END AS clean_sheet
+            FROM cleaned_matches
+            WHERE match_date >= :season_start AND match_date < :season_end
+            UNION ALL
+            SELECT away_team_id,
+                   0,
+                   CASE WHEN away_team_score > home_team_score THEN 1 ELSE 0 END,
+                   CASE WHEN home_team_score = 0 THEN 1 ELSE 0 END
+            FROM cleaned_matches
+            WHERE match_date >= :season_start AND match_date < :season_end
+        ) R ON T.team_id = R.team_id
+        GROUP BY T.team_id, T.team_name, T.country
+    ) windowed"""
+
+
+def team_condition(team, params):
+    if team is None:
+        return ""
+    params["team"] = team
+    return " AND team_name = :team"
+
+
+# Reports
+
+def player_leaders(engine, column, columns, team, season, top_n):
+    # Players (with stats) with the highest total in column: all of them
+    # tied for the maximum, or the top_n best
+    params = window_params(season)
+    source = player_source(season)
+    condition = "stat_rows > 0" + team_condition(team, params)
+    if top_n is None:
+        return read(engine, f"""
+            SELECT {columns}
+            FROM {source}
+            WHERE {condition}
+              AND {column} = (SELECT MAX({column}) FROM {source} WHERE {condition})
+        """, params)
+    params["top_n"] = top_n
+    return read(engine, f"""
+        SELECT {columns}
+        FROM {source}
+        WHERE {condition}
+        ORDER BY {column} DESC, player_name
+        LIMIT :top_n
+    """, params)
+
+
+def highest_scorer(engine, team=None, season=None, top_n=None):
+    return player_leaders(engine, "total_goals", "player_id, player_name, total_goals", team, season, top_n)
+
+
+def top_contributors(engine, team=None, season=None, top_n=None):
+    return player_leaders(engine, "total_contributions", "player_id, player_name, total_contributions",
+                          team, season, top_n)
+
+
+def most_minutes(engine, team=None, season=None, top_n=None):
+    return player_leaders(engine, "total_minutes", "player_name, total_minutes", team, season, top_n)
+
+
+def over_300_minutes(engine, team=None, season=None):
+    # Share of all players (with or without stats) above and below 300 minutes
+    params = window_params(season)
+    return read(engine, f"""
+        SELECT
+            COUNT(CASE WHEN total_minutes > 300 THEN 1 END) AS over_300_mins,
+            COUNT(CASE WHEN total_minutes <= 300 THEN 1 END) AS under_300_mins,
+            ROUND(COUNT(CASE WHEN total_minutes > 300 THEN 1 END) * 100.0 / NULLIF(COUNT(*), 0), 2) AS over_300_mins_percentage,
+            ROUND(COUNT(CASE WHEN total_minutes <= 300 THEN 1 END) * 100.0 / NULLIF(COUNT(*), 0), 2) AS under_300_mins_percentage
+        FROM {player_source(season)}
+        WHERE 1 = 1{team_condition(team, params)}
+    """, params)
+
+
+def average_age(engine, team=None, today=None):
+    # Age in completed years, like EXTRACT(YEAR FROM AGE(birthdate)), computed
+    # here so the summary does not go stale from one day to the next
+    today = today or date.today()
+    params = {}
+    players = read(engine, f"""
+        SELECT team_name, birthdate
+        FROM {PLAYER_SUMMARY_TABLE}
+        WHERE team_name IS NOT NULL{team_condition(team, params)}
+    """, params)
+    birthdate = pd.to_datetime(players['birthdate'])
+    before_birthday = (birthdate.dt.month > today.month) | (
+        (birthdate.dt.month == today.month) & (birthdate.dt.day > today.day))
+    players['age'] = today.year - birthdate.dt.year - before_birthday.astype(int)
+    ages = players.groupby('team_name')['age'].agg(['sum', 'count'])
+    # mean rounded half up to one decimal like round(numeric, 1), in integer arithmetic
+    average = ((20 * ages['sum'] + ages['count']) // (2 * ages['count'])) / 10
+    return average.rename('average_age').sort_values(ascending=False).reset_index()
+
+
+def team_results_report(engine, columns, order_by, team, season, top_n):
+    # Teams that played, best first
+    params = window_params(season)
+    limit = ""
+    if top_n is not None:
+        params["top_n"] = top_n
+        limit = "LIMIT :top_n"
+    return read(engine, f"""
+        SELECT {columns}
+        FROM {team_source(season)}
+        WHERE matches_played > 0{team_condition(team, params)}
+        ORDER BY {order_by}
+        {limit}
+    """, params)
+
+
+def team_wins(engine, team=None, season=None, top_n=None):
+    return team_results_report(engine, "team_name, home_wins, away_wins", "home_wins DESC, away_wins DESC",
+                               team, season, top_n)
+
+
+def clean_sheets(engine, team=None, season=None, top_n=None):
+    return team_results_report(engine, "team_name, clean_sheets", "clean_sheets DESC", team, season, top_n)
+
+
+def most_expensive_transfer(engine, team=None, season=None, top_n=None):
+    # Transfers with the highest fee (from or to team, dated in the season
+    # window): all of them tied for the maximum, or the top_n highest
+    params = window_params(season)
+    condition = "1 = 1"
+    if season is not None:
+        condition += " AND T.trans_date >= :season_start AND T.trans_date < :season_end"
+    if team is not None:
+        params["team"] = team
+        condition += f"""
+          AND (T.from_team_id IN (SELECT team_id FROM {TEAM_SUMMARY_TABLE} WHERE team_name = :team)
+               OR T.to_team_id IN (SELECT team_id FROM {TEAM_SUMMARY_TABLE} WHERE team_name = :team))"""
+    if top_n is None:
+        condition += f" AND T.trans_fee = (SELECT MAX(T.trans_fee) FROM cleaned_transfer_history T WHERE {condition})"
+        order_by, limit = "P.player_name", ""
+    else:
+        params["top_n"] = top_n
+        order_by, limit = "T.trans_fee DESC, P.player_name", "LIMIT :top_n"
+    return read(engine, f"""
+        SELECT P.player_name, T.trans_fee,
+               T.from_team_id, F.team_name AS from_team_name,
+               T.to_team_id, ToT.team_name AS to_team_name
+        FROM cleaned_transfer_history T
+        JOIN {PLAYER_SUMMARY_TABLE} P ON T.player_id = P.player_id
+        LEFT JOIN {TEAM_SUMMARY_TABLE} F ON T.from_team_id = F.team_id
+        LEFT JOIN {TEAM_SUMMARY_TABLE} ToT ON T.to_team_id = ToT.team_id
+        WHERE {condition}
+        ORDER BY {order_by}
+        {limit}
+    """, params)
+
+
+REPORTS = {
+    "highest_scorer": highest_scorer,
+    "top_contributors": top_contributors,
+    "most_minutes": most_minutes,
+    "over_300_minutes": over_300_minutes,
+    "average_age": average_age,
+    "team_wins": team_wins,
+    "most_expensive_transfer": most_expensive_transfer,
+    "clean_sheets": clean_sheets,
+}
+
+
+# Cache
+
+class ReportCache:
+    # LRU cache whose entries also expire ttl_seconds after they were stored
+
+    def __init__(self, max_size=REPORT_CACHE_SIZE, ttl_seconds=REPORT_CACHE_TTL_SECONDS, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+        # key: (stored at, value), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (self.ttl_seconds is not None and self.clock() - entry[0] > self.ttl_seconds):
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (self.clock(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+report_cache = ReportCache()
+
+# Bumped by process_data_task after every successful load; the reports
+# cached under an older generation are never served again. Kept in the
+# database, so a load by another process (the scheduler, a Spark run) is
+# seen by the dashboards too.
+GENERATION_TABLE = "report_generation"
+
+generation_metadata = MetaData()
+report_generation = Table(
+    GENERATION_TABLE,
+    generation_metadata,
+    Column("generation", BigInteger, nullable=False),
+)
+
+
+# {database URL: generation} as last read, for GENERATION_POLL_SECONDS
+generation_cache = ReportCache(ttl_seconds=GENERATION_POLL_SECONDS)
+
+
+def read_run_generation(engine):
+    # 0 until the first load
+    try:
+        with engine.connect() as connection:
+            return connection.execute(select(func.max(report_generation.c.generation))).scalar() or 0
+    except exc.DBAPIError:
+        # only a missing table means no load yet
+        with engine.connect() as connection:
+            if engine.dialect.has_table(connection, GENERATION_TABLE):
+                raise
+        return 0
+
+
+def bump_run_generation(engine):
+    report_generation.create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        bumped = connection.execute(update(report_generation).values(generation=report_generation.c.generation + 1))
+        if not bumped.rowcount:
+            connection.execute(insert(report_generation).values(generation=1))
+    generation_cache.put(str(engine.url), read_run_generation(engine))
+
+
+def run_generation(engine):
+    generation = generation_cache.get(str(engine.url))
+    if generation is None:
+        generation = read_run_generation(engine)
+        generation_cache.put(str(engine.url), generation)
+    return generation
+
+
+def cached_report(engine, name, generation, params):
+    key = (str(engine.url), name, generation, tuple(sorted(params.items())))
+    result = report_cache.get(key)
+    if result is None:
+        result = REPORTS[name](engine, **params)
+        report_cache.put(key, result)
+    # callers get their own copy to modify
+    return result.copy()
+
+
+def report(engine, name, **params):
+    # Report name with its parameters, from the cache while no run loaded new data
+    return cached_report(engine, name, run_generation(engine), params)
+
+
+def run_reports(engine, names=None, **params):
+    # {report name: DataFrame} of the named reports, all of them by default.
+    # Parameters a report does not take (e.g. season for average_age) are left out.
+    generation = run_generation(engine)
+    reports = {}
+    for name in names or REPORTS:
+        accepted = inspect.signature(REPORTS[name]).parameters
+        reports[name] = cached_report(engine, name, generation,
+                                      {key: value for key, value in params.items() if key in accepted})
+    return reports
+
+
+def main(argv=None):
+    from tabulate import tabulate
+
+    from pipeline_config import load_config, shared_engine
+
+    parser = argparse.ArgumentParser(description="Print the league reports")
+    parser.add_argument("reports", nargs="*", metavar="report",
+                        help=f"reports to print, all by default: {', '.join(REPORTS)}")
+    parser.add_argument("--team", help="only this team (by name)")
+    parser.add_argument("--season", type=int, help="only the season starting in this year, e.g. 2023 for 2023/24")
+    parser.add_argument("--top", type=int, dest="top_n", help="the n best rows instead of the ties for the best")
+    parser.add_argument("--database-url", help="default: the database_url setting (see pipeline_config.py)")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.reports if name not in REPORTS]
+    if unknown:
+        parser.error(f"unknown reports: {', '.join(unknown)}")
+
+    params = {"team": args.team, "top_n": args.top_n}
+    if args.season is not None:
+        params["season"] = season_window(args.season)
+    params = {key: value for key, value in params.items() if value is not None}
+
+    engine = shared_engine(load_config(database_url=args.database_url).database_url)
+    for name, result in run_reports(engine, args.reports, **params).items():
+        print(f"\n{name}")
+        print(tabulate(result, headers="keys", tablefmt="grid", showindex=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+# Schema of the league tables
+#
+# Column names and compact dtypes of the five raw tables. The dtypes are
+# applied once, where a frame enters the pipeline: when a CSV is read (see
+# parquet_staging.py), when a raw table is read from the database and when
+# the sync merges the two. Ids are int32, scores, cards and contract years
+# int8, minutes and years int16, assists float64 (also in an empty frame,
+# so the tables created from it get a float column), the low-cardinality
+# text (positions, nationalities, countries, cities, stadiums, referees)
+# category and dates datetime64, so the isin lookups and merges of
+# final_view run on small fixed-width keys and no stage parses a date
+# again. Integer columns holding missing values, fractions or values out of
+# the range of their dtype keep the wider type pandas gives them. The
+# writers store the dates back as ISO dates (see database_values).
+#
+#   python league_schema.py [--config FILE]    memory of the CSVs with the default and the compact dtypes
+
+import argparse
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_datetime64_dtype
+
+
+# Bumped whenever the dtypes change, so the staged copies of the CSVs are converted again
+SCHEMA_VERSION = 4
+
+DATE = "date"
+
+# Sheet of every table in FootballDummyData.xlsx, the workbook of the CSVs
+SHEETS = {
+    "teams": "Teams",
+    "players": "Players",
+    "matches": "Matches",
+    "transfer_history": "PlayerTransfers",
+    "player_stats": "PlayerStats",
+}
+
+# CSV column names -> database column names
+COLUMN_NAMES = {
+    "teams": {
+        "TeamID": "team_id",
+        "TeamName" : "team_name",
+        "FoundedYear": "founded_year",
+        "HomeCity" : "home_city",
+        "ManagerName":"manager_name",
+        "StadiumName" : "stadium_name",
+        "StadiumCapacity": "stadium_capacity",
+        "Country" : "country"
+    },
+    "players": {
+        'PlayerID': 'player_id',
+        'TeamID': 'team_id',
+        'Name': 'player_name',
+        'Position': 'position',
+        'DateOfBirth': 'birthdate',
+        'Nationality': 'nationality',
+        'ContractUntil': 'contract_until',
+        'MarketValue': 'market_value'
+    },
+    "matches": {
+        'MatchID': 'match_id',
+        'Date': 'match_date',
+        'HomeTeamID': 'home_team_id',
+        'AwayTeamID': 'away_team_id',
+        'HomeTeamScore': 'home_team_score',
+        'AwayTeamScore': 'away_team_score',
+        'Stadium': 'stadium',
+        'Referee': 'referee'
+    },
+    "transfer_history": {
+        'TransferID': 'trans_id',
+        'PlayerID': 'player_id',
+        'FromTeamID': 'from_team_id',
+        'ToTeamID': 'to_team_id',
+        'TransferDate': 'trans_date',
+        'TransferFee': 'trans_fee',
+        'ContractDuration': 'contract_duration'
+    },
+    "player_stats": {
+        'StatID': 'stat_id',
+        'PlayerID': 'player_id',
+        'MatchID': 'match_id',
+        'Goals': 'goals',
+        'Assists': 'assists',
+        'YellowCards': 'yellow_cards',
+        'RedCards': 'red_cards',
+        'MinutesPlayed': 'mins_played'
+    },
+}
+
+# dtypes by database column name; the other columns (names) keep the
+# inferred string types
+COLUMN_DTYPES = {
+    "teams": {
+        "team_id": "int32",
+        "founded_year": "int16",
+        "home_city": "category",
+        "stadium_capacity": "int32",
+        "country": "category",
+    },
+    "players": {
+        "player_id": "int32",
+        "team_id": "int32",
+        "position": "category",
+        "birthdate": DATE,
+        "nationality": "category",
+        "contract_until": DATE,
+        "market_value": "int64",
+    },
+    "matches": {
+        "match_id": "int32",
+        "match_date": DATE,
+        "home_team_id": "int32",
+        "away_team_id": "int32",
+        "home_team_score": "int8",
+        "away_team_score": "int8",
+        "stadium": "category",
+        "referee": "category",
+    },
+    "transfer_history": {
+        "trans_id": "int32",
+        "player_id": "int32",
+        "from_team_id": "int32",
+        "to_team_id": "int32",
+        "trans_date": DATE,
+        "trans_fee": "int64",
+        "contract_duration": "int8",
+    },
+    "player_stats": {
+        "stat_id": "int32",
+        "player_id": "int32",
+        "match_id": "int32",
+        "goals": "int8",
+        "assists": "float64",
+        "yellow_cards": "int8",
+        "red_cards": "int8",
+        "mins_played": "int16",
+    },
+}
+
+
+def csv_dtypes(table_name):
+    # dtypes read_csv can parse directly, by CSV column name. Only the
+    # categories: read_csv wraps integers that overflow a narrow dtype, so
+    # those are narrowed (and the dates converted) by apply_schema.
+    dtypes = COLUMN_DTYPES[table_name]
+    return {
+        csv_column: dtypes[column]
+        for csv_column, column in COLUMN_NAMES[table_name].items()
+        if dtypes.get(column) == "category"
+    }
+
+
+def fits(values, dtype):
+    # Whether values can be cast to the integer dtype as they are: astype
+    # wraps the values out of its range and truncates fractions silently
+    if values.isna().any():
+        return False
+    if values.dtype.kind not in "iuf" or values.empty:
+        return True
+    if values.dtype.kind == "f" and not (values == np.floor(values)).all():
+        return False
+    limits = np.iinfo(dtype)
+    return limits.min <= values.min() and values.max() <= limits.max
+
+
+def apply_schema(df, table_name):
+    # df (with database column names) in the compact dtypes of table_name.
+    # Columns that already have their dtype are left as they are.
+    dtypes = {}
+    for column, dtype in COLUMN_DTYPES[table_name].items():
+        if column not in df.columns:
+            continue
+        values = df[column]
+        if dtype == DATE:
+            if not is_datetime64_dtype(values):
+                # ISO text from the CSVs and SQLite, date objects from PostgreSQL
+                df = df.assign(**{column: pd.to_datetime(values, format="ISO8601")})
+        elif values.dtype != dtype and (dtype in ("category", "float64") or fits(values, dtype)):
+            dtypes[column] = dtype
+    return df.astype(dtypes) if dtypes else df
+
+
+def date_columns(df):
+    # datetime64 columns of df holding only dates, or nothing (e.g. the
+    # date columns of an empty frame)
+    dates = []
+    for column in df.columns:
+        values = df[column]
+        if is_datetime64_dtype(values):
+            present = values.dropna()
+            if (present == present.dt.normalize()).all():
+                dates.append(column)
+    return dates
+
+
+def database_values(df, dates):
+    # df with the given date columns as ISO text, which every database takes
+    # for a date (and SQLite stores as it is, like the CSVs)
+    if not dates:
+        return df
+    return df.assign(**{column: df[column].dt.strftime("%Y-%m-%d") for column in dates})
+
+
+# Memory report
+
+def frame_megabytes(df):
+    return df.memory_usage(deep=True).sum() / 2 ** 20
+
+
+def memory_report(csv_paths):
+    # [table, rows, MB with the default dtypes, MB with the compact dtypes,
+    # saving] of every CSV
+    rows = []
+    for table_name, path in csv_paths.items():
+        df = pd.read_csv(path).rename(columns=COLUMN_NAMES[table_name])
+        before, after = frame_megabytes(df), frame_megabytes(apply_schema(df, table_name))
+        rows.append([table_name, len(df), round(before, 3), round(after, 3),
+                     f"{1 - after / before:.0%}" if before else ""])
+    return rows
+
+
+if __name__ == "__main__":
+    from tabulate import tabulate
+
+    from pipeline_config import load_config
+
+    parser = argparse.ArgumentParser(description="Memory of the league CSVs with the default and the compact dtypes")
+    parser.add_argument("--config", help="JSON settings file (default: $LEAGUE_CONFIG)")
+    args = parser.parse_args()
+
+    print(tabulate(memory_report(load_config(args.config).csv_paths()),
+                   headers=["Table", "Rows", "Default MB", "Compact MB", "Saved"], tablefmt="grid"))
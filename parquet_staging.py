@@ -0,0 +1,232 @@
+# Parquet staging layer between the source CSVs and the pipeline
+#
+# Every CSV is parsed once, with the dtypes of league_schema.py, into a
+# Parquet dataset in the staging directory: matches and player_stats
+# partitioned by the month of the match date, the other tables as a single
+# file. A manifest keeps the checksum of the sources of every dataset, so a
+# CSV is only converted again when its content (or the schema) changed. The
+# runs read the typed Parquet, and only the columns (and partitions) they
+# ask for. The streamed tables (player_stats in streaming mode) are
+# converted and read back in chunks, never as one frame. Without pyarrow the
+# CSVs are read directly, with the same dtypes.
+
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from file_checksums import file_checksum
+from league_schema import SCHEMA_VERSION, apply_schema, csv_dtypes
+
+try:
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+MANIFEST_FILE = "manifest.json"
+
+# Original row number, restored on read so the sources keep their CSV order
+# (the last row of a duplicated key wins)
+ROW_COLUMN = "source_row"
+
+PARTITION_COLUMN = "match_month"
+# rows without a match date (e.g. stats of an unknown match)
+UNKNOWN_PARTITION = "unknown"
+
+# Tables partitioned by match month, and the tables their partitions are taken from
+PARTITIONED_TABLES = {
+    "matches": [],
+    "player_stats": ["matches"],
+}
+
+
+def staging_available():
+    return pyarrow is not None
+
+
+def read_typed_csv(path, table_name, column_names):
+    # Reads a CSV with the compact dtypes of league_schema.py and renames
+    # its columns; the integers are narrowed (range-checked) by apply_schema
+    df = pd.read_csv(path, dtype=csv_dtypes(table_name))
+    return apply_schema(df.rename(columns=column_names), table_name)
+
+
+def read_typed_csv_chunks(path, table_name, column_names, chunk_rows):
+    # read_typed_csv, chunk_rows rows at a time, indexed by CSV row; the type
+    # of an integer column holding missing values is decided per chunk
+    for chunk in pd.read_csv(path, chunksize=chunk_rows):
+        yield apply_schema(chunk.rename(columns=column_names), table_name)
+
+
+# Manifest
+
+def read_manifest(staging_dir):
+    path = os.path.join(staging_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(staging_dir, manifest):
+    path = os.path.join(staging_dir, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def dataset_path(staging_dir, table_name):
+    return os.path.join(staging_dir, table_name)
+
+
+# Conversion
+
+def month_of(dates):
+    # "YYYY-MM" partition of datetime64 dates; the ISO format is the fast
+    # path of strftime, any other format is rendered date by date
+    return dates.dt.strftime("%Y-%m-%d").str[:7].fillna(UNKNOWN_PARTITION)
+
+
+def match_months(matches):
+    # month of every match, indexed by match_id (the last row of a duplicated match wins)
+    months = pd.Series(month_of(matches["match_date"]).to_numpy(), index=matches["match_id"].to_numpy())
+    return months[~months.index.duplicated(keep="last")]
+
+
+def write_dataset(frames, path, partitioned):
+    # Writes the frames (a table, or its chunks, indexed by CSV row) next to
+    # the old dataset and swaps it in, so a failed conversion leaves the
+    # previous one readable. Returns the number of rows written.
+    temporary_path = path + ".tmp"
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+    rows = 0
+    for part, df in enumerate(frames):
+        df = df.copy()
+        df.insert(0, ROW_COLUMN, df.index.to_numpy(dtype="int32"))
+        if partitioned:
+            # every call adds new files to the partitions
+            df.to_parquet(temporary_path, partition_cols=[PARTITION_COLUMN], index=False)
+        else:
+            df.to_parquet(os.path.join(temporary_path, f"part-{part}.parquet"), index=False)
+        rows += len(df)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temporary_path, path)
+    return rows
+
+
+def add_partition(df, months):
+    # match_month of every row: from its date (matches) or from the month of
+    # its match (months, see match_months)
+    if months is None:
+        df[PARTITION_COLUMN] = month_of(df["match_date"])
+    else:
+        df[PARTITION_COLUMN] = df["match_id"].map(months).fillna(UNKNOWN_PARTITION)
+    return df
+
+
+def stage_csvs(csv_files, column_names, staging_dir, streamed=(), chunk_rows=None):
+    # Converts the CSVs whose content (or whose partition source) changed
+    # since their last conversion. The streamed tables are converted
+    # chunk_rows rows at a time. Returns the other converted frames by table.
+    os.makedirs(staging_dir, exist_ok=True)
+    manifest = read_manifest(staging_dir)
+    checksums = {table_name: file_checksum(path) for table_name, path in csv_files.items()}
+
+    converted = {}
+    # matches first, player_stats is partitioned by their dates
+    for table_name in sorted(csv_files, key=lambda name: name != "matches"):
+        sources = [table_name] + PARTITIONED_TABLES.get(table_name, [])
+        checksum = "+".join(checksums[source] for source in sources)
+        path = dataset_path(staging_dir, table_name)
+        staged = manifest.get(table_name, {})
+        if staged.get("checksum") == checksum and staged.get("schema") == SCHEMA_VERSION and os.path.isdir(path):
+            continue
+
+        partitioned = table_name in PARTITIONED_TABLES
+        months = None
+        if partitioned and table_name != "matches":
+            matches = converted.get("matches")
+            if matches is None:
+                matches = read_staged(staging_dir, "matches", columns=["match_id", "match_date"])
+            months = match_months(matches)
+
+        if table_name in streamed:
+            chunks = read_typed_csv_chunks(csv_files[table_name], table_name, column_names[table_name], chunk_rows)
+            if partitioned:
+                chunks = (add_partition(chunk, months) for chunk in chunks)
+            rows = write_dataset(chunks, path, partitioned)
+        else:
+            df = read_typed_csv(csv_files[table_name], table_name, column_names[table_name])
+            if partitioned:
+                df = add_partition(df, months)
+            rows = write_dataset([df], path, partitioned)
+            converted[table_name] = df.drop(columns=PARTITION_COLUMN, errors="ignore")
+        manifest[table_name] = {"checksum": checksum, "schema": SCHEMA_VERSION, "rows": rows}
+        write_manifest(staging_dir, manifest)
+    return converted
+
+
+# Reads
+
+def staged_dataset(staging_dir, table_name):
+    # pyarrow dataset of a staged table. The chunks of a streamed table may
+    # differ in their integer types (see apply_schema), so the schema is
+    # unified over the footers of all the files.
+    # the many small files of a streamed table are read as they are, not
+    # buffered whole (which costs more memory than the columns read)
+    file_format = pyarrow.dataset.ParquetFileFormat(
+        default_fragment_scan_options=pyarrow.dataset.ParquetFragmentScanOptions(pre_buffer=False))
+    partitioning = pyarrow.dataset.HivePartitioning.discover(infer_dictionary=True)
+    path = dataset_path(staging_dir, table_name)
+    dataset = pyarrow.dataset.dataset(path, format=file_format, partitioning=partitioning)
+    schema = pyarrow.unify_schemas(
+        [dataset.schema] + [fragment.physical_schema for fragment in dataset.get_fragments()],
+        promote_options="permissive")
+    return pyarrow.dataset.dataset(path, schema=schema, format=file_format, partitioning=partitioning)
+
+
+def read_staged(staging_dir, table_name, columns=None, filters=None):
+    # Reads a staged table in CSV order. columns prunes the column chunks that
+    # are read, filters (pyarrow filters, e.g. [("match_month", ">=", "2023-08")])
+    # the partitions.
+    dataset = staged_dataset(staging_dir, table_name)
+    if columns is None:
+        columns = [column for column in dataset.schema.names if column != PARTITION_COLUMN]
+    read_columns = [ROW_COLUMN] + [column for column in columns if column != ROW_COLUMN]
+    expression = None if filters is None else pyarrow.parquet.filters_to_expression(filters)
+    df = dataset.to_table(columns=read_columns, filter=expression).to_pandas()
+    return df.sort_values(ROW_COLUMN, kind="stable").drop(columns=ROW_COLUMN).reset_index(drop=True)
+
+
+def read_staged_chunks(staging_dir, table_name, chunk_rows):
+    # Reads a staged table chunk_rows rows at a time, in the dtypes of
+    # league_schema.py and indexed by CSV row, in file (not CSV) order.
+    # Yields at least one (possibly empty) chunk.
+    dataset = staged_dataset(staging_dir, table_name)
+    columns = [column for column in dataset.schema.names if column != PARTITION_COLUMN]
+
+    def typed(table):
+        df = table.to_pandas()
+        df.index = pd.Index(df.pop(ROW_COLUMN).to_numpy(dtype="int64"))
+        return apply_schema(df, table_name)
+
+    pending = dataset.schema.empty_table().select(columns)
+    yielded = False
+    for batch in dataset.to_batches(columns=columns, batch_size=chunk_rows):
+        pending = pyarrow.concat_tables([pending, pyarrow.Table.from_batches([batch])])
+        while pending.num_rows >= chunk_rows:
+            yield typed(pending.slice(0, chunk_rows))
+            pending = pending.slice(chunk_rows)
+            yielded = True
+    if pending.num_rows or not yielded:
+        yield typed(pending)
+
+
+def staged_rows(staging_dir, table_name):
+    # Row count of a staged table, from the manifest
+    return read_manifest(staging_dir)[table_name]["rows"]
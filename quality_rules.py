@@ -0,0 +1,114 @@
+# Data-quality rules for the league tables
+#
+# Every check is one registered rule: a vectorized predicate that flags the
+# offending rows of a table, the reason that is logged for them and an
+# optional fix. All the rules of a table and stage are evaluated together
+# into a boolean mask matrix, so a row that breaks several rules yields a
+# single error row listing all its reasons.
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass(frozen=True)
+class Rule:
+    rule_id: str
+    table: str
+    # "sync" rules run on the synced rows before they are loaded into the raw
+    # tables, "clean" rules on the raw tables before the cleaned ones are written
+    stage: str
+    # predicate(df, context) -> boolean mask of the rows that break the rule
+    predicate: object
+    reason: str
+    # fix(df) corrects the frame in place
+    fix: object = None
+
+
+RULES = []
+
+
+def rule(rule_id, table, stage, predicate, reason, fix=None):
+    RULES.append(Rule(rule_id, table, stage, predicate, reason, fix))
+
+
+def rules_for(stage, table):
+    return [registered for registered in RULES if registered.stage == stage and registered.table == table]
+
+
+# Fixes
+
+def clamp(column, maximum):
+    def fix(df):
+        df.loc[df[column] > maximum, column] = maximum
+    return fix
+
+
+def second_yellow_is_red(df):
+    df.loc[df['yellow_cards'] == 2, 'red_cards'] = 1
+
+
+# Predicates that need other tables
+
+def unknown_player(df, context):
+    return ~df['player_id'].isin(context['valid_player_ids'])
+
+
+def team_over_11_players(df, context):
+    player_counts = context['players']['team_id'].value_counts()
+    return df['team_id'].isin(player_counts[player_counts > 11].index)
+
+
+# Registry
+
+rule("transfer_player_fk", "transfer_history", "sync", unknown_player,
+     "ForeignKeyViolation: player_id not present in players table")
+rule("stats_player_fk", "player_stats", "sync", unknown_player,
+     "ForeignKeyViolation: player_id not present in players table")
+# rule("stats_match_fk", "player_stats", "sync", lambda df, context: ~df['match_id'].isin(context['valid_match_ids']),
+#      "ForeignKeyViolation: match_id not present in matches table")
+
+rule("team_max_players", "teams", "clean", team_over_11_players,
+     "Team has more than 11 players")
+
+rule("stats_red_cards", "player_stats", "clean", lambda df, context: df['red_cards'] > 1,
+     "Red Cards greater than 1, should be 1", fix=clamp('red_cards', 1))
+rule("stats_yellow_cards", "player_stats", "clean", lambda df, context: df['yellow_cards'] > 2,
+     "Yellow Cards greater than 2, should be maximum 2", fix=clamp('yellow_cards', 2))
+rule("stats_second_yellow", "player_stats", "clean",
+     lambda df, context: (df['yellow_cards'] == 2) & (df['red_cards'] != 1),
+     "If there are any yellow cards = 2, then player should have a red card", fix=second_yellow_is_red)
+
+
+def evaluate(stage, table, df, context=None):
+    # Boolean mask matrix with one column per rule, indexed like df
+    context = context or {}
+    table_rules = rules_for(stage, table)
+    return pd.DataFrame(
+        {registered.rule_id: np.asarray(registered.predicate(df, context), dtype=bool) for registered in table_rules},
+        index=df.index,
+        columns=[registered.rule_id for registered in table_rules],
+    )
+
+
+def check(stage, table, df, context=None):
+    # Returns (errors, valid): one error row per offending record with all its
+    # reasons in 'reason', and the records that passed every rule
+    masks = evaluate(stage, table, df, context)
+    offending = masks.any(axis=1).to_numpy()
+
+    errors = df[offending].copy()
+    reasons = pd.Series("", index=errors.index)
+    for registered in rules_for(stage, table):
+        flagged = masks.loc[offending, registered.rule_id].to_numpy()
+        reasons = reasons.where(~flagged, reasons + "; " + registered.reason)
+    errors['reason'] = reasons.str.removeprefix("; ")
+    return errors, df[~offending]
+
+
+def apply_fixes(stage, table, df):
+    # Run the fixes in registration order, each on the already fixed frame
+    for registered in rules_for(stage, table):
+        if registered.fix is not None:
+            registered.fix(df)
@@ -0,0 +1,184 @@
+# Scheduler for the cleaning pipeline
+#
+# Runs the task on a schedule, but only when the source CSVs changed since
+# the last successful run, never twice at the same time (in-process lock
+# plus a PostgreSQL advisory lock shared by every host), and with an
+# exponential backoff after failures. Every run is recorded in
+# pipeline_runs with its per-stage durations, row counts and outcome.
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import schedule
+from sqlalchemy import Column, DateTime, Float, Integer, MetaData, String, Table, Text, text
+
+from file_checksums import file_checksum
+
+
+logger = logging.getLogger(__name__)
+
+RUNS_TABLE = "pipeline_runs"
+
+# Advisory lock key shared by every host running the pipeline
+ADVISORY_LOCK_KEY = 5_281_907_316
+
+runs_metadata = MetaData()
+pipeline_runs = Table(
+    RUNS_TABLE,
+    runs_metadata,
+    Column("run_id", Integer, primary_key=True, autoincrement=True),
+    Column("started_at", DateTime, nullable=False),
+    Column("finished_at", DateTime, nullable=False),
+    Column("duration_seconds", Float, nullable=False),
+    Column("outcome", String(16), nullable=False),
+    Column("error", Text),
+    # {"stage name": seconds}
+    Column("stage_durations", Text),
+    # {"table name": rows}
+    Column("row_counts", Text),
+)
+
+
+class PipelineScheduler:
+
+    def __init__(self, task, engine, watched_paths, interval_seconds=10, max_backoff_seconds=600,
+                 clock=time.monotonic):
+        self.task = task
+        self.engine = engine
+        self.watched_paths = list(watched_paths)
+        self.interval_seconds = interval_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        # (mtime, size, checksum) of every watched file at the last successful run
+        self.fingerprints = {}
+        self.failures = 0
+        self.next_attempt = 0.0
+
+        runs_metadata.create_all(engine, checkfirst=True)
+
+    # Change detection
+
+    def changed_fingerprints(self):
+        # New fingerprints if any watched file changed, else None. Checksums
+        # are only computed for files whose mtime or size changed.
+        fingerprints = {}
+        changed = False
+        for path in self.watched_paths:
+            stat = os.stat(path)
+            previous = self.fingerprints.get(path)
+            if previous is not None and previous[:2] == (stat.st_mtime_ns, stat.st_size):
+                fingerprints[path] = previous
+                continue
+            checksum = file_checksum(path)
+            fingerprints[path] = (stat.st_mtime_ns, stat.st_size, checksum)
+            if previous is None or previous[2] != checksum:
+                changed = True
+        if not changed:
+            # remember touched-but-identical files so they are not hashed again
+            self.fingerprints = fingerprints
+            return None
+        return fingerprints
+
+    # Locking
+
+    def try_advisory_lock(self, connection):
+        if connection.dialect.name != "postgresql":
+            return True
+        return connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": ADVISORY_LOCK_KEY}).scalar()
+
+    def advisory_unlock(self, connection):
+        if connection.dialect.name == "postgresql":
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": ADVISORY_LOCK_KEY})
+
+    # Runs
+
+    def run_once(self, force=False):
+        # Returns the outcome: "success", "failed" or why the run was skipped.
+        # An error around the task (a watched file missing, the database
+        # down while locking or recording the run) fails the run like an
+        # error of the task, with the same backoff, so serve() keeps going.
+        if not self.lock.acquire(blocking=False):
+            return "skipped: already running"
+        try:
+            if self.clock() < self.next_attempt:
+                return "skipped: backing off"
+
+            try:
+                outcome, fingerprints = self.attempt(force)
+            except Exception:
+                logger.exception("Pipeline run failed")
+                outcome, fingerprints = "failed", None
+
+            if outcome == "success":
+                if fingerprints is not None:
+                    self.fingerprints = fingerprints
+                self.failures = 0
+                self.next_attempt = 0.0
+            elif outcome == "failed":
+                self.failures += 1
+                backoff = min(self.interval_seconds * 2 ** self.failures, self.max_backoff_seconds)
+                self.next_attempt = self.clock() + backoff
+                logger.warning("Pipeline run failed, next attempt in %s seconds", backoff)
+            return outcome
+        finally:
+            self.lock.release()
+
+    def attempt(self, force):
+        # (outcome, new fingerprints) of one run, unless skipped
+        fingerprints = self.changed_fingerprints()
+        if fingerprints is None and not force:
+            return "skipped: sources unchanged", None
+
+        with self.engine.connect() as lock_connection:
+            locked = self.try_advisory_lock(lock_connection)
+            # the session-level lock outlives the transaction of the query
+            lock_connection.commit()
+            if not locked:
+                return "skipped: running on another host", None
+            try:
+                outcome = self.execute()
+            finally:
+                self.advisory_unlock(lock_connection)
+                lock_connection.commit()
+        return outcome, fingerprints
+
+    def execute(self):
+        started_at = datetime.now()
+        start = time.perf_counter()
+        summary = None
+        error = None
+        try:
+            # the task returns its instrumentation, with .stages and .rows
+            summary = self.task()
+            outcome = "success"
+        except Exception as exc:
+            logger.exception("Pipeline run failed")
+            outcome = "failed"
+            error = f"{type(exc).__name__}: {exc}"
+        self.record_run(started_at, time.perf_counter() - start, outcome, error, summary)
+        return outcome
+
+    def record_run(self, started_at, duration, outcome, error, summary):
+        with self.engine.begin() as connection:
+            connection.execute(pipeline_runs.insert(), {
+                "started_at": started_at,
+                "finished_at": datetime.now(),
+                "duration_seconds": round(duration, 3),
+                "outcome": outcome,
+                "error": error,
+                "stage_durations": json.dumps(summary.stages) if summary is not None else None,
+                "row_counts": json.dumps(summary.rows) if summary is not None else None,
+            })
+
+    def serve(self):
+        schedule.every(self.interval_seconds).seconds.do(self.run_once)
+        # schedule.every().day.at("10:00").do(self.run_once)
+        while True:
+            schedule.run_pending()
+            time.sleep(max(schedule.idle_seconds() or 0, 0))
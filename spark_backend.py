@@ -0,0 +1,567 @@
+# Spark backend of the cleaning pipeline
+#
+# The stages of league_pipeline expressed as Spark DataFrame
+# transformations, for stats histories that do not fit in one pandas
+# process. It runs the full sync: the CSVs are read in parallel with
+# explicit schemas, synced with the raw tables by key, checked with the
+# rules of quality_rules (same reasons, one error row per record) and
+# loaded over JDBC in batches, and final_view is aggregated with the same
+# columns as final_view.py. Selected (and only then imported) by the
+# backend setting "spark"; runs in local[*] mode unless SPARK_MASTER says
+# otherwise. The incremental and streaming sync modes and the type-2
+# history are not implemented here: those settings are ignored with a
+# warning, and sync_apply_deletes is refused, as the full sync keeps the
+# rows removed from the CSVs.
+
+import logging
+import os
+import time
+from datetime import datetime
+
+import pandas as pd
+from pyspark.sql import SparkSession, Window
+from pyspark.sql import functions as F
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+from bulk_loader import TableWriter, make_writer
+from final_view import AGGREGATES_TABLE, COUNTRY_COLUMNS, FINAL_VIEW_COLUMNS
+from incremental_sync import SYNC_ORDER, TABLE_KEYS
+from instrumentation import Instrumentation
+from league_reports import bump_run_generation
+from league_pipeline import PipelineRun, open_cleaning_log, write_load_report, write_record_comparison
+from league_schema import COLUMN_NAMES
+from pipeline_config import load_config, shared_engine
+from quality_rules import RULES, rules_for
+from summary_tables import player_summary, refresh_summary_tables, team_summary
+
+
+SPARK_MASTER = "local[*]"
+
+# PostgreSQL JDBC driver, fetched by Spark from Maven on the first run
+# unless the spark_jars setting gives local jars; None uses the driver
+# already on the Spark classpath
+JDBC_DRIVER_PACKAGE = "org.postgresql:postgresql:42.7.4"
+# rows per JDBC batch, and concurrent connections per table write
+JDBC_BATCH_ROWS = 10_000
+JDBC_WRITE_PARTITIONS = 4
+
+# Explicit CSV schemas, in CSV column names, so no pass is spent on type inference
+CSV_SCHEMAS = {
+    "teams": "TeamID INT, TeamName STRING, FoundedYear INT, HomeCity STRING, ManagerName STRING, "
+             "StadiumName STRING, StadiumCapacity INT, Country STRING",
+    "players": "PlayerID INT, TeamID INT, Name STRING, Position STRING, DateOfBirth DATE, "
+               "Nationality STRING, ContractUntil DATE, MarketValue BIGINT",
+    "matches": "MatchID INT, Date DATE, HomeTeamID INT, AwayTeamID INT, HomeTeamScore INT, "
+               "AwayTeamScore INT, Stadium STRING, Referee STRING",
+    "transfer_history": "TransferID INT, PlayerID INT, FromTeamID INT, ToTeamID INT, TransferDate DATE, "
+                        "TransferFee BIGINT, ContractDuration INT",
+    "player_stats": "StatID INT, PlayerID INT, MatchID INT, Goals INT, Assists DOUBLE, YellowCards INT, "
+                    "RedCards INT, MinutesPlayed INT",
+}
+
+# Columns added by the stages, dropped before anything is written
+SOURCE_COLUMN = "_source"
+ROW_COLUMN = "_row"
+
+logger = logging.getLogger(__name__)
+
+
+def spark_session(jars=None):
+    # One session per process, reused by every scheduled run. jars: local
+    # JDBC driver jars (comma-separated), used instead of JDBC_DRIVER_PACKAGE
+    builder = (
+        SparkSession.builder
+        .appName("football-league-cleaning")
+        .master(SPARK_MASTER)
+        .config("spark.sql.shuffle.partitions", str(os.cpu_count() or 8))
+    )
+    if jars:
+        builder = builder.config("spark.jars", jars)
+    elif JDBC_DRIVER_PACKAGE is not None:
+        builder = builder.config("spark.jars.packages", JDBC_DRIVER_PACKAGE)
+    return builder.getOrCreate()
+
+
+# JDBC
+
+def jdbc_connection(engine):
+    # (JDBC url, connection properties) of the database of engine
+    url = make_url(engine.url)
+    if url.get_backend_name() != "postgresql":
+        raise ValueError(f"The Spark backend loads over JDBC into PostgreSQL only, not {url.get_backend_name()}")
+    jdbc_url = f"jdbc:postgresql://{url.host or 'localhost'}:{url.port or 5432}/{url.database}?reWriteBatchedInserts=true"
+    properties = {
+        "user": url.username or "",
+        "password": url.password or "",
+        "driver": "org.postgresql.Driver",
+        "batchsize": str(JDBC_BATCH_ROWS),
+        "numPartitions": str(JDBC_WRITE_PARTITIONS),
+    }
+    return jdbc_url, properties
+
+
+def read_table(spark, engine, table_name):
+    jdbc_url, properties = jdbc_connection(engine)
+    return spark.read.jdbc(jdbc_url, table_name, properties=properties)
+
+
+def write_table(df, engine, table_name, mode):
+    jdbc_url, properties = jdbc_connection(engine)
+    df.write.jdbc(jdbc_url, table_name, mode=mode, properties=properties)
+
+
+class JdbcWriter(TableWriter):
+    # Same interface and load report as the pandas writers, but writes Spark
+    # frames over JDBC (pandas frames are converted first)
+
+    def __init__(self, engine, spark):
+        super().__init__(engine)
+        self.spark = spark
+
+    def write(self, df, table_name, if_exists="append", connection=None):
+        if isinstance(df, pd.DataFrame):
+            df = self.spark.createDataFrame(df)
+        start = time.perf_counter()
+        rows = df.count()
+        write_table(df, self.engine, table_name, "overwrite" if if_exists == "replace" else if_exists)
+        self.record(table_name, rows, start)
+
+
+# Sync
+
+def keep_last(df, key):
+    # Last row of every key, like drop_duplicates(key, keep="last") on the
+    # concatenation: CSV rows win over database rows, later CSV rows over earlier ones
+    latest = Window.partitionBy(key).orderBy(F.col(SOURCE_COLUMN).desc(), F.col(ROW_COLUMN).desc())
+    return (
+        df.withColumn("_rank", F.row_number().over(latest))
+        .filter(F.col("_rank") == 1)
+        .drop("_rank", SOURCE_COLUMN, ROW_COLUMN)
+    )
+
+
+def changed_rows(existing, incoming, key):
+    # Rows of existing whose incoming version differs in any column
+    columns = [column for column in existing.columns if column != key]
+    different = F.lit(False)
+    for column in columns:
+        different = different | ~F.col(f"old.{column}").eqNullSafe(F.col(f"new.{column}"))
+    return (
+        existing.alias("old")
+        .join(incoming.alias("new"), key)
+        .filter(different)
+        .select(key, *[F.col(f"old.{column}") for column in columns])
+    )
+
+
+# Rules
+
+# Spark version of every registered predicate: (df, context) -> (df, mask).
+# Predicates may join helper columns (prefixed with _) onto df for their mask.
+
+def unknown_player(df, context):
+    known = context['valid_player_ids'].select('player_id').distinct().withColumn('_known_player', F.lit(True))
+    return df.join(F.broadcast(known), 'player_id', 'left'), F.col('_known_player').isNull()
+
+
+def team_over_11_players(df, context):
+    player_counts = context['players'].groupBy('team_id').count()
+    crowded = player_counts.filter(F.col('count') > 11).select('team_id', F.lit(True).alias('_over_11'))
+    return df.join(F.broadcast(crowded), 'team_id', 'left'), F.col('_over_11').isNotNull()
+
+
+SPARK_PREDICATES = {
+    "transfer_player_fk": unknown_player,
+    "stats_player_fk": unknown_player,
+    "team_max_players": team_over_11_players,
+    "stats_red_cards": lambda df, context: (df, F.col('red_cards') > 1),
+    "stats_yellow_cards": lambda df, context: (df, F.col('yellow_cards') > 2),
+    "stats_second_yellow": lambda df, context: (df, (F.col('yellow_cards') == 2) & (F.col('red_cards') != 1)),
+}
+
+
+def clamp(column, maximum):
+    def fix(df):
+        return df.withColumn(column, F.when(F.col(column) > maximum, maximum).otherwise(F.col(column)))
+    return fix
+
+
+def second_yellow_is_red(df):
+    return df.withColumn('red_cards', F.when(F.col('yellow_cards') == 2, 1).otherwise(F.col('red_cards')))
+
+
+SPARK_FIXES = {
+    "stats_red_cards": clamp('red_cards', 1),
+    "stats_yellow_cards": clamp('yellow_cards', 2),
+    "stats_second_yellow": second_yellow_is_red,
+}
+
+
+def check_rule_coverage():
+    # The pandas predicates cannot be translated, so the Spark versions above
+    # must follow quality_rules.RULES: a rule (or fix) added there without
+    # its Spark version, or removed there but not here, stops the import
+    # instead of leaving the backends with different rules
+    predicates = {registered.rule_id for registered in RULES}
+    fixes = {registered.rule_id for registered in RULES if registered.fix is not None}
+    problems = [
+        f"{kind} {', '.join(sorted(rule_ids))}"
+        for kind, rule_ids in [
+            ("no Spark predicate for", predicates - set(SPARK_PREDICATES)),
+            ("no Spark fix for", fixes - set(SPARK_FIXES)),
+            ("Spark predicate of unregistered", set(SPARK_PREDICATES) - predicates),
+            ("Spark fix of unregistered", set(SPARK_FIXES) - fixes),
+        ]
+        if rule_ids
+    ]
+    if problems:
+        raise ImportError(f"Spark rules out of date with quality_rules: {'; '.join(problems)}")
+
+
+check_rule_coverage()
+
+
+def check(stage, table, df, context=None):
+    # Returns (errors, valid) like quality_rules.check: one error row per
+    # offending record with all its reasons in 'reason'
+    context = context or {}
+    flagged = df
+    reasons = []
+    for registered in rules_for(stage, table):
+        flagged, mask = SPARK_PREDICATES[registered.rule_id](flagged, context)
+        reasons.append(F.when(mask, F.lit(registered.reason)))
+
+    reason = F.concat_ws("; ", *reasons) if reasons else F.lit("")
+    flagged = flagged.select(*df.columns, reason.alias('reason')).cache()
+    errors = flagged.filter(F.col('reason') != "")
+    valid = flagged.filter(F.col('reason') == "").drop('reason')
+    return errors, valid
+
+
+def apply_fixes(stage, table, df):
+    # Run the fixes in registration order, each on the already fixed frame
+    for registered in rules_for(stage, table):
+        if registered.fix is not None:
+            df = SPARK_FIXES[registered.rule_id](df)
+    return df
+
+
+# final_view
+
+def player_aggregates(stats, teams, transfers):
+    # Same columns as final_view.player_aggregates
+    aggregates = stats.groupBy('player_id').agg(
+        F.sum('goals').alias('goals'),
+        F.sum('assists').alias('assists'),
+        F.sum('mins_played').alias('minutes'),
+        F.count('mins_played').alias('minutes_count'),
+        F.count(F.lit(1)).alias('stat_rows'),
+        F.max('goals').alias('max_goals'),
+    )
+    stat_columns = [column for column in aggregates.columns if column != 'player_id']
+
+    for country, _, _, count_column, join_column in COUNTRY_COLUMNS:
+        country_team_ids = teams.filter(F.col('country') == country).select(F.col('team_id').alias('to_team_id'))
+        country_transfers = (
+            transfers.join(F.broadcast(country_team_ids), 'to_team_id', 'left_semi')
+            .groupBy('player_id')
+            .agg(F.count(F.lit(1)).alias(count_column), F.min('trans_date').alias(join_column))
+        )
+        aggregates = aggregates.join(country_transfers, 'player_id', 'outer')
+
+    # players with transfers but no stats
+    count_columns = [count_column for _, _, _, count_column, _ in COUNTRY_COLUMNS]
+    return aggregates.fillna(0, subset=stat_columns + count_columns)
+
+
+def view_from_aggregates(aggregates, players, teams):
+    minutes = F.col('minutes')
+    totals = aggregates.filter(F.col('stat_rows') > 0).select(
+        'player_id',
+        F.col('goals').alias('TotalGoals'),
+        F.col('assists').alias('TotalAssists'),
+        (minutes / F.col('minutes_count')).alias('AverageMinutesPlayed'),
+        (minutes > 300).cast('int').alias('PlayedOver300Min'),
+        (F.col('max_goals') >= 3).cast('int').alias('Scored3PlusGoalsInMatch'),
+        F.concat(
+            F.floor(minutes / 90).cast('string'), F.lit(' match '), (minutes % 90).cast('string'), F.lit(' mins')
+        ).alias('EstimatedMatchesPlayed'),
+    )
+    no_stats = players.join(totals, 'player_id', 'left_anti').select(
+        'player_id',
+        F.lit(0).cast('long').alias('TotalGoals'),
+        F.lit(0.0).alias('TotalAssists'),
+        F.lit(0.0).alias('AverageMinutesPlayed'),
+        F.lit(0).alias('PlayedOver300Min'),
+        F.lit(0).alias('Scored3PlusGoalsInMatch'),
+        F.lit('0').alias('EstimatedMatchesPlayed'),
+    )
+    view = totals.unionByName(no_stats)
+
+    # 1 for players aged 25 to 30, counted in days / 365 like final_view.age_flags
+    age_in_years = F.datediff(F.current_date(), F.col('birthdate')) / 365
+    ages = players.select('player_id', ((age_in_years >= 25) & (age_in_years <= 30)).cast('int').alias('AgeBetween25And30'))
+    view = view.join(ages, 'player_id', 'left').fillna(0, subset=['AgeBetween25And30'])
+
+    # PlayedIn<Country>: transferred to a team of that country or playing for one now
+    # DateJoined<Country>Team: earliest transfer to a team of that country
+    for country, played_column, joined_column, count_column, join_column in COUNTRY_COLUMNS:
+        transferred = aggregates.filter(F.col(count_column) > 0).select(
+            'player_id', F.lit(True).alias('_transferred'), F.col(join_column).alias(joined_column))
+        country_team_ids = teams.filter(F.col('country') == country).select('team_id')
+        current_players = players.join(country_team_ids, 'team_id', 'left_semi').select(
+            'player_id', F.lit(True).alias('_current'))
+        view = (
+            view.join(transferred, 'player_id', 'left')
+            .join(current_players.distinct(), 'player_id', 'left')
+            .withColumn(played_column, (F.col('_transferred').isNotNull() | F.col('_current').isNotNull()).cast('int'))
+            .drop('_transferred', '_current')
+        )
+
+    view = view.join(players.select('player_id', 'player_name', 'team_id'), 'player_id', 'left')
+    view = view.join(teams.select('team_id', 'team_name'), 'team_id', 'left')
+    return view.select(*FINAL_VIEW_COLUMNS).orderBy('player_id')
+
+
+# Stages
+
+class SparkRun(PipelineRun):
+    # The frames of a PipelineRun are Spark frames here
+
+    def __init__(self, engine, writer, cleaning_log, config, spark):
+        super().__init__(engine, writer, cleaning_log, config)
+        self.spark = spark
+
+
+# Stages return no frames to the instrumentation: counting the rows of every
+# stage would run extra Spark jobs. Row counts are taken once, on the cached
+# raw tables.
+
+def read_csvs(run):
+    for table_name, path in run.config.csv_paths().items():
+        run.csv[table_name] = (
+            run.spark.read.csv(path, header=True, schema=CSV_SCHEMAS[table_name], dateFormat="yyyy-MM-dd",
+                               enforceSchema=False)
+            .withColumnsRenamed(COLUMN_NAMES[table_name])
+            .withColumn(SOURCE_COLUMN, F.lit(1))
+            .withColumn(ROW_COLUMN, F.monotonically_increasing_id())
+            .cache()
+        )
+    return [], []
+
+
+def read_existing(run):
+    # Read now, not when a later stage first uses the frame: a JDBC read is
+    # lazy, and cache() only keeps what the first action computed, which
+    # would come after the raw tables are emptied
+    for table_name in SYNC_ORDER:
+        run.existing[table_name] = (
+            read_table(run.spark, run.engine, table_name)
+            .withColumn(SOURCE_COLUMN, F.lit(0))
+            .withColumn(ROW_COLUMN, F.monotonically_increasing_id())
+            .localCheckpoint(eager=True)
+        )
+    return [], []
+
+
+def merge_synced(run):
+    # If there is an updated row, the updated one is inserted instead of old
+    # If there is a new row, it will be inserted
+    for table_name in SYNC_ORDER:
+        merged = run.existing[table_name].unionByName(run.csv[table_name])
+        run.synced[table_name] = keep_last(merged, TABLE_KEYS[table_name])
+    return [], []
+
+
+def player_history(run):
+    existing_players = run.existing["players"].drop(SOURCE_COLUMN, ROW_COLUMN)
+    players = keep_last(run.csv["players"], 'player_id')
+
+    deleted_players = existing_players.join(players, 'player_id', 'left_anti').withColumn('operation', F.lit('Deleted'))
+    updated_players = changed_rows(existing_players, players, 'player_id').withColumn('operation', F.lit('Updated'))
+
+    history_players = deleted_players.unionByName(updated_players).withColumn(
+        'Time', F.lit(datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    run.writer.write(history_players, "players_history", if_exists="append")
+    return [], []
+
+
+def record_errors(run, errors, id_column, error_table, log_name):
+    errors = errors.orderBy(id_column)
+    run.writer.write(errors, error_table, if_exists='replace')
+    run.cleaning_log.add(errors.toPandas(), id_column, log_name)
+
+
+def check_foreign_keys(run):
+    # get player ids that exist in table players
+    rule_context = {'valid_player_ids': run.existing["players"]}
+
+    invalid_rows, run.synced["transfer_history"] = check(
+        "sync", "transfer_history", run.synced["transfer_history"], rule_context)
+    record_errors(run, invalid_rows, 'trans_id', 'transfer_history_errors', "Player Transfers")
+
+    invalid_player, run.synced["player_stats"] = check(
+        "sync", "player_stats", run.synced["player_stats"], rule_context)
+    record_errors(run, invalid_player, 'stat_id', 'player_stats_errors', "Player Stats")
+    return [], []
+
+
+def reload_raw_tables(run):
+    # The synced tables are computed before the raw tables are emptied, so
+    # nothing of them is read again from the database. They are the raw
+    # tables from here on, no need to read them back.
+    for table_name in SYNC_ORDER:
+        run.raw[table_name] = run.synced[table_name].localCheckpoint(eager=True)
+
+    # First delete data from the tables, children first
+    with run.engine.connect() as connection:
+        with connection.begin():
+            for table_name in reversed(SYNC_ORDER):
+                connection.execute(text(f"DELETE FROM {table_name}"))
+
+    for table_name in SYNC_ORDER:
+        run.writer.write(run.raw[table_name], table_name, if_exists="append")
+    return [], []
+
+
+def validate(run):
+    teams_errors, _ = check("clean", "teams", run.raw["teams"], {'players': run.raw["players"]})
+    record_errors(run, teams_errors, 'team_id', 'teams_errors', "Teams")
+
+    stats_invalid, _ = check("clean", "player_stats", run.raw["player_stats"])
+    record_errors(run, stats_invalid, 'stat_id', 'player_stats_errors', "Player Stats")
+
+    run.raw["player_stats"] = apply_fixes("clean", "player_stats", run.raw["player_stats"]).cache()
+    return [], []
+
+
+def write_cleaning_log(run):
+    run.cleaning_log.write()
+    write_record_comparison(
+        run.config.path("log_file"),
+        {table_name: df.count() for table_name, df in run.csv.items()},
+        {table_name: df.count() for table_name, df in run.raw.items()},
+    )
+    return [], []
+
+
+def load_cleaned_tables(run):
+    with run.engine.connect() as connection:
+        with connection.begin():
+            for table_name in reversed(SYNC_ORDER):
+                connection.execute(text(f"DELETE FROM cleaned_{table_name}"))
+
+    for table_name in SYNC_ORDER:
+        run.writer.write(run.raw[table_name], f"cleaned_{table_name}", if_exists='append')
+    return [], []
+
+
+def build_final_view(run):
+    raw = run.raw
+    aggregates = player_aggregates(raw["player_stats"], raw["teams"], raw["transfer_history"]).cache()
+    final_view = view_from_aggregates(aggregates, raw["players"], raw["teams"]).cache()
+
+    run.writer.write(aggregates, AGGREGATES_TABLE, if_exists='replace')
+    run.writer.write(final_view, 'final_view', if_exists='replace')
+
+    # one row per player, small enough for one file
+    run.final_view = final_view.toPandas()
+    run.final_view.to_csv(run.config.path("final_view_csv"), index=False, header=True)
+    return [], []
+
+
+def build_summaries(run):
+    # The aggregations run in Spark; their per-player and per-team results
+    # are small and are written in one transaction by the pandas writer
+    raw = run.raw
+    totals = raw["player_stats"].groupBy('player_id').agg(
+        F.sum('goals').alias('total_goals'),
+        F.sum('assists').alias('total_assists'),
+        F.sum('mins_played').alias('total_minutes'),
+        F.count(F.lit(1)).alias('stat_rows'),
+    )
+
+    # one row per team and match, home and away side stacked
+    sides = raw["matches"].select(
+        F.col('home_team_id').alias('team_id'), F.lit(True).alias('is_home'),
+        F.col('home_team_score').alias('goals_for'), F.col('away_team_score').alias('goals_against'),
+    ).unionByName(raw["matches"].select(
+        F.col('away_team_id').alias('team_id'), F.lit(False).alias('is_home'),
+        F.col('away_team_score').alias('goals_for'), F.col('home_team_score').alias('goals_against'),
+    ))
+    won = F.col('goals_for') > F.col('goals_against')
+    results = sides.groupBy('team_id').agg(
+        F.count(F.lit(1)).alias('matches_played'),
+        F.sum((won & F.col('is_home')).cast('int')).alias('home_wins'),
+        F.sum((won & ~F.col('is_home')).cast('int')).alias('away_wins'),
+        F.sum((F.col('goals_against') == 0).cast('int')).alias('clean_sheets'),
+    )
+
+    players = raw["players"].select('player_id', 'player_name', 'team_id', 'birthdate').toPandas()
+    teams = raw["teams"].select('team_id', 'team_name', 'country').toPandas()
+    refresh_summary_tables(
+        make_writer(run.engine),
+        player_summary(totals.toPandas(), players, teams),
+        team_summary(results.toPandas(), teams),
+    )
+    return [], []
+
+
+STAGES = [
+    ("read_csvs", read_csvs),
+    ("read_existing", read_existing),
+    ("merge_synced", merge_synced),
+    ("player_history", player_history),
+    ("foreign_keys", check_foreign_keys),
+    ("load_raw", reload_raw_tables),
+    ("validate", validate),
+    ("cleaning_log", write_cleaning_log),
+    ("load_cleaned", load_cleaned_tables),
+    ("final_view", build_final_view),
+    ("summaries", build_summaries),
+]
+
+
+def check_settings(config):
+    # Every run is a full sync without history, whatever the settings ask for
+    if config.sync_apply_deletes:
+        raise ValueError("The Spark backend runs the full sync, which keeps the rows removed from the CSVs; "
+                         "unset sync_apply_deletes or use the pandas backend")
+    if config.sync_mode != "full":
+        logger.warning("The Spark backend runs the full sync, sync_mode %r is ignored", config.sync_mode)
+    if config.track_history:
+        logger.warning("The Spark backend keeps no type-2 history, track_history is ignored")
+
+
+def process_data_task(config=None):
+    # Same interface as league_pipeline.process_data_task; the Spark session
+    # and the engine are kept for the next runs of the process
+    config = config or load_config()
+    check_settings(config)
+    engine = shared_engine(config.database_url)
+    spark = spark_session(config.spark_jars)
+    run = SparkRun(engine, JdbcWriter(engine, spark), open_cleaning_log(config), config, spark)
+    instrumentation = Instrumentation(profiler=config.profiler or None, profile_dir=config.path("profile_dir"))
+
+    try:
+        with instrumentation.profiling():
+            for name, stage in STAGES:
+                instrumentation.run_stage(name, stage, run)
+
+        write_load_report(run)
+
+        instrumentation.rows = {table_name: df.count() for table_name, df in run.raw.items()}
+        instrumentation.rows["rejected"] = len(run.cleaning_log)
+        if config.path("metrics_report") is not None:
+            instrumentation.write_report(config.path("metrics_report"))
+        instrumentation.write_table(run.writer)
+    finally:
+        # free the cached frames of this run, the session stays up for the next one
+        spark.catalog.clearCache()
+
+    # the reports cached before this load are stale now
+    bump_run_generation(engine)
+
+    print("Task executed successfully!")
+    return instrumentation
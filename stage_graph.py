@@ -0,0 +1,78 @@
+# Dependency graph of the pipeline stages
+#
+# A run is a list of named tasks, each with the names of the tasks it needs.
+# Every task whose dependencies are done is submitted to a thread pool, so
+# the reads, syncs and loads of independent tables overlap: they spend their
+# time in the database driver and in pandas, which release the GIL. Ready
+# tasks are submitted in list order, and with a single worker the tasks run
+# one after another in the calling thread. After a failure no new task is
+# started; the error is raised once the running tasks finished.
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Task:
+    name: str
+    # stage(run, *args) -> (input frames, output frames)
+    stage: object
+    # e.g. the table name of a per-table stage
+    args: tuple = ()
+    needs: tuple = ()
+
+
+def table_tasks(name, stage, tables, needs=lambda table_name: ()):
+    # One "<name>:<table>" task per table, with the dependencies needs(table) returns
+    return [Task(f"{name}:{table_name}", stage, (table_name,), tuple(needs(table_name))) for table_name in tables]
+
+
+def check_graph(tasks):
+    # Raises ValueError on duplicated names, unknown dependencies and cycles
+    names = [task.name for task in tasks]
+    duplicated = sorted({name for name in names if names.count(name) > 1})
+    if duplicated:
+        raise ValueError(f"Duplicated tasks: {', '.join(duplicated)}")
+    unknown = sorted({need for task in tasks for need in task.needs if need not in names})
+    if unknown:
+        raise ValueError(f"Unknown dependencies: {', '.join(unknown)}")
+
+    done = set()
+    pending = list(tasks)
+    while pending:
+        ready = [task for task in pending if all(need in done for need in task.needs)]
+        if not ready:
+            raise ValueError(f"Dependency cycle between {', '.join(task.name for task in pending)}")
+        done.update(task.name for task in ready)
+        pending = [task for task in pending if task.name not in done]
+
+
+def run_graph(tasks, run_task, workers=1):
+    # Calls run_task(task) for every task once its dependencies are done
+    check_graph(tasks)
+    if workers == 1:
+        done = set()
+        pending = list(tasks)
+        while pending:
+            task = next(task for task in pending if all(need in done for need in task.needs))
+            run_task(task)
+            done.add(task.name)
+            pending.remove(task)
+        return
+
+    done = set()
+    pending = list(tasks)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stage") as pool:
+        while pending or running:
+            for task in [task for task in pending if all(need in done for need in task.needs)]:
+                pending.remove(task)
+                running[pool.submit(run_task, task)] = task
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                if future.exception() is not None:
+                    # let the running tasks finish, start nothing new
+                    wait(running)
+                    raise future.exception()
+                done.add(task.name)
@@ -0,0 +1,161 @@
+# Chunked streaming of player_stats
+#
+# In "streaming" sync mode player_stats, the largest table, is never held as
+# one frame. Its staged Parquet dataset (the CSV, without staging) and the
+# raw table are read chunk_rows rows at a time, and every chunk is checked,
+# written out and folded into per-player aggregates that combine across
+# chunks (see final_view.STAT_AGGREGATES). Memory grows with the chunk size
+# and the number of players, not with the number of stats: only the stat_id
+# column of the source (to keep the last of duplicated rows), the valid
+# player ids and the rejected rows are held whole.
+
+import pandas as pd
+from sqlalchemy import inspect, text
+
+from final_view import combine_stat_aggregates, stat_aggregates
+from league_schema import apply_schema
+from parquet_staging import read_staged, read_staged_chunks, read_typed_csv_chunks
+from quality_rules import apply_fixes, check
+
+
+TABLE = "player_stats"
+KEY = "stat_id"
+
+# Synced rows, collected while the raw table is still read, then moved into it
+SYNC_TABLE = "player_stats_sync"
+
+
+def numeric_columns(engine, table_name):
+    columns = []
+    for column in inspect(engine).get_columns(table_name):
+        try:
+            if issubclass(column["type"].python_type, (int, float)):
+                columns.append(column["name"])
+        except NotImplementedError:
+            pass
+    return columns
+
+
+def read_table_chunks(engine, table_name, key, chunk_rows):
+    # Pages through a table in key order, one query per chunk, so no cursor
+    # stays open while the chunks are written elsewhere. Yields at least one
+    # (possibly empty) chunk, in the dtypes of league_schema.py.
+    numeric = numeric_columns(engine, table_name)
+    last_key = None
+    while True:
+        condition = "" if last_key is None else f"WHERE {key} > :last_key"
+        chunk = pd.read_sql(
+            text(f"SELECT * FROM {table_name} {condition} ORDER BY {key} LIMIT :chunk_rows"),
+            engine,
+            params={"last_key": last_key, "chunk_rows": chunk_rows},
+        )
+        # a numeric column that is NULL in the whole chunk reads as object
+        chunk = chunk.astype({column: "float64" for column in numeric if chunk[column].isna().all()})
+        yield apply_schema(chunk, table_name)
+        if len(chunk) < chunk_rows:
+            return
+        last_key = int(chunk[key].iloc[-1])
+
+
+def rejected(frames):
+    frames = [frame for frame in frames if not frame.empty]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=[KEY, "reason"])
+
+
+class StatsStream:
+    # The streamed player_stats of one run: row counts, rejected rows and
+    # the per-player stat aggregates of the cleaned rows
+
+    def __init__(self, engine, writer, chunk_rows):
+        self.engine = engine
+        self.writer = writer
+        self.chunk_rows = chunk_rows
+        self.csv_rows = 0
+        self.synced_rows = 0
+        self.cleaned_rows = 0
+        self.aggregates = None
+
+    # Sync
+
+    def sync_csv(self, csv_path, column_names, valid_player_ids):
+        csv_key = next(csv_column for csv_column, column in column_names.items() if column == KEY)
+        keys = pd.read_csv(csv_path, usecols=[csv_key])[csv_key]
+        chunks = read_typed_csv_chunks(csv_path, TABLE, column_names, self.chunk_rows)
+        return self.sync(keys, chunks, valid_player_ids)
+
+    def sync_staged(self, staging_dir, valid_player_ids):
+        # from the dataset staged in chunks by parquet_staging.stage_csvs
+        keys = read_staged(staging_dir, TABLE, columns=[KEY])[KEY]
+        chunks = read_staged_chunks(staging_dir, TABLE, self.chunk_rows)
+        return self.sync(keys, chunks, valid_player_ids)
+
+    def sync(self, keys, chunks, valid_player_ids):
+        # Streams the raw stats, then the source chunks (indexed by CSV row,
+        # keys holding the stat_id of every CSV row), into SYNC_TABLE like
+        # merge_synced and check_foreign_keys_of_tables do in full mode: a
+        # CSV row replaces the raw row with its stat_id, the last of
+        # duplicated CSV rows wins and the rows of unknown players are
+        # rejected. Returns the rejected rows, the CSV rows in CSV order.
+        last_rows = ~keys.duplicated(keep="last").to_numpy()
+        csv_keys = pd.Index(keys.unique())
+
+        # same column types as the raw table, whatever the types of a chunk
+        with self.engine.begin() as connection:
+            connection.execute(text(f"DROP TABLE IF EXISTS {SYNC_TABLE}"))
+            connection.execute(text(f"CREATE TABLE {SYNC_TABLE} AS SELECT * FROM {TABLE} WHERE 1 = 0"))
+
+        context = {'valid_player_ids': valid_player_ids}
+        errors = []
+        for chunk in read_table_chunks(self.engine, TABLE, KEY, self.chunk_rows):
+            errors.append(self.sync_chunk(chunk[~chunk[KEY].isin(csv_keys)], context))
+
+        csv_errors = []
+        for chunk in chunks:
+            self.csv_rows += len(chunk)
+            csv_errors.append(self.sync_chunk(chunk[last_rows[chunk.index]], context))
+        csv_errors = [frame for frame in csv_errors if not frame.empty]
+        if csv_errors:
+            # in CSV order, whatever the order of the chunks
+            errors.append(pd.concat(csv_errors).sort_index(kind="stable"))
+        return rejected(errors)
+
+    def sync_chunk(self, chunk, context):
+        invalid_rows, valid_rows = check("sync", TABLE, chunk, context)
+        self.writer.write(valid_rows, SYNC_TABLE, if_exists="append")
+        self.synced_rows += len(valid_rows)
+        return invalid_rows
+
+    def load_raw(self):
+        # Moves the synced rows into the (emptied) raw table, inside the database
+        with self.engine.begin() as connection:
+            columns = ", ".join(column["name"] for column in inspect(connection).get_columns(SYNC_TABLE))
+            connection.execute(text(f"INSERT INTO {TABLE} ({columns}) SELECT {columns} FROM {SYNC_TABLE}"))
+            connection.execute(text(f"DROP TABLE {SYNC_TABLE}"))
+
+    # Cleaning
+
+    def clean(self, history=None):
+        # Streams the raw stats through the card rules and their fixes into
+        # the (emptied) cleaned table, folding every cleaned chunk into the
+        # aggregates and the raw chunks into history (a history.TableHistory)
+        # if given. Returns the rejected rows.
+        errors = []
+        for chunk in read_table_chunks(self.engine, TABLE, KEY, self.chunk_rows):
+            if history is not None:
+                history.observe(chunk)
+            invalid_rows, _ = check("clean", TABLE, chunk)
+            errors.append(invalid_rows)
+            apply_fixes("clean", TABLE, chunk)
+            self.writer.write(chunk, f"cleaned_{TABLE}", if_exists="append")
+            self.fold(chunk)
+        if history is not None:
+            history.finish()
+        return rejected(errors)
+
+    def fold(self, chunk):
+        self.cleaned_rows += len(chunk)
+        chunk_aggregates = stat_aggregates(chunk)
+        if self.aggregates is None:
+            self.aggregates = chunk_aggregates
+        else:
+            self.aggregates = combine_stat_aggregates([self.aggregates, chunk_aggregates])
@@ -0,0 +1,144 @@
+# Summary tables behind the league reports
+#
+# player_summary (one row per player) and team_summary (one row per team)
+# hold the totals that the reports of "football league analysis.sql"
+# recomputed from the cleaned tables on every query. They are rebuilt at the
+# end of every run from the frames already in memory and replaced in one
+# transaction (in incremental mode only the rows of the touched players and
+# teams are), so a report reads a few hundred indexed rows however long the
+# match history grows. Team results stack the home and away side of every
+# match (UNION ALL) instead of joining on home_team_id OR away_team_id.
+
+import pandas as pd
+from sqlalchemy import Integer, inspect, text
+
+from incremental_sync import delete_keys
+
+
+PLAYER_SUMMARY_TABLE = "player_summary"
+TEAM_SUMMARY_TABLE = "team_summary"
+
+# (index name, table, columns), created if missing after every refresh
+SUMMARY_INDEXES = [
+    ("ix_player_summary_player_id", PLAYER_SUMMARY_TABLE, "player_id"),
+    ("ix_player_summary_team_id", PLAYER_SUMMARY_TABLE, "team_id"),
+    ("ix_player_summary_total_goals", PLAYER_SUMMARY_TABLE, "total_goals"),
+    ("ix_player_summary_total_contributions", PLAYER_SUMMARY_TABLE, "total_contributions"),
+    ("ix_player_summary_total_minutes", PLAYER_SUMMARY_TABLE, "total_minutes"),
+    ("ix_team_summary_team_id", TEAM_SUMMARY_TABLE, "team_id"),
+    ("ix_cleaned_transfer_history_trans_fee", "cleaned_transfer_history", "trans_fee"),
+    ("ix_cleaned_player_stats_player_id", "cleaned_player_stats", "player_id"),
+    ("ix_cleaned_matches_home_team_id", "cleaned_matches", "home_team_id"),
+    ("ix_cleaned_matches_away_team_id", "cleaned_matches", "away_team_id"),
+]
+
+PLAYER_TOTAL_COLUMNS = ['total_goals', 'total_assists', 'total_minutes', 'stat_rows']
+# the player totals that are whole numbers; assists may hold fractions
+PLAYER_COUNT_COLUMNS = ['total_goals', 'total_minutes', 'stat_rows']
+TEAM_RESULT_COLUMNS = ['matches_played', 'home_wins', 'away_wins', 'clean_sheets']
+
+
+# Aggregates
+
+def player_totals(stats):
+    # Stat totals of every player with stats
+    return stats.groupby('player_id').agg(
+        total_goals=('goals', 'sum'),
+        total_assists=('assists', 'sum'),
+        total_minutes=('mins_played', 'sum'),
+        stat_rows=('goals', 'size'),
+    ).reset_index()
+
+
+def player_totals_of_aggregates(aggregates):
+    # player_totals from the per-player stat aggregates of final_view.py
+    return aggregates.rename(columns={
+        'goals': 'total_goals',
+        'assists': 'total_assists',
+        'minutes': 'total_minutes',
+    })[PLAYER_TOTAL_COLUMNS].reset_index()
+
+
+def team_results(matches):
+    # Results of every team that played, from one row per team and match
+    home = pd.DataFrame({
+        'team_id': matches['home_team_id'],
+        'is_home': True,
+        'goals_for': matches['home_team_score'],
+        'goals_against': matches['away_team_score'],
+    })
+    away = pd.DataFrame({
+        'team_id': matches['away_team_id'],
+        'is_home': False,
+        'goals_for': matches['away_team_score'],
+        'goals_against': matches['home_team_score'],
+    })
+    sides = pd.concat([home, away], ignore_index=True)
+    won = sides['goals_for'] > sides['goals_against']
+    return pd.DataFrame({
+        'team_id': sides['team_id'],
+        'home_win': won & sides['is_home'],
+        'away_win': won & ~sides['is_home'],
+        'clean_sheet': sides['goals_against'] == 0,
+    }).groupby('team_id').agg(
+        matches_played=('team_id', 'size'),
+        home_wins=('home_win', 'sum'),
+        away_wins=('away_win', 'sum'),
+        clean_sheets=('clean_sheet', 'sum'),
+    ).reset_index()
+
+
+# Summaries
+
+def player_summary(totals, players, teams):
+    # One row per player, with zero totals for players without stats
+    summary = players[['player_id', 'player_name', 'team_id', 'birthdate']].merge(totals, on='player_id', how='left')
+    # the sums skip missing values
+    summary[PLAYER_TOTAL_COLUMNS] = summary[PLAYER_TOTAL_COLUMNS].fillna(0)
+    summary[PLAYER_COUNT_COLUMNS] = summary[PLAYER_COUNT_COLUMNS].astype('int64')
+    summary['total_assists'] = summary['total_assists'].astype('float64')
+    summary['total_contributions'] = summary['total_goals'] + summary['total_assists']
+    return summary.merge(teams[['team_id', 'team_name']], on='team_id', how='left')
+
+
+def team_summary(results, teams):
+    # One row per team, with zero results for teams without matches
+    summary = teams[['team_id', 'team_name', 'country']].merge(results, on='team_id', how='left')
+    summary[TEAM_RESULT_COLUMNS] = summary[TEAM_RESULT_COLUMNS].fillna(0).astype('int64')
+    return summary
+
+
+def summary_tables_current(bind):
+    # Whether both tables exist, with the float total_assists column of the
+    # tables created since assists may hold fractions
+    inspector = inspect(bind)
+    if not all(inspector.has_table(table_name) for table_name in (PLAYER_SUMMARY_TABLE, TEAM_SUMMARY_TABLE)):
+        return False
+    column_types = {column['name']: column['type'] for column in inspector.get_columns(PLAYER_SUMMARY_TABLE)}
+    return not isinstance(column_types.get('total_assists'), Integer)
+
+
+def refresh_summary_tables(writer, players_summary, teams_summary):
+    # Replace the content of both tables in one transaction, keeping the
+    # tables and their indexes for the readers. Tables of an older layout
+    # are created again.
+    with writer.engine.begin() as connection:
+        current = summary_tables_current(connection)
+        for table_name, summary in ((PLAYER_SUMMARY_TABLE, players_summary), (TEAM_SUMMARY_TABLE, teams_summary)):
+            if current:
+                connection.execute(text(f"DELETE FROM {table_name}"))
+            else:
+                connection.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
+            writer.write(summary, table_name, connection=connection)
+        for index_name, table_name, columns in SUMMARY_INDEXES:
+            connection.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns})"))
+
+
+def refresh_summary_rows(writer, players_summary, player_ids, teams_summary, team_ids):
+    # Replace the rows of the given players and teams (some of them may be
+    # gone) in one transaction
+    with writer.engine.begin() as connection:
+        delete_keys(connection, PLAYER_SUMMARY_TABLE, player_ids, 'player_id')
+        writer.write(players_summary, PLAYER_SUMMARY_TABLE, connection=connection)
+        delete_keys(connection, TEAM_SUMMARY_TABLE, team_ids, 'team_id')
+        writer.write(teams_summary, TEAM_SUMMARY_TABLE, connection=connection)
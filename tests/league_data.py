@@ -0,0 +1,51 @@
+# The dummy workbook as source CSVs, and the raw and cleaned tables the
+# pipeline loads, for the tests that run it
+
+import os
+
+import pandas as pd
+from sqlalchemy import text
+
+from league_schema import SHEETS
+from pipeline_config import CSV_NAMES
+
+
+WORKBOOK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "FootballDummyData.xlsx")
+
+TABLE_COLUMNS = {
+    "teams": "team_id INTEGER PRIMARY KEY, team_name TEXT, founded_year INTEGER, home_city TEXT, "
+             "manager_name TEXT, stadium_name TEXT, stadium_capacity INTEGER, country TEXT",
+    "players": "player_id INTEGER PRIMARY KEY, team_id INTEGER, player_name TEXT, position TEXT, birthdate DATE, "
+               "nationality TEXT, contract_until DATE, market_value BIGINT",
+    "matches": "match_id INTEGER PRIMARY KEY, match_date DATE, home_team_id INTEGER, away_team_id INTEGER, "
+               "home_team_score INTEGER, away_team_score INTEGER, stadium TEXT, referee TEXT",
+    "player_stats": "stat_id INTEGER PRIMARY KEY, player_id INTEGER, match_id INTEGER, goals INTEGER, "
+                    "assists DOUBLE PRECISION, yellow_cards INTEGER, red_cards INTEGER, mins_played INTEGER",
+    "transfer_history": "trans_id INTEGER PRIMARY KEY, player_id INTEGER, from_team_id INTEGER, "
+                        "to_team_id INTEGER, trans_date DATE, trans_fee BIGINT, contract_duration INTEGER",
+}
+
+
+def read_workbook():
+    # {table: sheet} with the dates as ISO text, as in the CSVs
+    sheets = {}
+    for table_name, sheet in SHEETS.items():
+        df = pd.read_excel(WORKBOOK, sheet_name=sheet)
+        for column in df.columns:
+            if df[column].dtype.kind == "M":
+                df[column] = df[column].dt.strftime("%Y-%m-%d")
+        sheets[table_name] = df
+    return sheets
+
+
+def write_csvs(csv_dir, sheets=None):
+    os.makedirs(csv_dir, exist_ok=True)
+    for table_name, df in (sheets or read_workbook()).items():
+        df.to_csv(os.path.join(csv_dir, CSV_NAMES[table_name]), index=False)
+
+
+def create_tables(engine):
+    with engine.begin() as connection:
+        for table_name, columns in TABLE_COLUMNS.items():
+            connection.execute(text(f"CREATE TABLE {table_name} ({columns})"))
+            connection.execute(text(f"CREATE TABLE cleaned_{table_name} ({columns})"))
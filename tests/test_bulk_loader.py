@@ -0,0 +1,125 @@
+# The writers round-trip NULLs, empty and escaped text, dates and integral
+# floats, and upsert by key: TableWriter on SQLite (with and without ON
+# CONFLICT), CopyWriter on PostgreSQL, given LEAGUE_TEST_POSTGRES_URL
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, exc, text
+
+import bulk_loader
+from bulk_loader import CopyWriter, TableWriter, make_writer
+
+
+POSTGRES_URL = os.environ.get("LEAGUE_TEST_POSTGRES_URL")
+
+TABLE = "bulk_loader_test"
+
+COLUMNS = "item_id INTEGER PRIMARY KEY, label TEXT, played_on DATE, goals INTEGER, assists DOUBLE PRECISION"
+
+ROWS = pd.DataFrame({
+    "item_id": [1, 2, 3, 4, 5],
+    "label": ["", None, "tab\there, new\nline\r", "back\\slash \\N", 'comma, "quoted"'],
+    "played_on": pd.to_datetime(["2024-01-31", None, "2023-08-01", "2024-02-29", "2024-05-01"]),
+    # an integer column with a NULL, read as float64
+    "goals": [1.0, np.nan, 0.0, 3.0, 2.0],
+    "assists": [0.5, 1.0, np.nan, 0.0, 2.25],
+})
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def engine(request, tmp_path):
+    if request.param == "sqlite":
+        engine = create_engine(f"sqlite:///{tmp_path / 'league.sqlite'}")
+    elif POSTGRES_URL is None:
+        pytest.skip("LEAGUE_TEST_POSTGRES_URL is not set")
+    else:
+        engine = create_engine(POSTGRES_URL)
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+        connection.execute(text(f"CREATE TABLE {TABLE} ({COLUMNS})"))
+    yield engine
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+    engine.dispose()
+
+
+def as_text(values):
+    # None for NULL, so an empty string is told apart
+    return values.astype(str).astype(object).where(values.notna(), None)
+
+
+def stored(engine):
+    df = pd.read_sql(f"SELECT * FROM {TABLE} ORDER BY item_id", engine)
+    # dates as SQLite stores them: text
+    return df.assign(label=as_text(df["label"]), played_on=as_text(df["played_on"])).astype(
+        {"goals": "Int64", "assists": "float64"})
+
+
+def expected(df):
+    df = df.sort_values("item_id").reset_index(drop=True)
+    return df.assign(label=as_text(df["label"]), played_on=as_text(df["played_on"].dt.strftime("%Y-%m-%d")),
+                     goals=df["goals"].astype("Int64"))
+
+
+def test_make_writer_copies_on_postgresql_only(engine):
+    writer = make_writer(engine)
+    assert type(writer) is (CopyWriter if engine.dialect.name == "postgresql" else TableWriter)
+
+
+def test_write_keeps_nulls_empty_text_and_escapes(engine):
+    writer = make_writer(engine)
+    writer.write(ROWS, TABLE)
+
+    pd.testing.assert_frame_equal(stored(engine), expected(ROWS))
+    assert stored(engine)["label"].tolist()[:2] == ["", None]
+    assert writer.report()[0][:2] == [TABLE, 5]
+
+
+@pytest.mark.parametrize("on_conflict", [True, False], ids=["on-conflict", "delete-insert"])
+def test_upsert_updates_and_inserts_by_key(engine, monkeypatch, on_conflict):
+    writer = make_writer(engine)
+    if not on_conflict:
+        # a dialect without ON CONFLICT
+        monkeypatch.setattr(bulk_loader, "on_conflict_insert", lambda dialect: None)
+        writer = TableWriter(engine)
+    # several batches
+    monkeypatch.setattr(writer, "batch_rows", 2)
+    writer.write(ROWS, TABLE)
+    changes = pd.DataFrame({
+        "item_id": [2, 5, 6],
+        "label": ["", None, "new"],
+        "played_on": pd.to_datetime(["2024-03-01", None, "2024-04-01"]),
+        "goals": [4.0, np.nan, 1.0],
+        "assists": [np.nan, 0.5, 1.5],
+    })
+
+    with engine.begin() as connection:
+        writer.upsert(connection, changes, TABLE, "item_id")
+
+    unchanged = ROWS[~ROWS["item_id"].isin(changes["item_id"])]
+    pd.testing.assert_frame_equal(stored(engine), expected(pd.concat([unchanged, changes])))
+
+
+def test_delete_insert_upserts_roll_back_with_the_transaction(engine, monkeypatch):
+    monkeypatch.setattr(bulk_loader, "on_conflict_insert", lambda dialect: None)
+    writer = TableWriter(engine)
+    writer.write(ROWS, TABLE)
+
+    # the keys are deleted, then the insert fails on a column the table lacks
+    with pytest.raises(exc.DBAPIError):
+        with engine.begin() as connection:
+            writer.upsert(connection, ROWS.assign(unknown=1), TABLE, "item_id")
+
+    pd.testing.assert_frame_equal(stored(engine), expected(ROWS))
+
+
+def test_empty_upserts_write_nothing(engine):
+    writer = make_writer(engine)
+    with engine.begin() as connection:
+        writer.upsert(connection, ROWS.iloc[:0], TABLE, "item_id")
+
+    assert stored(engine).empty
+    assert writer.report() == []
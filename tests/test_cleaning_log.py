@@ -0,0 +1,63 @@
+# The grid of the cleaning log against tabulate, and the log files
+
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+from tabulate import tabulate
+
+from cleaning_log import CleaningLog, render_grid
+
+
+FRAMES = {
+    "log": pd.DataFrame({
+        "Table ID": [1, 22, 333],
+        "Table Name": ["Teams", "Player Stats", "Player Stats"],
+        "Cleaning Reason": ["Team has more than 11 players", " padded ", "a; b"],
+    }),
+    "float ids with NaN": pd.DataFrame({"Table ID": [2.0, np.nan, 13.5], "Table Name": ["a", "b", "c"]}),
+    "whole, large and small floats": pd.DataFrame({"x": [2.0, np.nan, 1e7], "y": [0.001, 1234567.0, -3.25]}),
+    "numbers and text": pd.DataFrame({
+        "Table ID": [1, "x2", 3.0],
+        "numeric text": ["1", "2.5", None],
+        "blanks": ["", "3", None],
+    }),
+    "objects": pd.DataFrame({
+        "ints and None": pd.Series([1, 2, None], dtype=object),
+        "int text": pd.Series(["1", "22", ""], dtype=object),
+    }),
+    "categories": pd.DataFrame({
+        "country": pd.Categorical(["France", "Italy", None]),
+        "int": pd.Categorical([1, 2, None]),
+        "float": pd.Categorical([1.5, 2.0, 2.0]),
+    }),
+    "nullable": pd.DataFrame({
+        "Int64": pd.array([1, None, 3], dtype="Int64"),
+        "bool": [True, False, True],
+        "string": pd.array(["a", None, "c"], dtype="string"),
+    }),
+    "dates": pd.DataFrame({"date": pd.to_datetime(["2024-01-01", None]), "n": [1, 2]}),
+    "overflowing text": pd.DataFrame({"x": ["1e99999", "inf", "-5"], "y": [float("inf"), 1.0, 2.0]}),
+    "ints only": pd.DataFrame({"a": [1, 2], "b": [30, 4]}),
+    "empty": pd.DataFrame(columns=["Table ID", "Table Name", "Cleaning Reason"]),
+}
+
+
+@pytest.mark.parametrize("df", FRAMES.values(), ids=FRAMES.keys())
+def test_render_grid_matches_tabulate(df):
+    assert render_grid(df) == tabulate(df, headers="keys", tablefmt="grid", showindex=False)
+
+
+def test_write_renders_and_records_every_rejection(tmp_path):
+    log = CleaningLog(str(tmp_path / "cleaning.log"), records_path=str(tmp_path / "cleaning.jsonl"))
+    log.add(pd.DataFrame({"stat_id": [5, 7], "reason": ["r1", "r2"]}), "stat_id", "Player Stats")
+    log.add(pd.DataFrame({"team_id": [3]}), "team_id", "Teams", reason="too many players")
+    log.write()
+
+    assert len(log) == 3
+    assert (tmp_path / "cleaning.log").read_text() == "Data Cleaning Log\n" + tabulate(
+        log.frame(), headers="keys", tablefmt="grid", showindex=False)
+    records = [json.loads(line) for line in (tmp_path / "cleaning.jsonl").read_text().splitlines()]
+    assert [(record["table_id"], record["table_name"], record["reason"]) for record in records] == [
+        (5, "Player Stats", "r1"), (7, "Player Stats", "r2"), (3, "Teams", "too many players")]
@@ -0,0 +1,294 @@
+# final_view builder against the groupby/lambda code it replaced, and its
+# incremental refresh against a rebuild, on the dummy workbook
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sqlalchemy import create_engine, text
+
+from bulk_loader import make_writer
+from final_view import (
+    AGGREGATES_TABLE, FINAL_VIEW_COLUMNS, build_final_view, needs_rebuild, old_rows, player_aggregates,
+    rebuild_final_view, refresh_final_view, stat_changes, touched_players,
+)
+from incremental_sync import SYNC_ORDER, TABLE_KEYS, apply_changes, diff_table, load_state
+from league_data import create_tables, read_workbook
+from league_schema import COLUMN_NAMES, apply_schema
+
+
+NOW = datetime(2025, 3, 27, 10, 0)
+
+
+def baseline_final_view(stats_df_new, players_df_new, teams_df_new, transfers_df_new, now):
+    # The view of the original process_data_task, with datetime.now() as a
+    # parameter. The original assigned the age flags of players_df_new to the
+    # view rows by row position; they are joined by player_id here, as the
+    # builder does.
+    age_flags = players_df_new.set_index('player_id')['birthdate'].apply(
+        lambda x: 1 if 25 <= (now - pd.to_datetime(x)).days / 365 <= 30 else 0)
+
+    stats_aggregated_df = stats_df_new.groupby('player_id').agg(
+        TotalGoals=('goals', 'sum'),
+        TotalAssists=('assists', 'sum'),
+        TotalMinutesPlayed=('mins_played', 'sum'),
+        AverageMinutesPlayed=('mins_played','mean'),
+        PlayedOver300Min=('mins_played', lambda x: 1 if x.sum() > 300 else 0),
+        Scored3PlusGoalsInMatch=('goals', lambda x: 1 if (x >= 3).sum() > 0 else 0),
+        EstimatedMatchesPlayed=('mins_played', lambda x: x.sum() // 90),
+    ).reset_index()
+
+    stats_aggregated_df['EstimatedMatchesPlayed'] = stats_aggregated_df['EstimatedMatchesPlayed'].astype(str) + ' match ' + \
+                                                    (stats_aggregated_df['TotalMinutesPlayed'] % 90).astype(str) + ' mins'
+
+    stats_aggregated_df['AgeBetween25And30'] = stats_aggregated_df['player_id'].map(age_flags)
+
+    final_view = stats_aggregated_df.copy()
+
+    players_with_no_stats = players_df_new[~players_df_new['player_id'].isin(stats_aggregated_df['player_id'])]
+    no_stats_view=pd.DataFrame()
+    no_stats_view['player_id'] = players_with_no_stats['player_id']
+    no_stats_view['TotalGoals']=0
+    no_stats_view['TotalAssists']=0
+    no_stats_view['TotalMinutesPlayed']=0
+    no_stats_view['AverageMinutesPlayed']=0
+    no_stats_view['PlayedOver300Min']=0
+    no_stats_view['Scored3PlusGoalsInMatch']=0
+    no_stats_view['EstimatedMatchesPlayed']=0
+    no_stats_view['AgeBetween25And30']= no_stats_view['player_id'].map(age_flags)
+
+    final_view = pd.concat([final_view, no_stats_view], ignore_index=True)
+
+    france_teams = teams_df_new[teams_df_new['country'] == 'France']
+    italy_teams = teams_df_new[teams_df_new['country'] == 'Italy']
+
+    player_transfers = transfers_df_new.merge(players_df_new, on='player_id', how='left')
+
+    france_transfers = player_transfers[player_transfers['to_team_id'].isin(france_teams['team_id'])]
+    italy_transfers = player_transfers[player_transfers['to_team_id'].isin(italy_teams['team_id'])]
+
+    current_france_players = players_df_new[players_df_new['team_id'].isin(france_teams['team_id'])]
+    current_italy_players = players_df_new[players_df_new['team_id'].isin(italy_teams['team_id'])]
+
+    final_view['PlayedInFrance'] = final_view['player_id'].isin(france_transfers['player_id']) | final_view['player_id'].isin(current_france_players['player_id'])
+    final_view['PlayedInFrance'] = final_view['PlayedInFrance'].astype(int)
+    final_view['DateJoinedFrenchTeam'] = final_view['player_id'].map(
+        france_transfers.groupby('player_id')['trans_date'].min().to_dict()
+    )
+
+    final_view['PlayedInItaly'] = final_view['player_id'].isin(italy_transfers['player_id']) | final_view['player_id'].isin(current_italy_players['player_id'])
+    final_view['PlayedInItaly'] = final_view['PlayedInItaly'].astype(int)
+    final_view['DateJoinedItalianTeam'] = final_view['player_id'].map(
+        italy_transfers.groupby('player_id')['trans_date'].min().to_dict()
+    )
+
+    final_view = final_view.merge(players_df_new[['player_id', 'player_name','team_id']], on='player_id', how='left')
+    final_view = final_view.merge(teams_df_new[['team_id','team_name']], left_on='team_id', right_on='team_id', how='left')
+
+    return final_view[FINAL_VIEW_COLUMNS]
+
+
+@pytest.fixture(scope="module")
+def workbook():
+    # The sheets as the sync leaves them: database column names, ISO text
+    # dates, the last row of every key
+    tables = {}
+    for table_name, df in read_workbook().items():
+        df = df.rename(columns=COLUMN_NAMES[table_name])
+        tables[table_name] = df.drop_duplicates(subset=TABLE_KEYS[table_name], keep="last").reset_index(drop=True)
+    return tables
+
+
+def comparable(view):
+    view = view.sort_values('player_id').reset_index(drop=True)
+    for column in ('DateJoinedFrenchTeam', 'DateJoinedItalianTeam'):
+        view[column] = pd.to_datetime(view[column]).astype('datetime64[s]')
+    view['EstimatedMatchesPlayed'] = view['EstimatedMatchesPlayed'].astype(str)
+    view['player_name'] = view['player_name'].astype(str)
+    view['team_name'] = view['team_name'].astype(str)
+    return view
+
+
+def assert_same_view(tables, now=NOW):
+    expected = baseline_final_view(
+        tables["player_stats"], tables["players"], tables["teams"], tables["transfer_history"], now)
+    typed = {table_name: apply_schema(df, table_name) for table_name, df in tables.items()}
+    view = build_final_view(
+        typed["player_stats"], typed["players"], typed["teams"], typed["transfer_history"], now)
+
+    assert list(view.columns) == FINAL_VIEW_COLUMNS
+    pd.testing.assert_frame_equal(comparable(view), comparable(expected), check_dtype=False)
+
+
+def test_workbook(workbook):
+    assert_same_view(workbook)
+
+
+@pytest.mark.parametrize("now", [datetime(2020, 1, 1), datetime(2030, 6, 30, 23, 59)])
+def test_age_flags_on_other_days(workbook, now):
+    assert_same_view(workbook, now)
+
+
+def test_missing_values_and_players_without_stats(workbook):
+    tables = dict(workbook)
+    stats = tables["player_stats"].copy()
+    stats.loc[stats.index[::7], 'mins_played'] = np.nan
+    stats.loc[stats.index[::5], 'assists'] = np.nan
+    # every stat of the first ten players gone
+    tables["player_stats"] = stats[~stats['player_id'].isin(tables["players"]['player_id'].iloc[:10])]
+    assert_same_view(tables)
+
+
+def test_age_bounds(workbook):
+    tables = dict(workbook)
+    players = tables["players"].copy()
+    # exactly 25 and 30 years of 365 days, and one day outside either bound
+    days = [25 * 365, 30 * 365, 25 * 365 - 1, 30 * 365 + 1]
+    players.loc[players.index[:4], 'birthdate'] = [
+        (NOW - pd.Timedelta(days=age_days)).strftime("%Y-%m-%d") for age_days in days]
+    tables["players"] = players
+    assert_same_view(tables)
+
+
+# Incremental refresh
+
+VIEW_TABLES = ("player_stats", "players", "teams", "transfer_history")
+
+
+def stored_tables(engine):
+    # The view inputs as the raw tables hold them
+    return [apply_schema(pd.read_sql_table(table_name, engine), table_name) for table_name in VIEW_TABLES]
+
+
+def sync(writer, tables, apply_deletes=False):
+    changes = {table_name: diff_table(table_name, tables[table_name], load_state(writer.engine, table_name))
+               for table_name in SYNC_ORDER}
+    apply_changes(writer, changes, apply_deletes=apply_deletes)
+    return changes
+
+
+@pytest.fixture
+def stored(workbook, tmp_path):
+    # Database holding the workbook tables, their sync state and their view
+    engine = create_engine(f"sqlite:///{tmp_path / 'league.sqlite'}")
+    create_tables(engine)
+    writer = make_writer(engine)
+    sync(writer, workbook)
+    rebuild_final_view(writer, *stored_tables(engine), now=NOW)
+    yield writer
+    engine.dispose()
+
+
+def stored_view(engine, table_name):
+    df = pd.read_sql_table(table_name, engine)
+    return df.sort_values('player_id').reset_index(drop=True)
+
+
+def refresh(writer, tables, apply_deletes=False):
+    # Sync tables incrementally and refresh the view of the touched players,
+    # as an incremental run does; returns the touched players
+    engine = writer.engine
+    changes = {table_name: diff_table(table_name, tables[table_name], load_state(engine, table_name))
+               for table_name in SYNC_ORDER}
+    old = old_rows(engine, changes)
+    touched = touched_players(engine, changes, old)
+    changed_stats = stat_changes(changes["player_stats"], old["player_stats"], apply_deletes)
+    apply_changes(writer, changes, apply_deletes=apply_deletes)
+    refresh_final_view(writer, touched, changed_stats, *stored_tables(engine)[1:], now=NOW)
+    return touched
+
+
+def assert_refreshed_like_rebuilt(writer, tables, apply_deletes=False):
+    before = stored_view(writer.engine, 'final_view')
+    touched = refresh(writer, tables, apply_deletes)
+    stats, players, teams, transfers = stored_tables(writer.engine)
+
+    expected = build_final_view(stats, players, teams, transfers, NOW)
+    refreshed = stored_view(writer.engine, 'final_view')
+    pd.testing.assert_frame_equal(comparable(refreshed), comparable(expected), check_dtype=False)
+    aggregates = player_aggregates(stats, teams, transfers)
+    pd.testing.assert_frame_equal(
+        stored_view(writer.engine, AGGREGATES_TABLE).astype(str),
+        aggregates.sort_values('player_id').reset_index(drop=True).astype(str),
+    )
+    # the edit changed the view, for the touched players only
+    changed = refreshed.compare(before) if len(refreshed) == len(before) else refreshed
+    assert len(changed)
+    assert set(refreshed.loc[changed.index, 'player_id']) <= set(touched)
+    return touched
+
+
+def test_refresh_after_lowering_the_max_goals_of_a_player(workbook, stored):
+    tables = dict(workbook)
+    stats = tables["player_stats"].copy()
+    # the stat of the player's best match: the max goals come from another stat now
+    best = stats.loc[stats.groupby('player_id')['goals'].idxmax()].sort_values('goals').iloc[-1]
+    stats.loc[stats['stat_id'] == best['stat_id'], 'goals'] = 0
+    tables["player_stats"] = stats
+
+    assert best['player_id'] in assert_refreshed_like_rebuilt(stored, tables)
+
+
+def test_refresh_after_moving_a_stat_to_another_player(workbook, stored):
+    tables = dict(workbook)
+    stats = tables["player_stats"].copy()
+    moved = stats.index[stats['goals'] > 0][0]
+    old_player = stats.loc[moved, 'player_id']
+    new_player = stats.loc[stats['player_id'] != old_player, 'player_id'].iloc[0]
+    stats.loc[moved, 'player_id'] = new_player
+    tables["player_stats"] = stats
+
+    assert {old_player, new_player} <= set(assert_refreshed_like_rebuilt(stored, tables))
+
+
+@pytest.mark.parametrize("apply_deletes", [False, True])
+def test_refresh_after_deleting_stats(workbook, stored, apply_deletes):
+    tables = dict(workbook)
+    stats = tables["player_stats"]
+    # every stat of one player, and a stat of another below its best match,
+    # which is subtracted from the stored aggregates
+    first_player = stats['player_id'].iloc[0]
+    others = stats[stats['player_id'] != first_player]
+    below_best = others[others['goals'] < others.groupby('player_id')['goals'].transform('max')].iloc[0]
+    tables["player_stats"] = stats[(stats['player_id'] != first_player) & (stats['stat_id'] != below_best['stat_id'])]
+
+    if apply_deletes:
+        touched = assert_refreshed_like_rebuilt(stored, tables, True)
+        assert {first_player, below_best['player_id']} <= set(touched)
+    else:
+        # the stats stay in the raw table, and so in the view
+        before = stored_view(stored.engine, 'final_view')
+        refresh(stored, tables)
+        pd.testing.assert_frame_equal(stored_view(stored.engine, 'final_view'), before)
+        expected = build_final_view(*stored_tables(stored.engine), NOW)
+        pd.testing.assert_frame_equal(comparable(before), comparable(expected), check_dtype=False)
+
+
+def test_refresh_after_changing_the_country_of_a_team(workbook, stored):
+    tables = dict(workbook)
+    teams = tables["teams"].copy()
+    french = teams.index[teams['country'] == 'France'][0]
+    teams.loc[french, 'country'] = 'Italy'
+    tables["teams"] = teams
+
+    team_id = teams.loc[french, 'team_id']
+    players = tables["players"]
+    transfers = tables["transfer_history"]
+    team_players = set(players.loc[players['team_id'] == team_id, 'player_id'])
+    team_players |= set(transfers.loc[transfers['to_team_id'] == team_id, 'player_id'])
+    assert team_players <= set(assert_refreshed_like_rebuilt(stored, tables))
+
+
+def test_the_day_of_the_last_rebuild_is_kept_in_the_database(stored):
+    engine = stored.engine
+    assert not needs_rebuild(engine)
+    # another process, or this one restarted
+    other = create_engine(engine.url)
+    assert not needs_rebuild(other)
+
+    with engine.begin() as connection:
+        connection.execute(text("UPDATE final_view_rebuild SET rebuilt_on = '2000-01-01'"))
+    assert needs_rebuild(other)
+    other.dispose()
@@ -0,0 +1,132 @@
+# Type-2 history of the raw tables: versions opened and closed by reloads,
+# and the hashes of rows read from CSVs and from the database
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+import history
+from bulk_loader import make_writer
+from history import HASH_COLUMN, VALID_FROM, VALID_TO, TableHistory, content_hashes, history_table, track_history
+from league_data import create_tables, read_workbook, write_csvs
+from league_schema import COLUMN_NAMES, apply_schema
+from parquet_staging import read_typed_csv
+from pipeline_config import CSV_NAMES
+
+
+FIRST, SECOND, THIRD = datetime(2024, 1, 1), datetime(2024, 2, 1), datetime(2024, 3, 1)
+
+
+def teams(rows):
+    return pd.DataFrame(rows, columns=["team_id", "team_name", "country"])
+
+
+TEAMS = teams([(1, "Lions", "France"), (2, "Eagles", "Italy"), (3, "Bears", "Spain")])
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'league.sqlite'}")
+    create_tables(engine)
+    yield engine
+    engine.dispose()
+
+
+def versions(engine):
+    df = pd.read_sql(f"SELECT team_id, team_name, {VALID_FROM}, {VALID_TO} FROM {history_table('teams')} "
+                     f"ORDER BY team_id, {VALID_FROM}", engine, parse_dates=[VALID_FROM, VALID_TO])
+    return [(row.team_id, row.team_name, row.valid_from.to_pydatetime(),
+             None if pd.isna(row.valid_to) else row.valid_to.to_pydatetime()) for row in df.itertuples()]
+
+
+def reload(engine, df, now, keys=None):
+    return track_history(engine, make_writer(engine), "teams", df, now, keys)
+
+
+def test_an_unchanged_reload_adds_no_versions(engine):
+    reload(engine, TEAMS, FIRST)
+    first = versions(engine)
+
+    # other dtypes and row order, same content
+    written = reload(engine, TEAMS.astype({"team_id": "int32", "country": "category"}).iloc[::-1], SECOND)
+
+    assert written.empty
+    assert versions(engine) == first == [(1, "Lions", FIRST, None), (2, "Eagles", FIRST, None),
+                                         (3, "Bears", FIRST, None)]
+
+
+def test_a_changed_row_closes_its_version_and_opens_a_new_one(engine):
+    reload(engine, TEAMS, FIRST)
+    reload(engine, teams([(1, "Lions", "France"), (2, "Eagles FC", "Italy"), (3, "Bears", "Spain")]), SECOND)
+    reload(engine, teams([(1, "Lions", "France"), (2, "Eagles", "Italy"), (3, "Bears", "Spain")]), THIRD)
+
+    assert versions(engine) == [
+        (1, "Lions", FIRST, None),
+        (2, "Eagles", FIRST, SECOND),
+        (2, "Eagles FC", SECOND, THIRD),
+        # back to an older content: a new version, the old one stays closed
+        (2, "Eagles", THIRD, None),
+        (3, "Bears", FIRST, None),
+    ]
+
+
+def test_a_removed_row_only_closes(engine):
+    reload(engine, TEAMS, FIRST)
+    history_of_teams = TableHistory(engine, make_writer(engine), "teams", SECOND)
+    history_of_teams.observe(TEAMS[TEAMS["team_id"] != 3])
+
+    assert history_of_teams.finish() == {"inserted": 0, "updated": 0, "deleted": 1}
+    assert versions(engine) == [(1, "Lions", FIRST, None), (2, "Eagles", FIRST, None), (3, "Bears", FIRST, SECOND)]
+
+    # and comes back as a new version
+    reload(engine, TEAMS, THIRD)
+    assert versions(engine)[-2:] == [(3, "Bears", FIRST, SECOND), (3, "Bears", THIRD, None)]
+
+
+def test_keys_limit_the_history_to_those_rows(engine, monkeypatch):
+    monkeypatch.setattr(history, "CLOSE_BATCH_ROWS", 1)
+    reload(engine, TEAMS, FIRST)
+
+    # an incremental run: team 2 changed and team 3 was deleted, team 1 was not read
+    reload(engine, teams([(2, "Eagles FC", "Italy")]), SECOND, keys=pd.Index([2, 3]))
+
+    assert versions(engine) == [(1, "Lions", FIRST, None), (2, "Eagles", FIRST, SECOND),
+                                (2, "Eagles FC", SECOND, None), (3, "Bears", FIRST, SECOND)]
+
+
+def test_chunks_add_up_to_the_whole_table(engine):
+    reload(engine, TEAMS, FIRST)
+    chunked = TableHistory(engine, make_writer(engine), "teams", SECOND)
+    chunked.observe(teams([(1, "Lions", "France"), (2, "Eagles FC", "Italy")]))
+    chunked.observe(teams([(4, "Wolves", "Germany")]))
+
+    assert chunked.finish() == {"inserted": 1, "updated": 1, "deleted": 1}
+    current = pd.read_sql(f"SELECT team_id, {HASH_COLUMN} FROM {history_table('teams')} WHERE {VALID_TO} IS NULL "
+                          "ORDER BY team_id", engine)
+    expected = teams([(1, "Lions", "France"), (2, "Eagles FC", "Italy"), (4, "Wolves", "Germany")])
+    assert current["team_id"].tolist() == [1, 2, 4]
+    assert current[HASH_COLUMN].tolist() == content_hashes(expected, "team_id").tolist()
+
+
+@pytest.mark.parametrize("table_name", list(CSV_NAMES))
+def test_csv_and_database_reads_of_a_row_hash_the_same(engine, tmp_path, table_name):
+    sheets = read_workbook()
+    # a missing value turns an integer column float in one read and not the other
+    sheets[table_name].iloc[0, -1] = np.nan
+    write_csvs(tmp_path, sheets)
+    key = list(COLUMN_NAMES[table_name].values())[0]
+    csv = read_typed_csv(tmp_path / CSV_NAMES[table_name], table_name, COLUMN_NAMES[table_name])
+    csv = csv.drop_duplicates(subset=key, keep="last")
+    make_writer(engine).write(csv, table_name, if_exists="append")
+
+    stored = pd.read_sql(f"SELECT * FROM {table_name}", engine)
+
+    expected = content_hashes(csv, key)
+    pd.testing.assert_series_equal(content_hashes(apply_schema(stored, table_name), key), expected,
+                                   check_index_type=False)
+    # columns in another order and dates as text, as read without the schema
+    pd.testing.assert_series_equal(content_hashes(stored[stored.columns[::-1]], key), expected,
+                                   check_index_type=False)
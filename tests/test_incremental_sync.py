@@ -0,0 +1,230 @@
+# Change sets of the incremental sync, and incremental runs of the pipeline
+# against full runs over the same CSVs, on SQLite
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+import incremental_sync
+from bulk_loader import make_writer
+from incremental_sync import STATE_TABLE, apply_changes, diff_table, load_state, row_hashes, save_state
+from league_data import TABLE_COLUMNS, create_tables, read_workbook, write_csvs
+from pipeline_config import load_config, shared_engine
+
+
+def teams(rows):
+    return pd.DataFrame(rows, columns=["team_id", "team_name", "country"])
+
+
+TEAMS = teams([(1, "Lions", "France"), (2, "Eagles", "Italy"), (3, "Bears", "Spain")])
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'league.sqlite'}")
+    create_tables(engine)
+    yield engine
+    engine.dispose()
+
+
+def stored(engine, table_name, key):
+    return pd.read_sql(f"SELECT * FROM {table_name} ORDER BY {key}", engine)
+
+
+# Hashes and change sets
+
+def test_row_hashes_do_not_depend_on_dtypes():
+    df = pd.DataFrame({
+        "stat_id": [1, 2],
+        "goals": [3, 0],
+        "position": ["Forward", "Goalkeeper"],
+        "match_date": pd.to_datetime(["2024-01-01", "2024-02-01"]),
+    })
+    other = df.astype({"stat_id": "int32", "goals": "float64", "position": "category"})
+    other["match_date"] = other["match_date"].astype("datetime64[s]")
+
+    pd.testing.assert_series_equal(row_hashes(other, "stat_id"), row_hashes(df, "stat_id"), check_index_type=False)
+    # a missing value turns an integer column float without changing the other rows
+    with_missing = pd.concat([df, pd.DataFrame({"stat_id": [3], "goals": [np.nan]})], ignore_index=True)
+    assert (row_hashes(with_missing, "stat_id")[[1, 2]] == row_hashes(df, "stat_id")).all()
+
+
+def test_diff_table_finds_inserts_updates_and_deletes():
+    state = row_hashes(TEAMS, "team_id")
+    csv = teams([
+        (1, "Lions", "France"),
+        (2, "Old Eagles", "Italy"),
+        (2, "Eagles FC", "Italy"),
+        (4, "Wolves", "Germany"),
+    ])
+
+    changes = diff_table("teams", csv, state)
+
+    assert changes.inserts["team_id"].tolist() == [4]
+    # the last row of a duplicated key wins
+    assert changes.updates["team_name"].tolist() == ["Eagles FC"]
+    assert changes.deletes.tolist() == [3]
+    assert sorted(changes.hashes.index) == [2, 4]
+    assert len(changes) == 3
+    assert len(diff_table("teams", TEAMS, state)) == 0
+
+
+def test_drop_keys_keeps_rows_out_of_the_state():
+    changes = diff_table("teams", teams([(1, "Lions", "France"), (4, "Wolves", "Germany")]), row_hashes(TEAMS, "team_id"))
+    changes.drop_keys(pd.Index([4]))
+
+    assert changes.inserts.empty
+    assert list(changes.hashes.index) == []
+    # deletes are not rows of the CSV and stay
+    assert sorted(changes.deletes) == [2, 3]
+
+
+def test_save_state_replaces_the_hashes_of_changed_and_deleted_keys(engine, monkeypatch):
+    # several statements per IN list
+    monkeypatch.setattr(incremental_sync, "KEY_BATCH_ROWS", 2)
+    writer = make_writer(engine)
+    load_state(engine, "teams")
+    with engine.begin() as connection:
+        save_state(writer, connection, diff_table("teams", TEAMS, load_state(engine, "teams")))
+    pd.testing.assert_series_equal(load_state(engine, "teams").sort_index(), row_hashes(TEAMS, "team_id"))
+
+    csv = teams([(1, "Lions", "France"), (2, "Eagles FC", "Italy"), (4, "Wolves", "Germany")])
+    with engine.begin() as connection:
+        save_state(writer, connection, diff_table("teams", csv, load_state(engine, "teams")))
+    pd.testing.assert_series_equal(load_state(engine, "teams").sort_index(), row_hashes(csv, "team_id"))
+    assert pd.read_sql(f"SELECT COUNT(*) AS n FROM {STATE_TABLE}", engine)["n"].item() == 3
+
+
+@pytest.mark.parametrize("apply_deletes", [False, True])
+def test_apply_changes_inserts_updates_and_deletes(engine, monkeypatch, apply_deletes):
+    monkeypatch.setattr(incremental_sync, "KEY_BATCH_ROWS", 2)
+    writer = make_writer(engine)
+    apply_changes(writer, {"teams": diff_table("teams", TEAMS, load_state(engine, "teams"))})
+    csv = teams([(1, "Lions", "France"), (2, "Eagles FC", "Italy"), (4, "Wolves", "Germany")])
+
+    changes = diff_table("teams", csv, load_state(engine, "teams"))
+    apply_changes(writer, {"teams": changes}, apply_deletes=apply_deletes)
+
+    expected = teams([(1, "Lions", "France"), (2, "Eagles FC", "Italy"), (3, "Bears", "Spain"),
+                      (4, "Wolves", "Germany")])
+    if apply_deletes:
+        expected = expected[expected["team_id"] != 3].reset_index(drop=True)
+    actual = stored(engine, "teams", "team_id")[list(expected.columns)]
+    pd.testing.assert_frame_equal(actual, expected)
+    # the deleted row leaves the state either way
+    assert sorted(load_state(engine, "teams").index) == [1, 2, 4]
+    assert len(diff_table("teams", csv, load_state(engine, "teams"))) == 0
+
+
+# Pipeline runs
+
+COMPARED_TABLES = [
+    *TABLE_COLUMNS,
+    *[f"cleaned_{table_name}" for table_name in TABLE_COLUMNS],
+    "teams_errors", "player_stats_errors", "transfer_history_errors",
+    "final_view", "final_view_aggregates", "player_summary", "team_summary",
+]
+
+
+def edited(sheets):
+    # One cycle of edits of every kind, and the stat of a player added in
+    # the same cycle, which the foreign key check rejects until the player
+    # is stored
+    sheets = {table_name: df.copy() for table_name, df in sheets.items()}
+    players, stats = sheets["players"], sheets["player_stats"]
+    transfers, matches, league_teams = sheets["transfer_history"], sheets["matches"], sheets["teams"]
+
+    players.loc[players["PlayerID"] == 1, "MarketValue"] += 1
+    # the first team loses players until it is small enough
+    first_team = players["TeamID"].iloc[0]
+    players.loc[players.index[players["TeamID"] == first_team][5:], "TeamID"] = players["TeamID"].max()
+    new_player = players.iloc[:1].assign(PlayerID=players["PlayerID"].max() + 1, TeamID=players["TeamID"].max())
+
+    max_goals = stats.groupby("PlayerID")["Goals"].idxmax()
+    stats.loc[max_goals.iloc[0], "Goals"] -= 1
+    stats.loc[stats.index[3], "RedCards"] = 3
+    stats.loc[stats.index[5], "PlayerID"] = stats.loc[stats.index[6], "PlayerID"]
+    stats = stats[~stats["StatID"].isin(stats["StatID"].iloc[[10, 11]])]
+    new_stats = stats.iloc[:2].assign(StatID=stats["StatID"].max() + 1 + np.arange(2), Goals=[5, 0])
+    new_stats.loc[new_stats.index[1], "PlayerID"] = new_player["PlayerID"].item()
+
+    # a team neither of the moved players had
+    other_team = ~league_teams["TeamID"].isin([first_team, players["TeamID"].max()])
+    league_teams.loc[other_team.idxmax(), "Country"] = "Italy"
+    matches.loc[matches.index[0], "HomeTeamScore"] += 3
+
+    sheets.update(
+        players=pd.concat([players, new_player]),
+        player_stats=pd.concat([stats, new_stats]),
+        transfer_history=transfers[transfers["TransferID"] != transfers["TransferID"].iloc[0]],
+        matches=matches[matches["MatchID"] != matches["MatchID"].iloc[-1]],
+    )
+    return sheets, new_stats["StatID"].iloc[1]
+
+
+def run_pipeline(data_dir, sheets, **settings):
+    import league_pipeline
+
+    config = load_config(environ={}, database_url=f"sqlite:///{data_dir / 'league.sqlite'}", data_dir=str(data_dir),
+                         **settings)
+    write_csvs(config.path("csv_dir"), sheets)
+    engine = shared_engine(config.database_url)
+    if not engine.dialect.has_table(engine.connect(), "teams"):
+        create_tables(engine)
+    return league_pipeline.process_data_task(config), engine
+
+
+def comparable(df):
+    columns = sorted(df.columns)
+    df = df[columns].astype(str).sort_values(columns)
+    return df.reset_index(drop=True)
+
+
+def assert_same_tables(actual_engine, expected_engine):
+    for table_name in COMPARED_TABLES:
+        pd.testing.assert_frame_equal(
+            comparable(pd.read_sql_table(table_name, actual_engine)),
+            comparable(pd.read_sql_table(table_name, expected_engine)),
+            obj=table_name,
+        )
+
+
+def stat_ids(engine):
+    return set(pd.read_sql(text("SELECT stat_id FROM player_stats"), engine)["stat_id"])
+
+
+def test_incremental_runs_match_full_runs(tmp_path):
+    workbook = read_workbook()
+    changed, new_stat = edited(workbook)
+    cycles = [workbook, workbook, changed, changed]
+
+    for cycle, sheets in enumerate(cycles):
+        instrumentation, incremental = run_pipeline(tmp_path / "incremental", sheets, sync_mode="incremental")
+        _, full = run_pipeline(tmp_path / "full", sheets, sync_mode="full")
+        assert_same_tables(incremental, full)
+        if cycle == 2:
+            # rejected, as its player was not stored yet
+            assert new_stat not in stat_ids(incremental)
+
+    # checked again and loaded by the next cycle
+    assert new_stat in stat_ids(incremental)
+
+    # nothing changed: nothing is read back after the sync
+    instrumentation, _ = run_pipeline(tmp_path / "incremental", changed, sync_mode="incremental")
+    assert "load_raw" in instrumentation.stages
+    assert not [stage for stage in instrumentation.stages if stage.startswith("read_raw")]
+
+
+def test_incremental_runs_with_deletes_match_a_full_load(tmp_path):
+    # With the deletes applied the raw tables hold the CSVs, as two full
+    # runs (the second loads what the first rejected) into an empty database
+    workbook = read_workbook()
+    changed, _ = edited(workbook)
+    for sheets in [workbook, workbook, changed, changed]:
+        _, incremental = run_pipeline(tmp_path / "incremental", sheets, sync_mode="incremental",
+                                      sync_apply_deletes=True)
+    for sheets in [changed, changed]:
+        _, full = run_pipeline(tmp_path / "full", sheets, sync_mode="full")
+
+    assert_same_tables(incremental, full)
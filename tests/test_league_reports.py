@@ -0,0 +1,261 @@
+# The report cache and its run generation, and the parameterized reports
+# against the queries of "football league analysis.sql" on the dummy
+# workbook, on SQLite (and PostgreSQL, given LEAGUE_TEST_POSTGRES_URL)
+
+import os
+import re
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, event, exc, text
+
+import league_reports
+from league_data import create_tables, read_workbook, write_csvs
+from pipeline_config import load_config, shared_engine
+
+
+SQL_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        "football league analysis.sql")
+
+POSTGRES_URL = os.environ.get("LEAGUE_TEST_POSTGRES_URL")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(league_reports, "generation_cache",
+                        league_reports.ReportCache(ttl_seconds=league_reports.GENERATION_POLL_SECONDS, clock=clock))
+    league_reports.report_cache.clear()
+    return clock
+
+
+def count_statements(engine):
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    return statements
+
+
+def bump_elsewhere(engine):
+    # A load by another process: the database changes, not this process's cache
+    with engine.begin() as connection:
+        connection.execute(text(f"UPDATE {league_reports.GENERATION_TABLE} SET generation = generation + 1"))
+
+
+def test_cached_reports_make_no_query_until_another_process_loads(tmp_path, monkeypatch, clock):
+    url = f"sqlite:///{tmp_path / 'league.db'}"
+    reader, loader = create_engine(url), create_engine(url)
+    calls = []
+
+    def count(engine):
+        calls.append(engine)
+        return pd.DataFrame({"reads": [len(calls)]})
+
+    monkeypatch.setitem(league_reports.REPORTS, "count", count)
+
+    assert league_reports.run_generation(reader) == 0
+    league_reports.bump_run_generation(loader)
+    # seen at once by the loading process
+    assert league_reports.run_generation(reader) == 1
+    assert league_reports.report(reader, "count")['reads'].tolist() == [1]
+
+    statements = count_statements(reader)
+    assert league_reports.report(reader, "count")['reads'].tolist() == [1]
+    assert league_reports.run_reports(reader, ["count"])["count"]['reads'].tolist() == [1]
+    assert statements == []
+
+    bump_elsewhere(loader)
+    clock.now += league_reports.GENERATION_POLL_SECONDS / 2
+    assert league_reports.report(reader, "count")['reads'].tolist() == [1]
+    clock.now += league_reports.GENERATION_POLL_SECONDS
+    assert league_reports.run_generation(reader) == 2
+    assert league_reports.report(reader, "count")['reads'].tolist() == [2]
+    assert len(statements) == 1
+
+
+def test_only_a_missing_generation_table_reads_as_no_load(tmp_path, clock):
+    engine = create_engine(f"sqlite:///{tmp_path / 'league.db'}")
+    assert league_reports.run_generation(engine) == 0
+
+    with engine.begin() as connection:
+        connection.execute(text(f"CREATE TABLE {league_reports.GENERATION_TABLE} (other INTEGER)"))
+    clock.now += league_reports.GENERATION_POLL_SECONDS + 1
+    with pytest.raises(exc.OperationalError):
+        league_reports.run_generation(engine)
+
+
+# Reports against the original queries
+
+def original_queries():
+    # {report name: query} of the SQL file, whose statements are headed by
+    # a comment and not all end with a semicolon
+    names = {
+        "Highest Scorer": "highest_scorer",
+        "Top player contributors": "top_contributors",
+        "Most minutes played": "most_minutes",
+        "Player who played over 300 minutes": "over_300_minutes",
+        "Average age per team": "average_age",
+        "Total wins per team": "team_wins",
+        "Most expensive player transfers": "most_expensive_transfer",
+        "Total clean sheets per team": "clean_sheets",
+    }
+    with open(SQL_FILE) as f:
+        parts = re.split(r"^--(.*)$", f.read(), flags=re.MULTILINE)[1:]
+    return {names[title.strip()]: query.strip().rstrip(";") for title, query in zip(parts[::2], parts[1::2])}
+
+
+ORIGINAL_QUERIES = original_queries()
+
+PLAYER_LEADERS = ["highest_scorer", "top_contributors", "most_minutes"]
+TEAM_RESULTS = ["team_wins", "clean_sheets"]
+
+TEAM = "Milan City"
+SEASON = 2022
+
+
+def with_fractional_assists(sheets):
+    # Half assists in every third stat, which the summaries must not round
+    stats = sheets["player_stats"].copy()
+    stats.loc[stats.index[::3], 'Assists'] += 0.5
+    return dict(sheets, player_stats=stats)
+
+
+@pytest.fixture(scope="module", params=["sqlite", "sqlite-fractional-assists", "postgresql"])
+def league(request, tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp(request.param)
+    if request.param.startswith("sqlite"):
+        database_url = f"sqlite:///{data_dir / 'league.sqlite'}"
+    elif POSTGRES_URL is None:
+        pytest.skip("LEAGUE_TEST_POSTGRES_URL is not set")
+    else:
+        database_url = POSTGRES_URL
+    import league_pipeline
+
+    config = load_config(environ={}, database_url=database_url, data_dir=str(data_dir), sync_mode="full")
+    sheets = read_workbook()
+    if request.param.endswith("fractional-assists"):
+        sheets = with_fractional_assists(sheets)
+    write_csvs(config.path("csv_dir"), sheets)
+    engine = shared_engine(database_url)
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as connection:
+            connection.execute(text("DROP SCHEMA public CASCADE"))
+            connection.execute(text("CREATE SCHEMA public"))
+    create_tables(engine)
+    # the second run loads the stats the first rejected
+    league_pipeline.process_data_task(config)
+    league_pipeline.process_data_task(config)
+    return engine
+
+
+def restricted_tables(engine, name, team, season):
+    # The cleaned tables the original query of report name reads, cut down
+    # to the team and season, as temporary views that shadow them
+    schema = "main" if engine.dialect.name == "sqlite" else "public"
+    team_ids = f"(SELECT team_id FROM {schema}.cleaned_teams WHERE team_name = :team)"
+    conditions = {}
+    if team is not None:
+        if name in TEAM_RESULTS:
+            conditions["cleaned_teams"] = "team_name = :team"
+        elif name == "most_expensive_transfer":
+            conditions["cleaned_transfer_history"] = f"(from_team_id IN {team_ids} OR to_team_id IN {team_ids})"
+        else:
+            conditions["cleaned_players"] = f"team_id IN {team_ids}"
+    if season is not None:
+        in_season = "{} >= :season_start AND {} < :season_end"
+        conditions["cleaned_matches"] = in_season.format("match_date", "match_date")
+        conditions["cleaned_player_stats"] = (f"match_id IN (SELECT match_id FROM {schema}.cleaned_matches "
+                                              f"WHERE {in_season.format('match_date', 'match_date')})")
+        history = conditions.get("cleaned_transfer_history", "1 = 1")
+        conditions["cleaned_transfer_history"] = f"{history} AND {in_season.format('trans_date', 'trans_date')}"
+    return {table_name: f"SELECT * FROM {schema}.{table_name} WHERE {condition}"
+            for table_name, condition in conditions.items()}
+
+
+def original_report(engine, name, team=None, season=None, query=None):
+    params = {"team": team, **league_reports.window_params(season)}
+    with engine.connect() as connection:
+        for table_name, view in restricted_tables(engine, name, team, season).items():
+            statement = text(f"CREATE TEMPORARY VIEW {table_name} AS {view}")
+            # views take no parameters
+            connection.execute(text(str(statement.bindparams(**{
+                key: value for key, value in params.items() if f":{key}" in view
+            }).compile(engine, compile_kwargs={"literal_binds": True}))))
+        result = pd.read_sql(text(query or ORIGINAL_QUERIES[name]), connection)
+        for table_name in restricted_tables(engine, name, team, season):
+            connection.execute(text(f"DROP VIEW {table_name}"))
+    return result
+
+
+def comparable(df):
+    # rows in any order (ties), by position, numbers as floats
+    df = df.copy()
+    df.columns = range(len(df.columns))
+    for column in df.columns:
+        numbers = pd.to_numeric(df[column], errors="coerce")
+        if numbers.notna().all():
+            df[column] = numbers.astype("float64")
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def skip_unsupported(engine, name):
+    if name == "average_age" and engine.dialect.name != "postgresql":
+        pytest.skip("AGE and EXTRACT are PostgreSQL only")
+
+
+PARAMETERS = [{}, {"team": TEAM}, {"season": SEASON}, {"team": TEAM, "season": SEASON}]
+
+
+@pytest.mark.parametrize("name", list(league_reports.REPORTS))
+@pytest.mark.parametrize("params", PARAMETERS, ids=lambda params: "-".join(params) or "all")
+def test_reports_match_the_original_queries(league, name, params):
+    skip_unsupported(league, name)
+    if name == "average_age" and "season" in params:
+        pytest.skip("average_age has no season")
+    if "season" in params:
+        params = dict(params, season=league_reports.season_window(params["season"]))
+    expected = original_report(league, name, params.get("team"), params.get("season"))
+    assert len(expected)
+
+    actual = league_reports.REPORTS[name](league, **params)
+
+    pd.testing.assert_frame_equal(comparable(actual), comparable(expected))
+
+
+def ranking_query(name):
+    # The first CTE of a player leader query: the total of every player
+    match = re.match(r"(?is)with\s+(\w+)\s+as\s*\(.*?\n\)", ORIGINAL_QUERIES[name])
+    return f"{match.group(0)} SELECT * FROM {match.group(1)}"
+
+
+@pytest.mark.parametrize("name", PLAYER_LEADERS + TEAM_RESULTS + ["most_expensive_transfer"])
+@pytest.mark.parametrize("team", [None, TEAM])
+def test_top_n_reports_are_the_best_rows_of_the_original_queries(league, name, team):
+    top_n = 3
+    if name in PLAYER_LEADERS:
+        expected = original_report(league, name, team, query=ranking_query(name))
+    elif name == "most_expensive_transfer":
+        query = ORIGINAL_QUERIES[name].replace(
+            "T.trans_fee = (SELECT MAX(trans_fee) FROM cleaned_transfer_history)", "1 = 1")
+        expected = original_report(league, name, team, query=query)
+    else:
+        expected = original_report(league, name, team)
+
+    actual = league_reports.REPORTS[name](league, team=team, top_n=top_n)
+
+    # the ranked values: the wins by home then away wins, the others by their
+    # last or only number. NULL totals (no assists) are left out, as by MAX.
+    def values(df, column):
+        rows = map(tuple, df.iloc[:, column].astype("float64").to_numpy().reshape(len(df), -1))
+        return sorted((row for row in rows if not pd.isna(list(row)).any()), reverse=True)
+
+    column = {"team_wins": [1, 2], "most_expensive_transfer": 1}.get(name, -1)
+    assert len(actual) == min(top_n, len(expected))
+    assert values(actual, column) == values(expected, column)[:top_n]
@@ -0,0 +1,47 @@
+# Narrowing to the compact dtypes of league_schema.py never changes a value
+
+import pandas as pd
+import pytest
+
+from league_schema import COLUMN_NAMES, apply_schema
+from parquet_staging import read_staged, read_typed_csv, stage_csvs
+
+
+def test_values_out_of_range_keep_the_wider_type():
+    df = pd.DataFrame({
+        'stat_id': [1, 2],
+        'goals': [300, 2],
+        'yellow_cards': [1.5, 0.0],
+        'red_cards': [1.0, 0.0],
+        'mins_played': [40000, 90],
+    })
+    typed = apply_schema(df, "player_stats")
+    assert typed['stat_id'].dtype == "int32"
+    assert typed['red_cards'].dtype == "int8"
+    pd.testing.assert_frame_equal(typed.astype("float64"), df.astype("float64"))
+
+
+def test_csv_values_out_of_range_keep_the_wider_type(tmp_path):
+    path = tmp_path / "stats.csv"
+    path.write_text("StatID,PlayerID,MatchID,Goals,Assists,YellowCards,RedCards,MinutesPlayed\n"
+                    "1,1,1,200,0,0,0,40000\n"
+                    "2,1,2,1,0,0,0,\n")
+    df = read_typed_csv(path, "player_stats", COLUMN_NAMES["player_stats"])
+    assert df['goals'].tolist() == [200, 1]
+    assert df['mins_played'].iloc[0] == 40000 and df['mins_played'].isna().iloc[1]
+    assert df['yellow_cards'].dtype == "int8"
+
+
+def test_staged_values_out_of_range_keep_the_wider_type(tmp_path):
+    pytest.importorskip("pyarrow")
+    csv_dir = tmp_path / "csv"
+    csv_dir.mkdir()
+    (csv_dir / "matches.csv").write_text("MatchID,Date,HomeTeamID,AwayTeamID,HomeTeamScore,AwayTeamScore,Stadium,Referee\n"
+                                         "1,2023-08-01,1,2,130,0,A,B\n")
+    (csv_dir / "stats.csv").write_text("StatID,PlayerID,MatchID,Goals,Assists,YellowCards,RedCards,MinutesPlayed\n"
+                                       "1,1,1,1,0,0,0,40000\n")
+    csv_files = {"matches": csv_dir / "matches.csv", "player_stats": csv_dir / "stats.csv"}
+    staging_dir = str(tmp_path / "staging")
+    stage_csvs(csv_files, COLUMN_NAMES, staging_dir)
+    assert read_staged(staging_dir, "matches")['home_team_score'].tolist() == [130]
+    assert read_staged(staging_dir, "player_stats")['mins_played'].tolist() == [40000]
@@ -0,0 +1,48 @@
+# Chunked staging of the streamed tables
+
+import pandas as pd
+import pytest
+
+from league_schema import COLUMN_NAMES
+from parquet_staging import read_staged, read_staged_chunks, read_typed_csv, stage_csvs
+
+
+pytest.importorskip("pyarrow")
+
+MATCHES = ("MatchID,Date,HomeTeamID,AwayTeamID,HomeTeamScore,AwayTeamScore,Stadium,Referee\n"
+           "1,2023-08-01,1,2,1,0,A,B\n"
+           "2,2023-09-01,2,1,0,0,A,B\n")
+
+# chunks of two rows: int16 minutes, then missing minutes, then minutes out of int16
+STATS = ("StatID,PlayerID,MatchID,Goals,Assists,YellowCards,RedCards,MinutesPlayed\n"
+         "1,1,1,1,0,0,0,90\n"
+         "2,1,2,0,1,0,0,45\n"
+         "3,2,1,0,0,1,0,\n"
+         "2,1,2,2,1,0,0,60\n"
+         "4,2,2,0,0,0,0,40000\n"
+         "5,3,9,0,0,0,0,10\n")
+
+
+@pytest.fixture
+def staged(tmp_path):
+    (tmp_path / "matches.csv").write_text(MATCHES)
+    (tmp_path / "stats.csv").write_text(STATS)
+    csv_files = {"matches": tmp_path / "matches.csv", "player_stats": tmp_path / "stats.csv"}
+    staging_dir = str(tmp_path / "staging")
+    converted = stage_csvs(csv_files, COLUMN_NAMES, staging_dir, streamed=["player_stats"], chunk_rows=2)
+    assert list(converted) == ["matches"]
+    return staging_dir, read_typed_csv(tmp_path / "stats.csv", "player_stats", COLUMN_NAMES["player_stats"])
+
+
+def test_streamed_table_reads_back_whole(staged):
+    staging_dir, expected = staged
+    pd.testing.assert_frame_equal(read_staged(staging_dir, "player_stats"), expected)
+
+
+def test_streamed_table_reads_back_in_chunks(staged):
+    staging_dir, expected = staged
+    chunks = list(read_staged_chunks(staging_dir, "player_stats", 4))
+    assert [len(chunk) for chunk in chunks] == [4, 2]
+    # indexed by CSV row, whatever the order of the partitions
+    df = pd.concat(chunks).sort_index()
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False)
@@ -0,0 +1,79 @@
+# Rules of the registry: one error row per record with all its reasons, and
+# fixes that run in registration order on the already fixed frame
+
+import pandas as pd
+import pytest
+
+import quality_rules
+from quality_rules import apply_fixes, check, evaluate
+
+
+def stats(rows):
+    return pd.DataFrame(rows, columns=["stat_id", "player_id", "yellow_cards", "red_cards"])
+
+
+def test_a_record_breaking_two_rules_is_one_error_row_with_both_reasons():
+    df = stats([(1, 7, 0, 0), (2, 7, 3, 2), (3, 7, 0, 2), (4, 7, 2, 0)])
+
+    errors, valid = check("clean", "player_stats", df)
+
+    assert errors["stat_id"].tolist() == [2, 3, 4]
+    assert errors["reason"].tolist() == [
+        "Red Cards greater than 1, should be 1; Yellow Cards greater than 2, should be maximum 2",
+        "Red Cards greater than 1, should be 1",
+        "If there are any yellow cards = 2, then player should have a red card",
+    ]
+    assert valid["stat_id"].tolist() == [1]
+
+
+def test_rules_see_their_context():
+    players = pd.DataFrame({"player_id": [1, 2], "team_id": [10, 10]})
+    df = pd.DataFrame({"transfer_id": [1, 2], "player_id": [1, 3]})
+
+    masks = evaluate("sync", "transfer_history", df, {"valid_player_ids": players["player_id"], "players": players})
+    errors, valid = check("sync", "transfer_history", df, {"valid_player_ids": players["player_id"]})
+
+    assert masks["transfer_player_fk"].tolist() == [False, True]
+    assert errors["reason"].tolist() == ["ForeignKeyViolation: player_id not present in players table"]
+    assert valid["transfer_id"].tolist() == [1]
+
+
+def test_fixes_run_in_registration_order():
+    # the yellow cards are clamped to 2 before the second yellow becomes a red
+    df = stats([(1, 7, 3, 0), (2, 7, 2, 5), (3, 7, 1, 0)])
+
+    apply_fixes("clean", "player_stats", df)
+
+    assert df[["yellow_cards", "red_cards"]].values.tolist() == [[2, 1], [2, 1], [1, 0]]
+    assert check("clean", "player_stats", df)[0].empty
+
+
+def test_each_fix_sees_the_frame_the_previous_fix_left(monkeypatch):
+    calls = []
+
+    def append(value):
+        def fix(df):
+            calls.append(df["x"].tolist())
+            df["x"] = df["x"] * 10 + value
+        return fix
+
+    monkeypatch.setattr(quality_rules, "RULES", [])
+    for value in [1, 2, 3]:
+        quality_rules.rule(f"rule_{value}", "table", "clean", lambda df, context: df["x"] < 0, "", fix=append(value))
+    quality_rules.rule("other_stage", "table", "sync", lambda df, context: df["x"] < 0, "", fix=append(9))
+    df = pd.DataFrame({"x": [0]})
+
+    apply_fixes("clean", "table", df)
+
+    assert calls == [[0], [1], [12]]
+    assert df["x"].tolist() == [123]
+
+
+@pytest.mark.parametrize("stage, table", [("clean", "player_stats"), ("sync", "player_stats"), ("clean", "players")])
+def test_a_frame_without_offending_rows_passes_whole(stage, table):
+    df = stats([(1, 7, 0, 0), (2, 8, 1, 1)])
+
+    errors, valid = check(stage, table, df, {"valid_player_ids": pd.Series([7, 8])})
+
+    assert errors.empty and list(errors.columns) == [*df.columns, "reason"]
+    pd.testing.assert_frame_equal(valid, df)
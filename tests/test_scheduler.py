@@ -0,0 +1,157 @@
+# The scheduler with a fake clock and a fake task: runs only for changed
+# sources, backs off exponentially after failures, and records every run
+
+import json
+import os
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+import scheduler
+from scheduler import RUNS_TABLE, PipelineScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeTask:
+    # Fails while failing is set, else returns an instrumentation summary
+    def __init__(self):
+        self.calls = 0
+        self.failing = False
+
+    def __call__(self):
+        self.calls += 1
+        if self.failing:
+            raise RuntimeError("database down")
+        return SimpleNamespace(stages={"load": 1.5}, rows={"teams": 3})
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def task():
+    return FakeTask()
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / "teams.csv"
+    path.write_text("TeamID,TeamName\n1,Lions\n")
+    return path
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'league.sqlite'}")
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def pipeline_scheduler(task, engine, csv_path, clock):
+    return PipelineScheduler(task, engine, [csv_path], interval_seconds=10, max_backoff_seconds=100, clock=clock)
+
+
+def touch(path, seconds_later=10):
+    # a new mtime, even on file systems with a coarse one
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds_later * 1_000_000_000))
+
+
+def recorded_runs(engine):
+    return pd.read_sql(f"SELECT outcome, error, stage_durations, row_counts FROM {RUNS_TABLE} ORDER BY run_id", engine)
+
+
+def test_unchanged_sources_are_skipped(pipeline_scheduler, task, csv_path, monkeypatch):
+    checksums = []
+    monkeypatch.setattr(scheduler, "file_checksum", lambda path: checksums.append(path) or path.read_bytes())
+
+    assert pipeline_scheduler.run_once() == "success"
+    assert pipeline_scheduler.run_once() == "skipped: sources unchanged"
+    # not even read again
+    assert len(checksums) == 1
+
+    # touched but identical: read once, then known by its new mtime
+    touch(csv_path)
+    assert pipeline_scheduler.run_once() == "skipped: sources unchanged"
+    assert pipeline_scheduler.run_once() == "skipped: sources unchanged"
+    assert len(checksums) == 2
+
+    csv_path.write_text("TeamID,TeamName\n1,Lions\n2,Eagles\n")
+    touch(csv_path, 20)
+    assert pipeline_scheduler.run_once() == "success"
+    assert pipeline_scheduler.run_once(force=True) == "success"
+    assert task.calls == 3
+
+
+def test_failures_back_off_exponentially_up_to_the_cap(pipeline_scheduler, task, clock):
+    task.failing = True
+    waits = []
+    for _ in range(5):
+        assert pipeline_scheduler.run_once() == "failed"
+        waits.append(pipeline_scheduler.next_attempt - clock.now)
+        clock.now += waits[-1] - 1
+        assert pipeline_scheduler.run_once() == "skipped: backing off"
+        clock.now += 1
+
+    assert waits == [20, 40, 80, 100, 100]
+    assert task.calls == 5
+
+    # the sources are still unchanged for the last successful run, so the
+    # run after the failures is not skipped; it resets the backoff
+    task.failing = False
+    assert pipeline_scheduler.run_once() == "success"
+    assert (pipeline_scheduler.failures, pipeline_scheduler.next_attempt) == (0, 0.0)
+    assert pipeline_scheduler.run_once() == "skipped: sources unchanged"
+
+
+def test_runs_are_recorded_with_their_outcome(pipeline_scheduler, task, engine, clock):
+    assert pipeline_scheduler.run_once() == "success"
+    task.failing = True
+    assert pipeline_scheduler.run_once(force=True) == "failed"
+
+    runs = recorded_runs(engine)
+    assert runs["outcome"].tolist() == ["success", "failed"]
+    assert json.loads(runs["stage_durations"][0]) == {"load": 1.5}
+    assert json.loads(runs["row_counts"][0]) == {"teams": 3}
+    assert runs["error"][1] == "RuntimeError: database down"
+    assert runs["stage_durations"].isna().tolist() == [False, True]
+
+
+def test_errors_around_the_task_fail_the_run_with_the_same_backoff(pipeline_scheduler, task, engine, csv_path,
+                                                                     clock):
+    # a watched file missing: the task is not run
+    moved = csv_path.with_suffix(".moved")
+    csv_path.rename(moved)
+    assert pipeline_scheduler.run_once() == "failed"
+    assert (task.calls, pipeline_scheduler.failures, pipeline_scheduler.next_attempt) == (0, 1, 20)
+
+    # the database refusing the record of the run: the task ran, the run failed
+    moved.rename(csv_path)
+    clock.now = 20
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE {RUNS_TABLE}"))
+    assert pipeline_scheduler.run_once() == "failed"
+    assert (task.calls, pipeline_scheduler.failures, pipeline_scheduler.next_attempt) == (1, 2, 60)
+    # its sources are not taken as done
+    assert pipeline_scheduler.fingerprints == {}
+
+
+def test_a_run_already_in_progress_is_skipped(engine, csv_path, clock):
+    outcomes = []
+    pipeline_scheduler = PipelineScheduler(lambda: outcomes.append(pipeline_scheduler.run_once(force=True)),
+                                           engine, [csv_path], clock=clock)
+
+    assert pipeline_scheduler.run_once() == "success"
+    assert outcomes == ["skipped: already running"]
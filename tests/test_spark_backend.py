@@ -0,0 +1,228 @@
+# Spark backend against the pandas pipeline, in local[*] mode on the dummy
+# workbook: whole runs (full sync) over JDBC, and the transformations alone.
+# Needs pyspark and Java. The runs also need a PostgreSQL database the test
+# may wipe, given by LEAGUE_TEST_POSTGRES_URL; Spark fetches the JDBC driver
+# (see spark_backend.JDBC_DRIVER_PACKAGE) unless LEAGUE_SPARK_JARS gives it.
+
+import os
+import shutil
+from datetime import datetime
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from sqlalchemy import text
+
+from league_data import TABLE_COLUMNS, create_tables, write_csvs
+from pipeline_config import CSV_NAMES, load_config, shared_engine
+
+
+pytest.importorskip("pyspark")
+
+DATABASE_URL = os.environ.get("LEAGUE_TEST_POSTGRES_URL")
+
+pytestmark = pytest.mark.skipif(shutil.which("java") is None and "JAVA_HOME" not in os.environ, reason="no Java")
+
+COMPARED_TABLES = [
+    *TABLE_COLUMNS,
+    *[f"cleaned_{table_name}" for table_name in TABLE_COLUMNS],
+    "teams_errors", "player_stats_errors", "transfer_history_errors",
+    "final_view", "final_view_aggregates", "player_summary", "team_summary",
+]
+
+
+def edit_csvs(csv_dir):
+    # The last team and match only remain in the database, and one stat changes
+    for table_name, key in (("teams", "TeamID"), ("matches", "MatchID")):
+        path = os.path.join(csv_dir, CSV_NAMES[table_name])
+        df = pd.read_csv(path)
+        df[df[key] != df[key].max()].to_csv(path, index=False)
+    path = os.path.join(csv_dir, CSV_NAMES["player_stats"])
+    df = pd.read_csv(path)
+    df.loc[df.index[-1], 'Goals'] += 1
+    df.to_csv(path, index=False)
+
+
+def reset_database(engine):
+    with engine.begin() as connection:
+        connection.execute(text("DROP SCHEMA public CASCADE"))
+        connection.execute(text("CREATE SCHEMA public"))
+    create_tables(engine)
+
+
+def run_backend(process_data_task, data_dir):
+    # Two full syncs, the second with rows only in the database; returns
+    # every compared table
+    config = load_config(environ={}, database_url=DATABASE_URL, data_dir=str(data_dir), sync_mode="full",
+                         track_history=False, spark_jars=os.environ.get("LEAGUE_SPARK_JARS"))
+    engine = shared_engine(DATABASE_URL)
+    write_csvs(config.path("csv_dir"))
+    reset_database(engine)
+    process_data_task(config)
+    edit_csvs(config.path("csv_dir"))
+    process_data_task(config)
+
+    tables = {table_name: pd.read_sql_table(table_name, engine) for table_name in COMPARED_TABLES}
+    tables["players_history"] = pd.read_sql_table("players_history", engine).drop(columns=['Time'])
+    return tables
+
+
+def comparable(df, columns):
+    df = df[columns].sort_values(columns).reset_index(drop=True)
+    for column in columns:
+        if df[column].dtype == object:
+            df[column] = df[column].astype(str)
+    return df
+
+
+@pytest.mark.skipif(DATABASE_URL is None, reason="LEAGUE_TEST_POSTGRES_URL is not set")
+def test_spark_matches_pandas(tmp_path):
+    import league_pipeline
+    import spark_backend
+
+    expected = run_backend(league_pipeline.process_data_task, tmp_path / "pandas")
+    actual = run_backend(spark_backend.process_data_task, tmp_path / "spark")
+
+    for table_name, df in expected.items():
+        columns = list(df.columns)
+        assert sorted(actual[table_name].columns) == sorted(columns), table_name
+        pd.testing.assert_frame_equal(
+            comparable(actual[table_name], columns), comparable(df, columns), check_dtype=False, obj=table_name)
+
+
+
+# Transformations, without a database. They run after the test above and
+# reuse its session, which has the JDBC driver.
+
+@pytest.fixture(scope="module")
+def spark():
+    from pyspark.sql import SparkSession
+
+    return SparkSession.builder.master("local[*]").config("spark.sql.shuffle.partitions", "4").getOrCreate()
+
+
+@pytest.fixture(scope="module")
+def tables(spark, tmp_path_factory):
+    # {table: (pandas frame, Spark frame)} of the CSVs as the full sync of an
+    # empty database leaves them, read as either backend reads them
+    import spark_backend
+    from incremental_sync import TABLE_KEYS
+    from league_schema import COLUMN_NAMES, apply_schema
+
+    config = load_config(environ={}, data_dir=str(tmp_path_factory.mktemp("spark")))
+    write_csvs(config.path("csv_dir"))
+    run = SimpleNamespace(config=config, spark=spark, csv={})
+    spark_backend.read_csvs(run)
+
+    tables = {}
+    for table_name, path in config.csv_paths().items():
+        key = TABLE_KEYS[table_name]
+        df = pd.read_csv(path).rename(columns=COLUMN_NAMES[table_name])
+        df = apply_schema(df.drop_duplicates(subset=key, keep="last").reset_index(drop=True), table_name)
+        tables[table_name] = (df, spark_backend.keep_last(run.csv[table_name], key).cache())
+    return tables
+
+
+def same_rows(actual, expected):
+    # A Spark frame and a pandas frame, in any row order
+    columns = list(expected.columns)
+    assert sorted(actual.columns) == sorted(columns)
+    pd.testing.assert_frame_equal(
+        comparable(actual.toPandas(), columns).astype(str), comparable(expected, columns).astype(str))
+
+
+def test_keep_last_prefers_csv_rows_and_later_rows(tables):
+    from pyspark.sql import functions as F
+
+    from spark_backend import ROW_COLUMN, SOURCE_COLUMN, keep_last
+
+    stats, spark_stats = tables["player_stats"]
+    # in the database: an old version of every other stat, and one stat only there
+    only_stored = spark_stats.filter(F.col('stat_id') == 1).withColumn('stat_id', F.lit(10 ** 6))
+    existing = (
+        spark_stats.filter(F.col('stat_id') % 2 == 0).withColumn('goals', F.col('goals') + 100)
+        .unionByName(only_stored)
+        .withColumn(SOURCE_COLUMN, F.lit(0)).withColumn(ROW_COLUMN, F.monotonically_increasing_id())
+    )
+    # in the CSV: every stat twice, the second time with the goals of the synced row
+    csv = (
+        spark_stats.withColumn('goals', F.lit(-1)).withColumn(ROW_COLUMN, F.lit(0))
+        .unionByName(spark_stats.withColumn(ROW_COLUMN, F.lit(1)))
+        .withColumn(SOURCE_COLUMN, F.lit(1))
+    )
+
+    expected = pd.concat([stats, stats[stats['stat_id'] == 1].assign(stat_id=10 ** 6)], ignore_index=True)
+    same_rows(keep_last(existing.unionByName(csv), 'stat_id'), expected)
+
+
+@pytest.mark.parametrize("stage, table_name, key", [
+    ("sync", "player_stats", "stat_id"),
+    ("sync", "transfer_history", "trans_id"),
+    ("clean", "teams", "team_id"),
+    ("clean", "player_stats", "stat_id"),
+])
+def test_rules_match_quality_rules(tables, stage, table_name, key):
+    import quality_rules
+    import spark_backend
+
+    df, spark_df = tables[table_name]
+    players, spark_players = tables["players"]
+    # every fifth player unknown to the foreign key rules, and the teams of
+    # even id cut down to 11 players, the most they may have
+    known = players[players['player_id'] % 5 != 0]
+    squads = players[(players['team_id'] % 2 == 1) | (players.groupby('team_id').cumcount() < 11)]
+    context = {'valid_player_ids': known['player_id'], 'players': squads}
+    spark_context = {
+        'valid_player_ids': spark_players.filter(spark_players['player_id'] % 5 != 0),
+        'players': spark_players.filter(spark_players['player_id'].isin(squads['player_id'].tolist())),
+    }
+
+    errors, valid = quality_rules.check(stage, table_name, df, context)
+    spark_errors, spark_valid = spark_backend.check(stage, table_name, spark_df, spark_context)
+
+    assert len(errors) and len(valid)
+    same_rows(spark_errors, errors)
+    same_rows(spark_valid, valid)
+
+
+def test_fixes_match_quality_rules(tables):
+    import quality_rules
+    import spark_backend
+
+    stats, spark_stats = tables["player_stats"]
+    fixed = stats.copy()
+    quality_rules.apply_fixes("clean", "player_stats", fixed)
+
+    assert not fixed.equals(stats)
+    same_rows(spark_backend.apply_fixes("clean", "player_stats", spark_stats), fixed)
+
+
+def test_final_view_matches_final_view_py(tables):
+    import final_view
+    import spark_backend
+
+    stats, players, teams, transfers = (tables[table_name] for table_name in
+                                        ("player_stats", "players", "teams", "transfer_history"))
+    aggregates = final_view.player_aggregates(stats[0], teams[0], transfers[0])
+    spark_aggregates = spark_backend.player_aggregates(stats[1], teams[1], transfers[1])
+    view = final_view.view_from_aggregates(aggregates, players[0], teams[0], now=datetime.now())
+    spark_view = spark_backend.view_from_aggregates(spark_aggregates, players[1], teams[1])
+
+    assert spark_view.columns == final_view.FINAL_VIEW_COLUMNS
+    same_rows(spark_aggregates, aggregates)
+    same_rows(spark_view, view)
+
+
+def test_settings_the_backend_ignores(caplog):
+    import spark_backend
+
+    with caplog.at_level("WARNING", logger="spark_backend"):
+        spark_backend.check_settings(load_config(environ={}, sync_mode="full", track_history=False))
+        assert not caplog.records
+        spark_backend.check_settings(load_config(environ={}))
+    assert [record.getMessage() for record in caplog.records] == [
+        "The Spark backend runs the full sync, sync_mode 'incremental' is ignored",
+        "The Spark backend keeps no type-2 history, track_history is ignored",
+    ]
+    with pytest.raises(ValueError, match="sync_apply_deletes"):
+        spark_backend.check_settings(load_config(environ={}, sync_mode="full", sync_apply_deletes=True))
@@ -0,0 +1,118 @@
+# Stages run after their dependencies, sequentially and on a thread pool;
+# a failure stops its dependents; malformed graphs are refused
+
+import threading
+
+import pytest
+
+from stage_graph import Task, check_graph, run_graph, table_tasks
+
+
+def noop(run, *args):
+    return [], []
+
+
+def graph():
+    # read:a  read:b
+    #    \     /  \
+    #     load     index:b
+    #       |
+    #     report
+    return [
+        *table_tasks("read", noop, ["a", "b"]),
+        Task("load", noop, needs=("read:a", "read:b")),
+        *table_tasks("index", noop, ["b"], lambda table_name: [f"read:{table_name}"]),
+        Task("report", noop, needs=("load",)),
+    ]
+
+
+class Recorder:
+    # run_task that records the order the tasks ran in, failing the named ones
+    def __init__(self, failing=(), blocking=()):
+        self.order = []
+        self.failing = failing
+        self.blocking = blocking
+        self.released = threading.Event()
+        self.lock = threading.Lock()
+
+    def __call__(self, task):
+        if task.name in self.blocking:
+            assert self.released.wait(5)
+        if task.name in self.failing:
+            self.released.set()
+            raise RuntimeError(task.name)
+        with self.lock:
+            self.order.append(task.name)
+
+
+def assert_dependency_order(tasks, order):
+    position = {name: index for index, name in enumerate(order)}
+    for task in tasks:
+        for need in task.needs:
+            assert position[need] < position[task.name], f"{task.name} ran before {need}"
+
+
+def test_table_tasks_name_and_chain_the_per_table_stages():
+    tasks = table_tasks("index", noop, ["a", "b"], lambda table_name: [f"read:{table_name}"])
+
+    assert [(task.name, task.args, task.needs) for task in tasks] == [
+        ("index:a", ("a",), ("read:a",)), ("index:b", ("b",), ("read:b",))]
+
+
+def test_a_single_worker_runs_the_ready_tasks_in_list_order():
+    recorder = Recorder()
+    run_graph(graph(), recorder)
+
+    assert recorder.order == ["read:a", "read:b", "load", "index:b", "report"]
+
+
+@pytest.mark.parametrize("workers", [2, 4])
+def test_the_pool_runs_every_task_after_its_dependencies(workers):
+    tasks = graph()
+    recorder = Recorder()
+    run_graph(tasks, recorder, workers=workers)
+
+    assert sorted(recorder.order) == sorted(task.name for task in tasks)
+    assert_dependency_order(tasks, recorder.order)
+
+
+def test_the_pool_runs_independent_tasks_at_once():
+    # each read waits for the other to start
+    started = threading.Barrier(2, timeout=5)
+    tasks = [Task(f"read:{name}", noop) for name in "ab"]
+
+    run_graph(tasks, lambda task: started.wait(), workers=2)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_a_failing_stage_cancels_its_dependents(workers):
+    # read:a fails while read:b is still running: read:b finishes, nothing new starts
+    recorder = Recorder(failing=["read:a"], blocking=["read:b"] if workers > 1 else [])
+
+    with pytest.raises(RuntimeError, match="read:a"):
+        run_graph(graph(), recorder, workers=workers)
+
+    assert "load" not in recorder.order and "report" not in recorder.order
+    assert "index:b" not in recorder.order
+    if workers > 1:
+        assert recorder.order == ["read:b"]
+
+
+@pytest.mark.parametrize("tasks, message", [
+    ([Task("a", noop), Task("a", noop)], "Duplicated tasks: a"),
+    ([Task("a", noop, needs=("b", "c")), Task("b", noop)], "Unknown dependencies: c"),
+    ([Task("a", noop, needs=("b",)), Task("b", noop, needs=("a",)), Task("c", noop)],
+     "Dependency cycle between a, b"),
+    ([Task("a", noop, needs=("a",))], "Dependency cycle between a"),
+    ([Task("a", noop), Task("b", noop, needs=("a", "d")), Task("c", noop, needs=("b",)),
+      Task("d", noop, needs=("c",))], "Dependency cycle between b, c, d"),
+])
+def test_malformed_graphs_are_refused_before_any_task_runs(tasks, message):
+    recorder = Recorder()
+    with pytest.raises(ValueError, match=message):
+        check_graph(tasks)
+    for workers in [1, 2]:
+        with pytest.raises(ValueError, match=message):
+            run_graph(tasks, recorder, workers=workers)
+
+    assert recorder.order == []
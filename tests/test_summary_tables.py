@@ -0,0 +1,62 @@
+# Summary tables keep fractional assists, also in tables created before
+# assists could hold fractions
+
+import pandas as pd
+from sqlalchemy import Integer, create_engine, inspect, text
+
+from bulk_loader import make_writer
+from league_data import create_tables
+from summary_tables import (
+    PLAYER_SUMMARY_TABLE, player_summary, player_totals, refresh_summary_tables, summary_tables_current, team_results,
+    team_summary,
+)
+
+
+PLAYERS = pd.DataFrame({
+    'player_id': [1, 2, 3],
+    'player_name': ["Ann", "Bob", "Cid"],
+    'team_id': [10, 10, 20],
+    'birthdate': pd.to_datetime(["1990-01-01", "1995-06-30", "2000-12-31"]),
+})
+TEAMS = pd.DataFrame({'team_id': [10, 20], 'team_name': ["Lions", "Eagles"], 'country': ["France", "Italy"]})
+STATS = pd.DataFrame({
+    'player_id': [1, 1, 2],
+    'goals': [1, 2, 0],
+    'assists': [0.5, None, 1.0],
+    'mins_played': [90, 45, 30],
+})
+MATCHES = pd.DataFrame({'home_team_id': [10], 'away_team_id': [20], 'home_team_score': [1], 'away_team_score': [0]})
+
+
+def test_player_summary_keeps_fractional_assists():
+    summary = player_summary(player_totals(STATS), PLAYERS, TEAMS).set_index('player_id')
+
+    assert summary['total_assists'].tolist() == [0.5, 1.0, 0.0]
+    assert summary['total_contributions'].tolist() == [3.5, 1.0, 0.0]
+    assert summary['total_goals'].tolist() == [3, 0, 0]
+    assert summary[['total_goals', 'total_minutes', 'stat_rows']].dtypes.eq('int64').all()
+
+
+def test_tables_with_integer_assists_are_created_again(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'league.sqlite'}")
+    # the cleaned tables, which the refresh indexes too
+    create_tables(engine)
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"CREATE TABLE {PLAYER_SUMMARY_TABLE} (player_id INTEGER, player_name TEXT, team_id INTEGER, "
+            "birthdate DATE, total_goals BIGINT, total_assists BIGINT, total_minutes BIGINT, stat_rows BIGINT, "
+            "total_contributions BIGINT, team_name TEXT)"))
+        connection.execute(text("CREATE TABLE team_summary (team_id INTEGER, team_name TEXT, country TEXT, "
+                                "matches_played BIGINT, home_wins BIGINT, away_wins BIGINT, clean_sheets BIGINT)"))
+    assert not summary_tables_current(engine)
+
+    players = player_summary(player_totals(STATS), PLAYERS, TEAMS)
+    refresh_summary_tables(make_writer(engine), players, team_summary(team_results(MATCHES), TEAMS))
+
+    assert summary_tables_current(engine)
+    column_types = {column['name']: column['type'] for column in inspect(engine).get_columns(PLAYER_SUMMARY_TABLE)}
+    assert not isinstance(column_types['total_assists'], Integer)
+    stored = pd.read_sql(f"SELECT player_id, total_assists FROM {PLAYER_SUMMARY_TABLE} ORDER BY player_id", engine)
+    assert stored['total_assists'].tolist() == [0.5, 1.0, 0.0]
+    indexes = {index['name'] for index in inspect(engine).get_indexes(PLAYER_SUMMARY_TABLE)}
+    assert "ix_player_summary_total_goals" in indexes